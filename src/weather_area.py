@@ -0,0 +1,220 @@
+"""This module combines the readings of the nearby stations.  A time slice of observations is
+loaded with the station coordinates into NumPy arrays, one row per time step and one column
+per station, then summarised per time step for the whole area (mean, median and an outlier
+rejected mean) and interpolated onto a grid by inverse distance weighting.  Everything runs
+as whole array operations, and the distance weights, which only depend on where the
+stations and grid points are, are cached per station set"""
+import datetime
+import math
+import warnings
+from collections import OrderedDict
+import numpy
+import src.weather_store
+import src.wu_station_index
+
+# Readings combined across the area
+MEASURES = ['temp_f', 'relative_humidity', 'pressure_mb']
+SLICE_COL_NAMES = ['station_id', 'time'] + MEASURES
+
+# Scales that make the median (or, where that is 0, the mean) absolute deviation
+# comparable to a standard deviation
+MAD_SCALE = 0.6745
+MEAN_AD_SCALE = 0.7979
+# Readings at or below this are the API's -999/-9999 placeholders (see
+# src.weather_rollup.valid_reading), older rows have them stored as numbers
+PLACEHOLDER_MAX = -999
+
+class ObservationSlice():
+    """Readings of a time slice as arrays.  values[measure] has one row per time step and one
+    column per station, NaN where the station did not report in that step or sent a
+    placeholder (the last reading in a step is kept)"""
+
+    def __init__(self, station_ids, lats, lons, step_starts, values):
+        """Initialize the slice
+        station_ids: list of station ids, in column order
+        lats, lons: float arrays of the station coordinates, in column order
+        step_starts: numpy datetime64 array of each time step's start, in row order
+        values: dict of measure -> float array (time steps x stations)"""
+        self.station_ids = station_ids
+        self.lats = lats
+        self.lons = lons
+        self.step_starts = step_starts
+        self.values = values
+
+    def __len__(self):
+        return len(self.step_starts)
+
+def mask_placeholders(values):
+    """Copy of the float array with the -999 style placeholders as NaN (no reading)"""
+    values = numpy.array(values, dtype=numpy.float64)
+    with numpy.errstate(invalid='ignore'):
+        values[values <= PLACEHOLDER_MAX] = numpy.nan
+    return values
+
+def as_datetime64(times):
+    """Times from either backend (datetime or 'YYYY-MM-DD HH:MM:SS' text) as datetime64[s]"""
+    return numpy.array([str(value).replace(' ', 'T') for value in times], dtype='datetime64[s]')
+
+def load_slice(dbw, conf, start_time, end_time, step_minutes=None):
+    """Load the readings with start_time < time <= end_time into an ObservationSlice.  Rows
+    are streamed in chunks and gathered into flat lists, all the reshaping is done on arrays
+    start_time, end_time: datetime.datetime
+    step_minutes: length of a time step (default area_step_minutes)"""
+    step = numpy.timedelta64(int((step_minutes or conf.values['area_step_minutes']) * 60), 's')
+    key_range = ('time', start_time.strftime('%Y-%m-%d %H:%M:%S'), end_time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    columns = [[] for col_name in SLICE_COL_NAMES]
+    for rows in dbw.stream_chunks(conf.values['observation_table_name'], SLICE_COL_NAMES, ['time'],
+                                  conf.values['report_chunk_size'], key_range):
+        for column, values in zip(columns, zip(*rows)):
+            column.extend(values)
+
+    # Only stations with known coordinates can be placed on the map
+    known_pws = src.weather_store.load_known_pws(dbw, conf)
+    located = sorted(station_id for station_id, cols in known_pws.items() if cols[0] is not None and cols[1] is not None)
+    station_index = {station_id: index for index, station_id in enumerate(located)}
+    lats = numpy.array([known_pws[station_id][0] for station_id in located], dtype=numpy.float64)
+    lons = numpy.array([known_pws[station_id][1] for station_id in located], dtype=numpy.float64)
+
+    first = numpy.datetime64(key_range[1].replace(' ', 'T'), 's')
+    step_count = max(1, int(math.ceil((numpy.datetime64(key_range[2].replace(' ', 'T'), 's') - first) / step)))
+    step_starts = first + step * numpy.arange(step_count)
+    values = {measure: numpy.full((step_count, len(located)), numpy.nan) for measure in MEASURES}
+
+    station_columns = numpy.array([station_index.get(station_id, -1) for station_id in columns[0]], dtype=numpy.int64)
+    keep = station_columns >= 0
+    if keep.any():
+        # Rows arrive in time order, so where a station reported twice in a step the later
+        # assignment is the one left
+        step_rows = numpy.minimum((as_datetime64(columns[1]) - first) // step, step_count - 1)[keep]
+        for offset, measure in enumerate(MEASURES):
+            readings = mask_placeholders(columns[2 + offset])
+            values[measure][step_rows, station_columns[keep]] = readings[keep]
+    return ObservationSlice(located, lats, lons, step_starts, values)
+
+def area_statistics(values, outlier_z=3.5):
+    """Per time step statistics across the stations
+    values: float array (time steps x stations), NaN (or a -999 placeholder) for no reading
+    outlier_z: readings whose modified z-score (distance from the median in scaled median
+    absolute deviations) is over this are left out of robust_mean.  Readings rounded to
+    whole numbers (pressure) often have a median absolute deviation of 0, the mean
+    absolute deviation stands in for it then
+    returns: dict of 'count', 'mean', 'median', 'robust_mean', 'outliers', one value per step"""
+    values = mask_placeholders(values)
+    present = ~numpy.isnan(values)
+    count = present.sum(axis=1)
+    # Steps with no readings at all come out as NaN, without the empty slice warnings
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = numpy.nanmean(values, axis=1)
+        median = numpy.nanmedian(values, axis=1)
+        deviation = numpy.abs(values - median[:, numpy.newaxis])
+        mad = numpy.nanmedian(deviation, axis=1)
+        spread = numpy.where(mad > 0, mad / MAD_SCALE, numpy.nanmean(deviation, axis=1) / MEAN_AD_SCALE)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            z = deviation / spread[:, numpy.newaxis]
+        # Where every reading agrees the spread is 0, keep them all
+        inliers = present & ((z <= outlier_z) | (deviation == 0))
+        robust_mean = numpy.nanmean(numpy.where(inliers, values, numpy.nan), axis=1)
+    return {'count': count, 'mean': mean, 'median': median, 'robust_mean': robust_mean,
+            'outliers': count - inliers.sum(axis=1)}
+
+def grid_axes(conf, center=None, radius_km=None, size=None):
+    """Latitudes and longitudes of a size x size grid covering radius_km around center
+    center: (lat, lon), default lat_lon
+    radius_km: default area_radius_km, or pws_max_distance_km if that is None
+    size: points per side, default area_grid_size
+    returns: (latitude array, longitude array), each of length size"""
+    if center is None:
+        center = tuple(float(value) for value in conf.values['lat_lon'].split(','))
+    if radius_km is None:
+        radius_km = conf.values['area_radius_km'] or conf.values['pws_max_distance_km']
+    size = size or conf.values['area_grid_size']
+    offsets_km = numpy.linspace(-radius_km, radius_km, size)
+    lats = center[0] + offsets_km / src.wu_station_index.KM_PER_DEG_LAT
+    lons = center[1] + offsets_km / (src.wu_station_index.KM_PER_DEG_LAT * max(math.cos(math.radians(center[0])), 1e-6))
+    return (lats, lons)
+
+def distance_matrix_km(lats_a, lons_a, lats_b, lons_b):
+    """Great circle (haversine) distance from every point a to every point b in km, same
+    formula as src.wu_station_index.distance_km
+    returns: float array (len a x len b)"""
+    lat_a = numpy.radians(lats_a)[:, numpy.newaxis]
+    lon_a = numpy.radians(lons_a)[:, numpy.newaxis]
+    lat_b = numpy.radians(lats_b)[numpy.newaxis, :]
+    lon_b = numpy.radians(lons_b)[numpy.newaxis, :]
+    h = numpy.sin((lat_b - lat_a) / 2) ** 2 + numpy.cos(lat_a) * numpy.cos(lat_b) * numpy.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * src.wu_station_index.EARTH_RADIUS_KM * numpy.arcsin(numpy.minimum(1.0, numpy.sqrt(h)))
+
+class IdwInterpolator():
+    """Inverse distance weighted interpolation onto a grid.  The weight matrix (grid points x
+    stations) is the costly part and only depends on the station and grid positions, so
+    the most recent max_cached of them are kept"""
+
+    def __init__(self, power=2.0, max_cached=32, min_distance_km=0.01):
+        """Initialize the interpolator
+        power: weights fall off as 1 / distance ** power
+        max_cached: weight matrices kept, least recently used dropped first
+        min_distance_km: distances are clamped to this, so a grid point on top of a
+        station takes (almost exactly) its reading"""
+        self.power = power
+        self.max_cached = max_cached
+        self.min_distance_km = min_distance_km
+        # (station lats, lons, grid lats, lons as bytes) -> weight matrix
+        self.weight_cache = OrderedDict()
+
+    def weights(self, station_lats, station_lons, grid_lats, grid_lons):
+        """Weight matrix (grid points x stations), grid points in row major order"""
+        key = (station_lats.tobytes(), station_lons.tobytes(), grid_lats.tobytes(), grid_lons.tobytes())
+        weights = self.weight_cache.get(key)
+        if weights is not None:
+            self.weight_cache.move_to_end(key)
+            return weights
+
+        point_lats = numpy.repeat(grid_lats, len(grid_lons))
+        point_lons = numpy.tile(grid_lons, len(grid_lats))
+        distances = numpy.maximum(distance_matrix_km(point_lats, point_lons, station_lats, station_lons), self.min_distance_km)
+        weights = distances ** -self.power
+        self.weight_cache[key] = weights
+        while len(self.weight_cache) > self.max_cached:
+            self.weight_cache.popitem(last=False)
+        return weights
+
+    def interpolate(self, values, station_lats, station_lons, grid_lats, grid_lons):
+        """Grid of every time step at once.  Stations without a reading in a step are left out
+        of that step's weights
+        values: float array (time steps x stations), NaN (or a -999 placeholder) for no reading
+        returns: float array (time steps x len(grid_lats) x len(grid_lons)), NaN for steps
+        with no readings"""
+        values = mask_placeholders(values)
+        weights = self.weights(station_lats, station_lons, grid_lats, grid_lons)
+        present = ~numpy.isnan(values)
+        # Two matrix products: weighted sum of the readings, and the sum of the weights used
+        weighted = numpy.where(present, values, 0.0) @ weights.T
+        total_weight = present.astype(numpy.float64) @ weights.T
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            grid = weighted / total_weight
+        return grid.reshape(len(values), len(grid_lats), len(grid_lons))
+
+def summarize(dbw, conf, start_time, end_time, interpolator=None, grid=True):
+    """Load a slice and compute the area statistics (and grids) of every measure
+    interpolator: IdwInterpolator to reuse across calls, so its weights stay cached
+    returns: (ObservationSlice, dict of measure -> statistics, dict of measure -> grid array
+    or None, (grid lats, grid lons))"""
+    observation_slice = load_slice(dbw, conf, start_time, end_time)
+    statistics = {measure: area_statistics(observation_slice.values[measure], conf.values['area_outlier_z'])
+                  for measure in MEASURES}
+    grids = {measure: None for measure in MEASURES}
+    axes = grid_axes(conf)
+    if grid and observation_slice.station_ids:
+        if interpolator is None:
+            interpolator = IdwInterpolator(conf.values['area_idw_power'], conf.values['area_weight_cache_entries'])
+        for measure in MEASURES:
+            grids[measure] = interpolator.interpolate(observation_slice.values[measure], observation_slice.lats,
+                                                      observation_slice.lons, axes[0], axes[1])
+    return (observation_slice, statistics, grids, axes)
+
+def default_window(hours, end_time=None):
+    """(start, end) datetimes for the last 'hours' hours up to end_time (default now)"""
+    end_time = end_time or datetime.datetime.now().replace(microsecond=0)
+    return (end_time - datetime.timedelta(hours=hours), end_time)
@@ -0,0 +1,116 @@
+"""This module holds the compact observation schema.  Observation rows only keep the readings:
+the station is an integer key to the PWS row, the weather text an integer key to a small
+lookup table, and the per station constants (location, elevation, city, zip) live on the
+station row alone.  Every column is fixed width, so rows are a fraction of the size and many
+more of them fit in the buffer pool.  A view under the old observation table name joins the
+pieces back together, so readers see the same columns as before"""
+import hashlib
+import src.wu_records
+
+# Observation values in row order, as produced by Observation.row()
+OBSERVATION_COL_NAMES = list(src.wu_records.Observation.__slots__)
+# Compact table columns, in the order encode_rows produces them
+COMPACT_COL_NAMES = ['station_key', 'time', 'weather_id', 'temp_f', 'temp_c', 'relative_humidity',
+                     'uv_index', 'precip_in', 'pressure_in', 'pressure_mb']
+COMPACT_COL_DEFS = ['station_key INT NOT NULL', 'time DATETIME NOT NULL', 'weather_id SMALLINT', 'temp_f FLOAT', 'temp_c FLOAT',
+                    'relative_humidity TINYINT', 'uv_index FLOAT', 'precip_in FLOAT', 'pressure_in FLOAT', 'pressure_mb FLOAT']
+# Per station constants moved from the observation rows onto the station row
+STATION_COL_DEFS = ['elevation INT', 'zip VARCHAR(10)']
+# The weather text is as wide as the wide table's column.  TEXT cannot carry a unique key
+# everywhere, so the key is on a hash of it
+WEATHER_LOOKUP_COL_DEFS = ['name TEXT', 'name_hash CHAR(40) UNIQUE']
+
+# Positions in an observation row
+STATION_ID, TIME, WEATHER, LATITUDE, LONGITUDE, ELEVATION, CITY, ZIP = [
+    OBSERVATION_COL_NAMES.index(col_name) for col_name in ['station_id', 'time', 'weather', 'latitude', 'longitude', 'elevation', 'city', 'zip']]
+# The readings kept as they are, temp_f through pressure_mb
+READINGS = slice(OBSERVATION_COL_NAMES.index('temp_f'), OBSERVATION_COL_NAMES.index('pressure_mb') + 1)
+
+def compact_schema(dbw, conf):
+    """True once the database has moved to the compact schema, i.e. observation_table_name is
+    the compatibility view.  Looked up once per connection"""
+    if 'compact' not in dbw.schema_info:
+        dbw.schema_info['compact'] = dbw.view_exists(conf.values['observation_table_name'])
+    return dbw.schema_info['compact']
+
+def observation_base_table(dbw, conf):
+    """Table the observations are stored in, for writes, deletes and partition maintenance.
+    Reads can keep going through observation_table_name either way"""
+    if compact_schema(dbw, conf):
+        return conf.values['compact_observation_table_name']
+    return conf.values['observation_table_name']
+
+def legacy_table_name(conf):
+    """Name the wide observation table is kept under once the compact schema takes over"""
+    return conf.values['observation_table_name'] + '_legacy'
+
+def view_select(conf):
+    """SELECT for the compatibility view, the same columns (and ids) as the wide table"""
+    readings = ', '.join(str('o.{0} AS {0}').format(col_name) for col_name in OBSERVATION_COL_NAMES[READINGS])
+    return str('SELECT o.id AS id, p.id AS station_id, o.time AS time, w.name AS weather, {0}, '
+               'p.latitude AS latitude, p.longitude AS longitude, p.elevation AS elevation, p.city AS city, p.zip AS zip '
+               'FROM {1} o JOIN {2} p ON p.autoid = o.station_key LEFT JOIN {3} w ON w.id = o.weather_id').format(
+                   readings, conf.values['compact_observation_table_name'], conf.values['pws_table_name'],
+                   conf.values['weather_lookup_table_name'])
+
+def station_keys(dbw, conf, rows):
+    """PWS autoid of each station in the observation rows.  Stations the PWS table does not
+    have yet are added, and changed elevation or zip values are written to the station row
+    returns: dict of station id to autoid"""
+    pws_table_name = conf.values['pws_table_name']
+    cache = dbw.schema_info.get('stations')
+    if cache is None or any(row[STATION_ID] not in cache for row in rows):
+        cache = dbw.schema_info['stations'] = dbw.get_rows_keyed_by_column(pws_table_name, 'id', ['autoid', 'elevation', 'zip'])
+
+    # store_pws normally runs first.  A station can only be missing when the observations
+    # come from somewhere else (a spool replay, a migration of rows without a foreign key)
+    missing = {row[STATION_ID]: (row[STATION_ID], row[LATITUDE], row[LONGITUDE], row[CITY], '')
+               for row in rows if row[STATION_ID] not in cache}
+    if missing:
+        dbw.add_rows_to_table(pws_table_name, ['id', 'latitude', 'longitude', 'city', 'neighborhood'], list(missing.values()),
+                              ignore_duplicates=True)
+        cache = dbw.schema_info['stations'] = dbw.get_rows_keyed_by_column(pws_table_name, 'id', ['autoid', 'elevation', 'zip'])
+
+    changed = {}
+    for row in rows:
+        if cache[row[STATION_ID]][1:] != (row[ELEVATION], row[ZIP]):
+            changed[row[STATION_ID]] = (row[STATION_ID], row[ELEVATION], row[ZIP])
+    if changed:
+        dbw.upsert_rows_in_table(pws_table_name, ['id', 'elevation', 'zip'], list(changed.values()), ['elevation', 'zip'], key_names=['id'])
+        for station_id, elevation, zip_code in changed.values():
+            cache[station_id] = (cache[station_id][0], elevation, zip_code)
+    return {station_id: values[0] for station_id, values in cache.items()}
+
+def weather_hash(name):
+    """Unique key of a weather text in the lookup table"""
+    return hashlib.sha1(name.encode('utf-8')).hexdigest()
+
+def weather_ids(dbw, conf, names):
+    """Lookup id of each weather text, adding the ones not seen before
+    returns: dict of weather text to id"""
+    lookup_table_name = conf.values['weather_lookup_table_name']
+    cache = dbw.schema_info.get('weather')
+    if cache is None or any(name not in cache for name in names):
+        cache = dbw.schema_info['weather'] = {name: values[0] for name, values in
+                                              dbw.get_rows_keyed_by_column(lookup_table_name, 'name', ['id']).items()}
+    new_names = sorted(set(name for name in names if name not in cache))
+    if new_names:
+        dbw.add_rows_to_table(lookup_table_name, ['name', 'name_hash'], [(name, weather_hash(name)) for name in new_names],
+                              ignore_duplicates=True)
+        cache = dbw.schema_info['weather'] = {name: values[0] for name, values in
+                                              dbw.get_rows_keyed_by_column(lookup_table_name, 'name', ['id']).items()}
+    return cache
+
+def encode_rows(dbw, conf, rows, with_ids=False):
+    """Observation rows (OBSERVATION_COL_NAMES order) as compact rows (COMPACT_COL_NAMES
+    order).  Nothing is committed here
+    with_ids: True if each row starts with its id, which is then kept at the front"""
+    offset = 1 if with_ids else 0
+    observation_rows = [row[offset:] for row in rows] if with_ids else rows
+    keys = station_keys(dbw, conf, observation_rows)
+    weather = weather_ids(dbw, conf, [row[WEATHER] for row in observation_rows if row[WEATHER] is not None])
+    encoded = []
+    for row, observation_row in zip(rows, observation_rows):
+        compact_row = (keys[observation_row[STATION_ID]], observation_row[TIME], weather.get(observation_row[WEATHER])) + tuple(observation_row[READINGS])
+        encoded.append(row[:offset] + compact_row)
+    return encoded
@@ -0,0 +1,77 @@
+"""This module moves an existing wide observation table to the compact schema (see
+src/weather_compact.py) while the other scripts keep storing observations.  Rows are copied
+a batch per transaction, keeping their ids so the rollup and export watermarks stay valid.
+Once the copy has caught up, the wide table is renamed out of the way, the last rows stored
+in the meantime are copied, and the compatibility view takes its name"""
+import time
+import src.weather_compact
+import src.weather_store
+import src.weather_watermark
+
+WATERMARK_NAME = 'compact_migration'
+
+def copy_batch(dbw, conf, source_table_name):
+    """Copy the next batch of rows past the migration watermark into the compact table, in
+    one transaction with the watermark move
+    returns: number of rows copied"""
+    last_id = src.weather_watermark.get_watermark(dbw, conf, WATERMARK_NAME)
+    rows = dbw.get_rows_after_key(source_table_name, 'id', last_id, ['id'] + src.weather_store.OBSERVATION_COL_NAMES,
+                                  conf.values['migration_batch_size'])
+    if not rows:
+        return 0
+    dbw.add_rows_to_table(conf.values['compact_observation_table_name'], ['id'] + src.weather_compact.COMPACT_COL_NAMES,
+                          src.weather_compact.encode_rows(dbw, conf, rows, with_ids=True), conf.values['insert_batch_size'],
+                          ignore_duplicates=True)
+    src.weather_watermark.set_watermark(dbw, conf, WATERMARK_NAME, rows[-1][0])
+    dbw.commit()
+    return len(rows)
+
+def copy_until_caught_up(dbw, conf, source_table_name):
+    """Copy batches, pausing migration_pause_s between them so ingest gets the tables,
+    until a batch comes back short
+    returns: number of rows copied"""
+    total = 0
+    while True:
+        copied = copy_batch(dbw, conf, source_table_name)
+        total += copied
+        if copied:
+            print(str('COPIED {0} OBSERVATIONS').format(total))
+        if copied < conf.values['migration_batch_size']:
+            return total
+        time.sleep(conf.values['migration_pause_s'])
+
+def migrate_to_compact(dbw, conf):
+    """Move the observation table to the compact schema.  Safe to stop and run again, it
+    carries on from its watermark.  Writers still on the wide table fail their inserts from
+    the rename on, look the schema up again and retry (see insert_observation_rows).  What
+    fails again, while there is no observation table or view at all, the store pipeline
+    spools"""
+    table_name = conf.values['observation_table_name']
+    if src.weather_compact.compact_schema(dbw, conf):
+        print('THE OBSERVATIONS ARE ALREADY COMPACT')
+        return
+
+    legacy_table_name = src.weather_compact.legacy_table_name(conf)
+    if dbw.table_exists(table_name):
+        src.weather_store.setup_compact_tables(dbw, conf)
+        dbw.commit()
+        print('COPYING THE OBSERVATIONS TO THE COMPACT TABLE')
+        copy_until_caught_up(dbw, conf, table_name)
+
+        # Inserts by table name fail from here until the view exists.  Rows committed before
+        # the rename are picked up by the last copy below
+        print(str('RENAMING {0} TO {1}').format(table_name, legacy_table_name))
+        dbw.rename_table(table_name, legacy_table_name)
+    elif not dbw.table_exists(legacy_table_name):
+        print(str('NO {0} TABLE TO MIGRATE').format(table_name))
+        return
+
+    # Also where a run cut short after the rename carries on.  The view goes last, writers
+    # only switch to the compact table once it exists, so their new ids cannot collide
+    # with the rows still being copied
+    copy_until_caught_up(dbw, conf, legacy_table_name)
+    dbw.create_view(table_name, src.weather_compact.view_select(conf))
+    dbw.commit()
+    dbw.schema_info.clear()
+    print(str('DONE.  {0} IS NOW A VIEW OVER {1}, DROP {2} ONCE YOU ARE HAPPY WITH THE RESULT').format(
+        table_name, conf.values['compact_observation_table_name'], legacy_table_name))
@@ -9,32 +9,65 @@ class WeatherConfig():
         self.values = {}
         
         # SERVER VALUES
-        # False will attempt to use a previously saved local response
+        # False will replay previously cached responses instead of calling the server
         self.values['use_live_server'] = True
-        # Saves the last response from the server
+        # Saves each response from the server into the response cache
         self.values['save_live_response'] = True
-        # Base URL for querying nearby PWS - placeholder is for API KEY
-        self.values['endpoint_url_format'] = 'http://api.wunderground.com/api/{0}/geolookup/q/'
-        # Base URL for querying conditions at a given PWS - placeholder is for API KEY
-        self.values['endpoint_stationid_format'] = 'http://api.wunderground.com/api/{0}/conditions/q/'
+        # Folder holding the cached responses, keyed by query URL
+        self.values['response_cache_dir'] = 'response_cache'
+        # How long (seconds) a cached response is served instead of calling the server.
+        # The station list barely changes, the conditions change every few minutes
+        self.values['response_cache_ttl'] = {'geolookup': 24 * 60 * 60, 'conditions': 5 * 60}
+        # Total size of the cache before least recently used responses are evicted
+        self.values['response_cache_max_bytes'] = 32 * 1024 * 1024
+        # Answer the nearby PWS search from a local index of every station seen so far
+        self.values['use_station_index'] = True
+        # File holding the station index
+        self.values['station_index_path'] = 'station_index.json'
+        # How long (seconds) the stations around a location are trusted before the
+        # geolookup is run again
+        self.values['station_index_ttl'] = 7 * 24 * 60 * 60
+        # Server to query.  Point this at src/wu_simulator.py (e.g. 'http://localhost:8080')
+        # for load testing without network access or API quota
+        self.values['endpoint_host'] = 'http://api.wunderground.com'
         # API_KEY is defined in .gitignored module
         self.values['api_key'] = API_KEY
-        # Add the API_KEY
-        self.values['endpoint_url_base'] = self.values['endpoint_url_format'].format(self.values['api_key'])
         # LAT/LON to search for PWS - could replace with ZIP or other accepted formats
         # see https://www.wunderground.com/weather/api/
         self.values['lat_lon'] = '37.392089,-122.083347'
-        # Final GEOLOOKUP URL with json extension
-        self.values['endpoint_url'] = self.values['endpoint_url_base'] + self.values['lat_lon'] + '.json'
-        # Final CONDITIONS URL with json extension
-        self.values['endpoint_url_stationid'] = self.values['endpoint_stationid_format'].format(self.values['api_key']) + 'pws:{0}.json'
+        # Extra 'lat,lon' locations to cover with weather_collector.py (lat_lon is always included)
+        self.values['extra_locations'] = []
+        # Optional bounding box covered by a grid of locations for weather_collector.py, e.g.
+        # {'south': 37.30, 'west': -122.15, 'north': 37.45, 'east': -121.95, 'step_km': 5}
+        self.values['location_grid'] = None
+        # The query URLs are built from the values above
+        self.build_endpoint_urls()
+
+        # DIAGNOSTIC VALUES
+        # Python logging level.  'DEBUG' echoes REST queries and SQL statements
+        self.values['log_level'] = 'INFO'
+        # Only echo every Nth query/statement at DEBUG, the echo itself is costly under load
+        self.values['debug_log_sample_every'] = 1
+        # Count and time REST calls, SQL statements, commits and parses
+        self.values['metrics_enabled'] = False
+        # JSON snapshot of the metrics written at the end of a run (None for no file)
+        self.values['metrics_json_path'] = None
+        # Serve /metrics (Prometheus text) and /metrics.json on this local port (None for off)
+        self.values['metrics_port'] = None
 
         # DATABASE VALUES
         # Only useful for debug or schema changes, otherwise the tables should remain untouched
         self.values['drop_all_tables'] = False
         # Flag to control dumping contents of database
         self.values['print_db'] = True
+        # Rows fetched per round trip when streaming the database dump
+        self.values['report_chunk_size'] = 1000
 
+        # Where the data is kept: 'mysql' (server login in mysql_user_info.py) or 'sqlite'
+        # (a local WAL mode file, no server needed)
+        self.values['storage_backend'] = 'mysql'
+        # File for the sqlite backend, None for database_name + '.sqlite3' in the working folder
+        self.values['sqlite_path'] = None
         # Database name (can change for testing to preserve old data)
         self.values['database_name'] = 'wu_weather_nearby_mountainview_ca'
         #self.values['database_name'] = 'wu_weather_nearby_test'
@@ -42,6 +75,108 @@ class WeatherConfig():
         self.values['pws_table_name'] = 'pws_nearby'
         # TABLE name for OBSERVATION data
         self.values['observation_table_name'] = 'weather_nearby'
+        # Number of rows sent per multi-row INSERT.  The whole run is still one commit
+        self.values['insert_batch_size'] = 500
+        # Maximum connections held by the pool for concurrent store workers
+        self.values['db_pool_size'] = 4
+        # Store observations compactly (see src/weather_compact.py): readings only, with the
+        # weather text and the station as integer keys.  observation_table_name becomes a view
+        # with the old columns.  A new database starts out compact, an existing one is moved
+        # over by weather_migrate_compact.py
+        self.values['compact_observations'] = False
+        self.values['compact_observation_table_name'] = 'weather_obs'
+        self.values['weather_lookup_table_name'] = 'weather_text'
+        # Rows copied per transaction by weather_migrate_compact.py, and the pause (seconds)
+        # between transactions so inserts are not held up
+        self.values['migration_batch_size'] = 5000
+        self.values['migration_pause_s'] = 0.1
+        # TABLE name for the incremental jobs' progress (rollups, exports)
+        self.values['watermark_table_name'] = 'job_watermark'
+        # Hourly and daily per-station rollups (see src/weather_rollup.py).  With
+        # rollup_on_insert the rollups are brought up to date after every observation
+        # insert, otherwise run weather_rollup_catchup.py on a schedule
+        self.values['rollup_enabled'] = True
+        self.values['rollup_on_insert'] = True
+        self.values['rollup_hourly_table_name'] = 'weather_hourly'
+        self.values['rollup_daily_table_name'] = 'weather_daily'
+        # Observations folded in per transaction by the catch-up
+        self.values['rollup_batch_size'] = 5000
+        # Only observations stored at least this many seconds ago are folded in, so inserts
+        # still committing (they can hold lower ids than the newest row) are not skipped.
+        # Keep it above the longest observation insert.  0 folds everything straight away,
+        # which is only safe with a single writer
+        self.values['rollup_lag_s'] = 10
+        # Range partition the OBSERVATION table by month on time (MySQL only).  Partitioned
+        # tables cannot have foreign keys, so the station reference is not enforced then
+        self.values['observation_partitioning'] = False
+        # Months of partitions kept ready past the current one
+        self.values['partition_months_ahead'] = 3
+        # Months of observations kept by weather_retention.py (None keeps everything).  The
+        # rollups are not expired
+        self.values['retention_months'] = None
+        # Swap expired partitions into <table>_pYYYYMM archive tables instead of dropping them
+        self.values['retention_archive'] = False
+        # Without partitioning old rows are deleted this many per transaction, pausing
+        # purge_pause_s seconds between transactions so inserts are not held up
+        self.values['purge_chunk_size'] = 1000
+        self.values['purge_pause_s'] = 0.1
+
+        # STORE PIPELINE VALUES (weather_collector.py and weather_daemon.py)
+        # Fetch and store side by side through a bounded queue (see src/wu_pipeline.py)
+        # instead of fetching everything, then storing it
+        self.values['use_store_pipeline'] = True
+        # Observations the queue holds before the fetch workers wait for the store worker
+        self.values['pipeline_queue_size'] = 1000
+        # Observations stored per transaction, and the longest wait (seconds) to fill a batch
+        self.values['pipeline_batch_size'] = 200
+        self.values['pipeline_batch_wait_s'] = 1.0
+        # Fraction of the queue that counts as falling behind: batches are spooled instead
+        # of stored until the queue drains below it
+        self.values['pipeline_high_water'] = 0.75
+        # Seconds between reconnect attempts while the database is down
+        self.values['pipeline_retry_s'] = 30
+        # Folder for the spool files holding observations not stored yet
+        self.values['spool_dir'] = 'spool'
+
+        # QUERY VALUES (src/weather_query.py)
+        # Answers kept in the read side cache, and for how long (seconds).  Observations stored
+        # in the same process refresh it straight away, the TTL covers other writers
+        self.values['query_cache_entries'] = 4096
+        self.values['query_cache_ttl_s'] = 60
+        # Most readings a history query returns
+        self.values['query_history_limit'] = 1000
+        # Serve the queries as JSON on this local port from weather_daemon.py (None for off).
+        # weather_query_server.py serves them on its own
+        self.values['query_port'] = None
+
+        # AREA VALUES (src/weather_area.py, needs numpy)
+        # Readings are lined up in time steps of this many minutes, a station's last reading
+        # in a step stands for the step
+        self.values['area_step_minutes'] = 10
+        # Readings further than this many scaled median absolute deviations from the area
+        # median are left out of the robust mean (the mean absolute deviation stands in when
+        # the median one is 0)
+        self.values['area_outlier_z'] = 3.5
+        # Interpolation grid: points per side, and km from lat_lon to its edges (None for
+        # pws_max_distance_km)
+        self.values['area_grid_size'] = 25
+        self.values['area_radius_km'] = None
+        # Inverse distance weighting power, and how many station sets' weights to keep
+        self.values['area_idw_power'] = 2.0
+        self.values['area_weight_cache_entries'] = 32
+
+        # EXPORT VALUES (weather_export.py)
+        # Folder the export files are written to
+        self.values['export_dir'] = 'export'
+        # 'parquet' or 'arrow' (need pyarrow), 'csv.zst' (needs zstandard) or 'csv.gz'.  A
+        # format whose library is missing falls back to the next one in that list
+        self.values['export_format'] = 'parquet'
+        # Rows read from the database and written to the file at a time
+        self.values['export_chunk_size'] = 10000
+        # Seconds an incremental export waits before reading, so inserts already under way
+        # when it starts (they can hold lower ids than the newest row) commit first.  Keep it
+        # above the longest observation insert
+        self.values['export_lag_s'] = 10
 
         # MISC VALUES
         # Maximum distance in km to search for PWS
@@ -50,3 +185,53 @@ class WeatherConfig():
         # It's free, but has limits on calls per min and per day.  We could easily go over
         # that without some limits
         self.values['pws_max_extract'] = 2
+        # API quotas for the key in use (developer key is 10/min and 500/day)
+        self.values['api_calls_per_minute'] = 10
+        self.values['api_calls_per_day'] = 500
+        # Query the stations' conditions in parallel.  The quotas above still apply, so
+        # the run time is bound by the quota rather than by each round trip
+        self.values['use_concurrent_fetch'] = True
+        # Maximum number of conditions requests in flight at once
+        self.values['fetch_max_workers'] = 4
+        # HTTP client for the live calls.  Connect and read timeouts (seconds) per attempt
+        self.values['http_connect_timeout_s'] = 3.05
+        self.values['http_read_timeout_s'] = 10
+        # Retries after a timeout, dropped connection or 5xx, with jittered exponential
+        # backoff.  Other 4xx (rate limiting included) are never retried.  Each retry uses
+        # quota.  No retry starts unless it can finish within http_deadline_s of the first try
+        self.values['http_max_retries'] = 2
+        self.values['http_backoff_base_s'] = 0.5
+        self.values['http_backoff_max_s'] = 8
+        self.values['http_deadline_s'] = 30
+        # Send a second request for a straggler that has not answered after this many seconds,
+        # first answer wins (None for off).  Hedges only go out when there is quota to spare
+        self.values['http_hedge_after_s'] = None
+        # Keep-alive connections kept open to the server
+        self.values['http_pool_size'] = 8
+        # Worker processes weather_collector.py splits the fetch/store work across.  They share
+        # one quota limiter, starting from what the geolookups left
+        self.values['collector_processes'] = 2
+
+        # POLLER DAEMON VALUES (weather_daemon.py)
+        # Starting interval (seconds) between conditions queries for each station
+        self.values['poll_interval_s'] = 10 * 60
+        # Bounds for the adaptive interval.  Stations that report often are polled down
+        # to the minimum, stale stations back off to the maximum
+        self.values['poll_min_interval_s'] = 2 * 60
+        self.values['poll_max_interval_s'] = 2 * 60 * 60
+        # Factor the interval shrinks by on a new reading and grows by on a stale one
+        self.values['poll_backoff_factor'] = 2.0
+
+    def build_endpoint_urls(self):
+        """(Re)build the query URLs from endpoint_host, api_key and lat_lon.  Call again after
+        changing any of those"""
+        # Base URL for querying nearby PWS - placeholder is for API KEY
+        self.values['endpoint_url_format'] = self.values['endpoint_host'] + '/api/{0}/geolookup/q/'
+        # Base URL for querying conditions at a given PWS - placeholder is for API KEY
+        self.values['endpoint_stationid_format'] = self.values['endpoint_host'] + '/api/{0}/conditions/q/'
+        # Add the API_KEY
+        self.values['endpoint_url_base'] = self.values['endpoint_url_format'].format(self.values['api_key'])
+        # Final GEOLOOKUP URL with json extension
+        self.values['endpoint_url'] = self.values['endpoint_url_base'] + self.values['lat_lon'] + '.json'
+        # Final CONDITIONS URL with json extension
+        self.values['endpoint_url_stationid'] = self.values['endpoint_stationid_format'].format(self.values['api_key']) + 'pws:{0}.json'
@@ -0,0 +1,226 @@
+"""This module exports the PWS and OBSERVATION tables to files for analytics: Parquet or
+Arrow IPC (with pyarrow), or CSV compressed with zstd (with zstandard) or gzip.  Rows are
+streamed from the database a chunk at a time and written as they arrive, so memory use is
+bound by export_chunk_size whatever the size of the tables.  Observations can be exported
+incrementally, each run only writing the rows stored since the last one"""
+import csv
+import datetime
+import gzip
+import io
+import os
+import time
+import src.weather_store
+import src.weather_watermark
+
+# Format -> file extension
+EXPORT_FORMATS = {'parquet': '.parquet', 'arrow': '.arrow', 'csv.zst': '.csv.zst', 'csv.gz': '.csv.gz'}
+
+# Column types per table, for the columnar formats.  The PWS id is the station id text,
+# the observation id is the autokey
+PWS_COLUMN_TYPES = {'id': 'str', 'latitude': 'float', 'longitude': 'float', 'city': 'str', 'neighborhood': 'str'}
+OBSERVATION_COLUMN_TYPES = {'id': 'int', 'station_id': 'str', 'time': 'datetime', 'weather': 'str', 'temp_f': 'float',
+                            'temp_c': 'float', 'relative_humidity': 'int', 'uv_index': 'float', 'precip_in': 'float',
+                            'pressure_in': 'float', 'pressure_mb': 'float', 'latitude': 'float', 'longitude': 'float',
+                            'elevation': 'int', 'city': 'str', 'zip': 'str'}
+
+# Observations carry their id, so incremental files can be lined up and deduplicated
+EXPORT_OBSERVATION_COL_NAMES = ['id'] + src.weather_store.OBSERVATION_COL_NAMES
+
+WATERMARK_NAME = 'observation_export'
+
+def available_format(export_format):
+    """export_format if its library is installed, otherwise the nearest one that is.  The
+    columnar formats fall back to zstd CSV, zstd CSV falls back to gzip CSV"""
+    if export_format in ('parquet', 'arrow'):
+        try:
+            import pyarrow
+            return export_format
+        except ImportError:
+            print(str('pyarrow IS NOT INSTALLED, EXPORTING CSV INSTEAD OF {0}').format(export_format.upper()))
+            export_format = 'csv.zst'
+    if export_format == 'csv.zst':
+        try:
+            import zstandard
+            return export_format
+        except ImportError:
+            print('zstandard IS NOT INSTALLED, USING GZIP')
+            export_format = 'csv.gz'
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(str('Unknown export format {0}').format(export_format))
+    return export_format
+
+class ExportWriter():
+    """Writes rows to a file a chunk at a time.  The file is written under a temporary name
+    and renamed into place by close(), so a reader never sees a half written export"""
+
+    def __init__(self, path, col_names):
+        """Initialize the writer
+        path: final file name
+        col_names: list of column ids, in row order"""
+        self.path = path
+        self.temp_path = path + '.tmp'
+        self.col_names = col_names
+        self.rows_written = 0
+
+    def write_chunk(self, rows):
+        """Write a list of row tuples"""
+        raise NotImplementedError
+
+    def finish(self):
+        """Flush and close the temporary file"""
+        raise NotImplementedError
+
+    def close(self):
+        """Finish the file and move it into place"""
+        self.finish()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self):
+        """Give up on the file, removing what was written"""
+        try:
+            self.finish()
+        finally:
+            if os.path.exists(self.temp_path):
+                os.remove(self.temp_path)
+
+class CsvExportWriter(ExportWriter):
+    """CSV with a header row, compressed as it is written.  NULLs are empty fields"""
+
+    def __init__(self, path, col_names, compression):
+        """compression: 'zstd' or 'gzip'"""
+        ExportWriter.__init__(self, path, col_names)
+        if compression == 'zstd':
+            import zstandard
+            self.raw_file = open(self.temp_path, 'wb')
+            self.compressed = zstandard.ZstdCompressor().stream_writer(self.raw_file)
+            self.text = io.TextIOWrapper(self.compressed, encoding='utf-8', newline='')
+        else:
+            self.raw_file = None
+            self.text = gzip.open(self.temp_path, 'wt', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(col_names)
+
+    def write_chunk(self, rows):
+        self.writer.writerows(rows)
+        self.rows_written += len(rows)
+
+    def finish(self):
+        # Closing the text layer closes the compressor, and gzip its own file
+        if not self.text.closed:
+            self.text.close()
+        if self.raw_file is not None and not self.raw_file.closed:
+            self.raw_file.close()
+
+class ArrowExportWriter(ExportWriter):
+    """Parquet (one row group per chunk) or Arrow IPC file (one record batch per chunk)"""
+
+    def __init__(self, path, col_names, export_format, col_types):
+        """export_format: 'parquet' or 'arrow'
+        col_types: dict of column id to 'int', 'float', 'str' or 'datetime' (e.g. PWS_COLUMN_TYPES)"""
+        ExportWriter.__init__(self, path, col_names)
+        self.col_types = col_types
+        import pyarrow
+        self.pyarrow = pyarrow
+        arrow_types = {'int': pyarrow.int64(), 'float': pyarrow.float64(), 'str': pyarrow.string(),
+                       'datetime': pyarrow.timestamp('s')}
+        self.schema = pyarrow.schema([(col_name, arrow_types[col_types[col_name]]) for col_name in col_names])
+        if export_format == 'parquet':
+            import pyarrow.parquet
+            self.writer = pyarrow.parquet.ParquetWriter(self.temp_path, self.schema, compression='zstd')
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(self.temp_path, self.schema)
+        self.closed = False
+
+    def write_chunk(self, rows):
+        columns = list(zip(*rows))
+        arrays = []
+        for index, col_name in enumerate(self.col_names):
+            values = columns[index]
+            # DATETIME columns come back as datetime from MySQL and as text from SQLite
+            if self.col_types[col_name] == 'datetime' and any(isinstance(value, str) for value in values):
+                values = [None if value is None else datetime.datetime.fromisoformat(value) for value in values]
+            arrays.append(self.pyarrow.array(values, type=self.schema.field(index).type))
+        self.writer.write_batch(self.pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.rows_written += len(rows)
+
+    def finish(self):
+        if not self.closed:
+            self.writer.close()
+            self.closed = True
+
+def make_writer(path, col_names, export_format, col_types):
+    """Writer for the format (see EXPORT_FORMATS).  col_types is only used by the columnar formats"""
+    if export_format in ('parquet', 'arrow'):
+        return ArrowExportWriter(path, col_names, export_format, col_types)
+    return CsvExportWriter(path, col_names, 'zstd' if export_format == 'csv.zst' else 'gzip')
+
+def export_table(dbw, conf, table_name, col_names, col_types, order_by, path, export_format, key_range=None):
+    """Stream the table (or the key_range of it, see stream_chunks) into a new file
+    col_types: the table's column types (PWS_COLUMN_TYPES or OBSERVATION_COLUMN_TYPES)
+    returns: number of rows written"""
+    writer = make_writer(path, col_names, export_format, col_types)
+    try:
+        for rows in dbw.stream_chunks(table_name, col_names, order_by, conf.values['export_chunk_size'], key_range):
+            writer.write_chunk(rows)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close()
+    return writer.rows_written
+
+def export_pws(dbw, conf, export_format):
+    """Write the whole PWS table (it is small) to <export_dir>/<pws table><ext>
+    export_format: one of EXPORT_FORMATS with its library installed (see available_format)"""
+    path = os.path.join(conf.values['export_dir'], conf.values['pws_table_name'] + EXPORT_FORMATS[export_format])
+    count = export_table(dbw, conf, conf.values['pws_table_name'], src.weather_store.PWS_COL_NAMES, PWS_COLUMN_TYPES, ['id'], path,
+                         export_format)
+    print(str('EXPORTED {0} PWS TO {1}').format(count, path))
+    return path
+
+def export_observations(dbw, conf, export_format, full=False):
+    """Write the observations stored since the last export to
+    <export_dir>/<observation table>_from_<first id><ext>, then move the export watermark.
+    A run cut short before the watermark moves is repeated next time under the same file
+    name, so no rows end up in two files.  The export covers the ids up to MAX(id) when it
+    starts, after waiting export_lag_s for inserts still in flight below that id to commit
+    full: export every observation to <observation table>_full<ext>, leaving the watermark
+    returns: path of the file written, None if there was nothing new"""
+    table_name = conf.values['observation_table_name']
+    after_id = 0 if full else src.weather_watermark.get_watermark(dbw, conf, WATERMARK_NAME)
+
+    # Fix the upper end now, rows stored while the export runs go in the next one
+    dbw.execute(str('SELECT MAX(id) FROM {0}').format(table_name))
+    through_id = dbw.cursor.fetchone()[0]
+    if through_id is None or through_id <= after_id:
+        print('NO NEW OBSERVATIONS TO EXPORT')
+        return None
+
+    if not full:
+        # With several writers (e.g. the collector's worker processes) an insert that is not
+        # committed yet can hold an id below MAX(id).  Once the watermark moves past it the
+        # row would never be exported, so give such inserts time to commit, then end this
+        # read transaction so the export sees them
+        time.sleep(conf.values['export_lag_s'])
+        dbw.commit()
+
+    name = str('{0}_full').format(table_name) if full else str('{0}_from_{1:012d}').format(table_name, after_id + 1)
+    path = os.path.join(conf.values['export_dir'], name + EXPORT_FORMATS[export_format])
+    count = export_table(dbw, conf, table_name, EXPORT_OBSERVATION_COL_NAMES, OBSERVATION_COLUMN_TYPES, ['id'], path, export_format,
+                         ('id', after_id, through_id))
+    if not full:
+        src.weather_watermark.set_watermark(dbw, conf, WATERMARK_NAME, through_id)
+        dbw.commit()
+    print(str('EXPORTED {0} OBSERVATIONS TO {1}').format(count, path))
+    return path
+
+def export_all(dbw, conf, export_format=None, full=False):
+    """Export the PWS table and the new (or all) observations
+    returns: list of the files written"""
+    export_format = available_format(conf.values['export_format'] if export_format is None else export_format)
+    os.makedirs(conf.values['export_dir'], exist_ok=True)
+    paths = [export_pws(dbw, conf, export_format)]
+    observations_path = export_observations(dbw, conf, export_format, full)
+    if observations_path is not None:
+        paths.append(observations_path)
+    return paths
@@ -0,0 +1,196 @@
+"""This module answers read queries over the stored observations: the latest reading of a
+station, a station's history over a time range, and the stations nearest a point with their
+current conditions.  Answers are kept in an LRU cache with a time to live.  Observations
+stored by this process update the latest readings in place and drop the cached histories
+they touch, so frequent current conditions lookups are answered without a query.  serve()
+puts the queries behind a small local HTTP/JSON endpoint for dashboards"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+import src.weather_store
+import src.wu_metrics
+import src.wu_station_index
+
+class LruTtlCache():
+    """Thread safe cache holding up to max_entries values for ttl seconds each, evicting the
+    least recently used first"""
+
+    def __init__(self, max_entries, ttl):
+        """Initialize an empty cache"""
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # key -> (expires, value), least recently used first
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        """The cached value, None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        """Cache value under key for ttl seconds"""
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard_where(self, matches):
+        """Drop every entry whose key matches(key)"""
+        with self.lock:
+            for key in [key for key in self.entries if matches(key)]:
+                del self.entries[key]
+
+def reading_dict(col_names, row):
+    """Row as a dict, times as 'YYYY-MM-DD HH:MM:SS' text whichever backend they came from"""
+    reading = dict(zip(col_names, row))
+    if reading.get('time') is not None:
+        reading['time'] = str(reading['time'])
+    return reading
+
+class WeatherQueries():
+    """Cached read queries over the observation table (or the compact schema's view)"""
+
+    def __init__(self, conf, pool):
+        """Initialize the queries and start listening to this process's inserts
+        conf: WeatherConfig
+        pool: src.wu_storage.WeatherConnectionPool the queries run on"""
+        self.conf = conf
+        self.pool = pool
+        self.table_name = conf.values['observation_table_name']
+        self.col_names = src.weather_store.OBSERVATION_COL_NAMES
+        self.cache = LruTtlCache(conf.values['query_cache_entries'], conf.values['query_cache_ttl_s'])
+        self.history_limit = conf.values['query_history_limit']
+        src.weather_store.add_observation_listener(self.observations_stored)
+
+    def observations_stored(self, observation_rows):
+        """Insert listener: move each station's cached latest reading forward, and drop its
+        cached histories, which may now be missing a row"""
+        latest = {}
+        for row in observation_rows:
+            reading = reading_dict(self.col_names, row)
+            if reading['station_id'] not in latest or reading['time'] > latest[reading['station_id']]['time']:
+                latest[reading['station_id']] = reading
+        for station_id, reading in latest.items():
+            cached = self.cache.get(('latest', station_id))
+            if cached is None or reading['time'] >= cached['time']:
+                self.cache.put(('latest', station_id), reading)
+        self.cache.discard_where(lambda key: key[0] == 'history' and key[1] in latest)
+
+    def latest(self, station_id):
+        """Most recent reading of the station as a dict, None if it has none"""
+        reading = self.cache.get(('latest', station_id))
+        if reading is not None:
+            src.wu_metrics.METRICS.increment('query_cache_hits')
+            return reading
+
+        start = src.wu_metrics.METRICS.start()
+        with self.pool.read_connection() as dbw:
+            row = dbw.get_last_row_by_column(self.table_name, 'station_id', station_id, 'time', self.col_names)
+        src.wu_metrics.METRICS.observe('query_latest', start)
+        if row is None:
+            return None
+        reading = reading_dict(self.col_names, row)
+        self.cache.put(('latest', station_id), reading)
+        return reading
+
+    def history(self, station_id, start_time, end_time, limit=None):
+        """Readings of the station with start_time <= time < end_time, oldest first
+        start_time, end_time: 'YYYY-MM-DD HH:MM:SS' (or shorter, e.g. '2017-07-16') text
+        limit: most readings returned (default query_history_limit)"""
+        limit = self.history_limit if limit is None else min(limit, self.history_limit)
+        key = ('history', station_id, start_time, end_time, limit)
+        readings = self.cache.get(key)
+        if readings is not None:
+            src.wu_metrics.METRICS.increment('query_cache_hits')
+            return readings
+
+        start = src.wu_metrics.METRICS.start()
+        with self.pool.read_connection() as dbw:
+            rows = dbw.get_rows_in_range(self.table_name, 'station_id', station_id, 'time', start_time, end_time, self.col_names, limit)
+        src.wu_metrics.METRICS.observe('query_history', start)
+        readings = [reading_dict(self.col_names, row) for row in rows]
+        self.cache.put(key, readings)
+        return readings
+
+    def stations(self):
+        """Every stored station as (id, lat, lon), cached like the readings"""
+        stations = self.cache.get(('stations',))
+        if stations is None:
+            with self.pool.read_connection() as dbw:
+                known_pws = src.weather_store.load_known_pws(dbw, self.conf)
+            stations = [(station_id, cols[0], cols[1]) for station_id, cols in known_pws.items()
+                        if cols[0] is not None and cols[1] is not None]
+            self.cache.put(('stations',), stations)
+        return stations
+
+    def nearest(self, lat, lon, count=5, radius_km=None):
+        """The count stations nearest the point (within radius_km if given), closest first,
+        each with its distance and latest reading
+        returns: list of {'station_id', 'distance_km', 'latest'}"""
+        by_distance = sorted((src.wu_station_index.distance_km(lat, lon, station_lat, station_lon), station_id)
+                             for station_id, station_lat, station_lon in self.stations())
+        if radius_km is not None:
+            by_distance = [(km, station_id) for km, station_id in by_distance if km <= radius_km]
+        return [{'station_id': station_id, 'distance_km': round(km, 3), 'latest': self.latest(station_id)}
+                for km, station_id in by_distance[:count]]
+
+    def answer(self, path, params):
+        """Answer one endpoint request
+        path: '/latest', '/history' or '/nearest'
+        params: dict of query parameter lists, as from parse_qs
+        returns: (HTTP status, JSON-able body)"""
+        # A missing required parameter raises KeyError, the handler turns that into a 400
+        def optional(name, cast, default=None):
+            return cast(params[name][0]) if name in params else default
+
+        if path == '/latest':
+            reading = self.latest(params['station'][0])
+            return (200, reading) if reading is not None else (404, {'error': 'no readings for this station'})
+        if path == '/history':
+            return (200, self.history(params['station'][0], params['start'][0], params['end'][0], optional('limit', int)))
+        if path == '/nearest':
+            return (200, self.nearest(float(params['lat'][0]), float(params['lon'][0]), optional('count', int, 5),
+                                      optional('radius_km', float)))
+        return (404, {'error': 'unknown query'})
+
+    def serve(self, port):
+        """Serve the queries as JSON on localhost:port from daemon threads
+            /latest?station=KCAMOUNT1
+            /history?station=KCAMOUNT1&start=2017-07-16&end=2017-07-17[&limit=100]
+            /nearest?lat=37.39&lon=-122.08[&count=5][&radius_km=3]"""
+        # Only loaded when serving, like the metrics endpoint
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        queries = self
+
+        class QueryHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                try:
+                    status, body = queries.answer(url.path, parse_qs(url.query))
+                except (KeyError, TypeError, ValueError) as e:
+                    status, body = 400, {'error': str('bad query: {0}').format(e)}
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), QueryHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
@@ -0,0 +1,120 @@
+"""This module keeps the OBSERVATION table's monthly partitions ahead of the clock and
+expires old observations.  With partitioning, whole months are dropped (or swapped into
+archive tables), which is quick and leaves no fragmentation.  Without it, old rows are
+deleted a small chunk per transaction, so inserts are never held up for long"""
+import datetime
+import time
+import src.weather_compact
+import src.weather_rollup
+import src.wu_storage
+
+def partitioning_enabled(dbw, conf):
+    """True if the observation table is (or should be) partitioned with this backend"""
+    return conf.values['observation_partitioning'] and dbw.supports_partitioning
+
+def upcoming_months(conf, first=None):
+    """Month starts from first (default this month) through partition_months_ahead months out"""
+    this_month = src.wu_storage.month_start(datetime.date.today())
+    first = this_month if first is None else src.wu_storage.month_start(first)
+    months = []
+    month = first
+    while month <= src.wu_storage.add_months(this_month, conf.values['partition_months_ahead']):
+        months.append(month)
+        month = src.wu_storage.add_months(month, 1)
+    return months
+
+def oldest_observation_time(dbw, conf):
+    """time of the oldest observation, None if there are none"""
+    dbw.execute(str('SELECT MIN(time) FROM {0}').format(src.weather_compact.observation_base_table(dbw, conf)))
+    oldest = dbw.cursor.fetchone()[0]
+    if isinstance(oldest, str):
+        oldest = datetime.datetime.strptime(oldest, '%Y-%m-%d %H:%M:%S')
+    return oldest
+
+def month_partitions(dbw, table_name):
+    """(month start, partition name) of the table's monthly partitions, in order"""
+    months = []
+    for name, bound, rows in dbw.get_partitions(table_name):
+        if name not in (dbw.PARTITION_OLDEST, dbw.PARTITION_FUTURE):
+            months.append((datetime.datetime.strptime(name[1:], '%Y%m').date(), name))
+    return months
+
+def ensure_partitions(dbw, conf):
+    """Add monthly partitions up to partition_months_ahead, so new rows never pile up in the
+    catch-all future partition"""
+    table_name = src.weather_compact.observation_base_table(dbw, conf)
+    existing = month_partitions(dbw, table_name)
+    first = src.wu_storage.add_months(existing[-1][0], 1) if existing else None
+    months = upcoming_months(conf, first)
+    if months:
+        print(str('ADDING {0} MONTHLY PARTITIONS FROM {1}').format(len(months), months[0].strftime('%Y-%m')))
+        dbw.add_month_partitions(table_name, 'time', months)
+
+def retention_cutoff(conf, retention_months=None):
+    """Observations before this date are expired: the start of the month retention_months
+    before this one, so a whole number of months is always kept"""
+    if retention_months is None:
+        retention_months = conf.values['retention_months']
+    return src.wu_storage.add_months(datetime.date.today(), -retention_months)
+
+def purge_partitions(dbw, conf, cutoff, archive):
+    """Drop (or archive, then drop) every partition wholly before cutoff.  The catch-all
+    partition for rows before the first month goes with the first of them
+    returns: list of the partitions removed"""
+    table_name = src.weather_compact.observation_base_table(dbw, conf)
+    # MySQL TO_DAYS() is the proleptic ordinal plus 365
+    cutoff_days = cutoff.toordinal() + 365
+    expired = [name for name, bound, rows in dbw.get_partitions(table_name)
+               if bound != 'MAXVALUE' and int(bound) <= cutoff_days]
+    if archive:
+        for name in expired:
+            archive_table_name = str('{0}_{1}').format(table_name, name)
+            print(str('ARCHIVING PARTITION {0} TO {1}').format(name, archive_table_name))
+            dbw.archive_partition(table_name, name, archive_table_name)
+
+    # Rows for a dropped range that still come in (late backfills) land in the next partition up
+    if expired:
+        print(str('DROPPING PARTITIONS {0}').format(', '.join(expired)))
+        dbw.drop_partitions(table_name, expired)
+    return expired
+
+def purge_chunks(dbw, conf, cutoff):
+    """Delete the observations before cutoff, purge_chunk_size rows per transaction with a
+    short pause between chunks so the ingest path gets the table in between
+    returns: number of rows deleted"""
+    table_name = src.weather_compact.observation_base_table(dbw, conf)
+    cutoff_text = cutoff.strftime('%Y-%m-%d %H:%M:%S')
+    total = 0
+    while True:
+        # The time index finds the oldest rows, the delete itself then goes by primary key
+        ids = dbw.get_keys_before(table_name, 'id', 'time', cutoff_text, conf.values['purge_chunk_size'])
+        if not ids:
+            break
+        total += dbw.delete_rows_by_key(table_name, 'id', ids)
+        dbw.commit()
+        time.sleep(conf.values['purge_pause_s'])
+    return total
+
+def purge_observations(dbw, conf, retention_months=None, archive=None):
+    """Expire observations older than the retention period.  The rollups are brought up to
+    date first, so nothing is expired before it has been counted
+    archive: True to keep dropped partitions as archive tables (default from the config)"""
+    if retention_months is None and conf.values['retention_months'] is None:
+        print('RETENTION IS OFF, NOTHING TO PURGE')
+        return
+    if archive is None:
+        archive = conf.values['retention_archive']
+    cutoff = retention_cutoff(conf, retention_months)
+
+    if conf.values['rollup_enabled']:
+        src.weather_rollup.catch_up_rollups(dbw, conf)
+
+    print(str('EXPIRING OBSERVATIONS BEFORE {0}').format(cutoff.isoformat()))
+    if partitioning_enabled(dbw, conf):
+        ensure_partitions(dbw, conf)
+        purge_partitions(dbw, conf, cutoff, archive)
+    else:
+        if archive:
+            print('ARCHIVING NEEDS PARTITIONING, DELETING INSTEAD')
+        removed = purge_chunks(dbw, conf, datetime.datetime(cutoff.year, cutoff.month, cutoff.day))
+        print(str('DELETED {0} OBSERVATIONS').format(removed))
@@ -0,0 +1,189 @@
+"""This module keeps hourly and daily per-station rollups of the OBSERVATION table.  Raw
+rows are folded in incrementally: everything past a watermark (the last observation id
+already counted) is aggregated and merged into the rollup rows, and the watermark moves
+forward in the same transaction.  Reads then cost one row per station per hour/day,
+however many raw rows there are.  The watermark is locked while it moves, and only rows
+stored at least rollup_lag_s ago are folded in, so several writers can run it side by side"""
+import time
+import src.weather_watermark
+
+# Rollup granularity -> (config key of the table name, length of the time prefix kept)
+# 'YYYY-MM-DD HH' is 13 characters, 'YYYY-MM-DD' is 10
+GRANULARITIES = {'hourly': ('rollup_hourly_table_name', 13), 'daily': ('rollup_daily_table_name', 10)}
+
+# Sums and counts give averages (sum / count), min and max are kept as is.  Readings that
+# were missing are left out of every aggregate
+ROLLUP_COL_NAMES = ['station_id', 'period_start', 'samples',
+                    'temp_f_sum', 'temp_f_count', 'temp_f_min', 'temp_f_max',
+                    'humidity_sum', 'humidity_count',
+                    'pressure_mb_sum', 'pressure_mb_count',
+                    'precip_in_max']
+ROLLUP_MERGE_OPS = {'samples': 'sum', 'temp_f_sum': 'sum', 'temp_f_count': 'sum', 'temp_f_min': 'min',
+                    'temp_f_max': 'max', 'humidity_sum': 'sum', 'humidity_count': 'sum',
+                    'pressure_mb_sum': 'sum', 'pressure_mb_count': 'sum', 'precip_in_max': 'max'}
+
+# Observation columns read by the rollup, id first for paging
+SOURCE_COL_NAMES = ['id', 'station_id', 'time', 'temp_f', 'relative_humidity', 'pressure_mb', 'precip_in']
+
+WATERMARK_NAME = 'observation_rollups'
+# MAX(id) of the observations when last noted, and when (unix time) that was
+SEEN_NAME = 'observation_rollups_seen'
+SEEN_AT_NAME = 'observation_rollups_seen_at'
+
+def setup_rollup_tables(dbw, conf):
+    """Create the rollup tables if needed"""
+    if conf.values['drop_all_tables']:
+        for granularity in GRANULARITIES:
+            dbw.drop_table(conf.values[GRANULARITIES[granularity][0]])
+
+    rollup_cols = ['station_id VARCHAR(20)', 'period_start DATETIME', 'samples INT',
+                   'temp_f_sum DOUBLE', 'temp_f_count INT', 'temp_f_min FLOAT', 'temp_f_max FLOAT',
+                   'humidity_sum DOUBLE', 'humidity_count INT',
+                   'pressure_mb_sum DOUBLE', 'pressure_mb_count INT',
+                   'precip_in_max FLOAT']
+    for granularity in GRANULARITIES:
+        table_name = conf.values[GRANULARITIES[granularity][0]]
+        if dbw.open_or_create_table(table_name, 'id', *rollup_cols):
+            # One row per station per period, and range scans over a station's periods.  Index
+            # names are per database in some backends, hence the table name in them
+            dbw.add_index(table_name, table_name + '_station_period', ['station_id', 'period_start'], True)
+            dbw.add_index(table_name, table_name + '_period_idx', ['period_start'], False)
+
+    dbw.commit()
+
+def get_watermark(dbw, conf):
+    """Id of the last observation already in the rollups"""
+    return src.weather_watermark.get_watermark(dbw, conf, WATERMARK_NAME)
+
+def valid_reading(value):
+    """False for missing readings (NULL, or the -999 style placeholders)"""
+    return value is not None and value > -999
+
+def period_start(time_value, prefix_length):
+    """Start of the hour or day holding time_value, as 'YYYY-MM-DD HH:MM:SS'.  DATETIME
+    columns come back as datetime from MySQL and as text from SQLite"""
+    text = time_value if isinstance(time_value, str) else time_value.strftime('%Y-%m-%d %H:%M:%S')
+    return text[:prefix_length] + '0000-00-00 00:00:00'[prefix_length:]
+
+def aggregate_rows(rows, prefix_length):
+    """Partial rollup rows for a batch of observation rows (SOURCE_COL_NAMES order), as a
+    list of tuples in ROLLUP_COL_NAMES order"""
+    buckets = {}
+    for row in rows:
+        key = (row[1], period_start(row[2], prefix_length))
+        bucket = buckets.get(key)
+        if bucket is None:
+            # samples, temp sum/count/min/max, humidity sum/count, pressure sum/count, precip max
+            bucket = buckets[key] = [0, 0.0, 0, None, None, 0.0, 0, 0.0, 0, None]
+        bucket[0] += 1
+        temp_f, humidity, pressure_mb, precip_in = row[3], row[4], row[5], row[6]
+        if valid_reading(temp_f):
+            bucket[1] += temp_f
+            bucket[2] += 1
+            bucket[3] = temp_f if bucket[3] is None else min(bucket[3], temp_f)
+            bucket[4] = temp_f if bucket[4] is None else max(bucket[4], temp_f)
+        if valid_reading(humidity):
+            bucket[5] += humidity
+            bucket[6] += 1
+        if valid_reading(pressure_mb):
+            bucket[7] += pressure_mb
+            bucket[8] += 1
+        # precip_in is the running total for the day, so its max is the total so far
+        if valid_reading(precip_in):
+            bucket[9] = precip_in if bucket[9] is None else max(bucket[9], precip_in)
+
+    return [key + tuple(bucket) for key, bucket in buckets.items()]
+
+def fold_through_id(dbw, conf):
+    """Highest observation id the rollups can fold in now (the caller holds the watermark
+    lock).  An insert still committing can hold an id below MAX(id), and once the watermark
+    is past it the row would never be counted.  So MAX(id) is noted with the time, and the
+    rows up to it are only folded in once rollup_lag_s has gone by, when a new note is
+    taken.  Without a lag everything is folded straight away (safe with a single writer)
+    returns: the id, None if the last note is not old enough yet"""
+    dbw.execute(str('SELECT MAX(id) FROM {0}').format(conf.values['observation_table_name']))
+    max_id = dbw.cursor.fetchone()[0] or 0
+    if not conf.values['rollup_lag_s']:
+        return max_id
+
+    now = int(time.time())
+    seen_id = src.weather_watermark.get_watermark(dbw, conf, SEEN_NAME)
+    if now - src.weather_watermark.get_watermark(dbw, conf, SEEN_AT_NAME) < conf.values['rollup_lag_s']:
+        return None
+    src.weather_watermark.set_watermark(dbw, conf, SEEN_NAME, max_id)
+    src.weather_watermark.set_watermark(dbw, conf, SEEN_AT_NAME, now)
+    return seen_id
+
+def update_rollups(dbw, conf, commit=True):
+    """Fold the observations past the watermark (up to fold_through_id) into the rollups,
+    rollup_batch_size rows at a time.  Each batch moves the watermark in the same
+    transaction as its rollup rows, so a batch is either fully counted or not at all.  The
+    watermark stays locked until the transaction ends, another writer running this waits,
+    then carries on from where this one left the watermark
+    commit: False to leave everything in the caller's transaction (e.g. with the insert
+    that added the rows)
+    returns: number of observations folded in"""
+    last_id = src.weather_watermark.lock_watermark(dbw, conf, WATERMARK_NAME)
+    through_id = fold_through_id(dbw, conf)
+    total = 0
+    while through_id is not None and last_id < through_id:
+        rows = dbw.get_rows_after_key(conf.values['observation_table_name'], 'id', last_id, SOURCE_COL_NAMES,
+                                      conf.values['rollup_batch_size'])
+        rows = [row for row in rows if row[0] <= through_id]
+        if not rows:
+            break
+
+        for granularity in GRANULARITIES:
+            table_key, prefix_length = GRANULARITIES[granularity]
+            dbw.merge_rows_in_table(conf.values[table_key], ROLLUP_COL_NAMES, aggregate_rows(rows, prefix_length),
+                                    ['station_id', 'period_start'], ROLLUP_MERGE_OPS, conf.values['insert_batch_size'])
+
+        last_id = rows[-1][0]
+        src.weather_watermark.set_watermark(dbw, conf, WATERMARK_NAME, last_id)
+        total += len(rows)
+        if commit:
+            dbw.commit()
+            # Another writer may have moved it while it was unlocked
+            last_id = src.weather_watermark.lock_watermark(dbw, conf, WATERMARK_NAME)
+    if commit:
+        dbw.commit()
+    return total
+
+def catch_up_rollups(dbw, conf):
+    """Fold in every observation stored before the call.  Rows too recent for
+    update_rollups are picked up after waiting rollup_lag_s (at most twice)
+    returns: number of observations folded in"""
+    dbw.execute(str('SELECT MAX(id) FROM {0}').format(conf.values['observation_table_name']))
+    target_id = dbw.cursor.fetchone()[0] or 0
+    folded = update_rollups(dbw, conf)
+    for attempt in range(2):
+        if get_watermark(dbw, conf) >= target_id:
+            break
+        time.sleep(conf.values['rollup_lag_s'])
+        folded += update_rollups(dbw, conf)
+    return folded
+
+def get_rollups(dbw, conf, granularity, station_id, start, end):
+    """Rollup rows for one station with period_start in [start, end), oldest first.  Each row
+    is a dict with the averages worked out
+    granularity: 'hourly' or 'daily'
+    start, end: 'YYYY-MM-DD HH:MM:SS' strings"""
+    table_name = conf.values[GRANULARITIES[granularity][0]]
+    sql = dbw.cached_statement(('rollup_range', table_name),
+                               lambda: str('SELECT {0} FROM {1} WHERE station_id={2} AND period_start>={2} AND period_start<{2} ORDER BY period_start').format(
+                                   ', '.join(ROLLUP_COL_NAMES), table_name, dbw.placeholder))
+    dbw.execute(sql, (station_id, start, end))
+
+    results = []
+    for row in dbw.cursor.fetchall():
+        values = dict(zip(ROLLUP_COL_NAMES, row))
+        results.append({'station_id': values['station_id'],
+                        'period_start': values['period_start'],
+                        'samples': values['samples'],
+                        'temp_f_avg': values['temp_f_sum'] / values['temp_f_count'] if values['temp_f_count'] else None,
+                        'temp_f_min': values['temp_f_min'],
+                        'temp_f_max': values['temp_f_max'],
+                        'humidity_avg': values['humidity_sum'] / values['humidity_count'] if values['humidity_count'] else None,
+                        'pressure_mb_avg': values['pressure_mb_sum'] / values['pressure_mb_count'] if values['pressure_mb_count'] else None,
+                        'precip_in': values['precip_in_max']})
+    return results
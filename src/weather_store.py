@@ -0,0 +1,307 @@
+"""This module holds the schema and the store steps for the WeatherUnderground data.  It is
+shared by the one-shot script and the poller daemon"""
+import src.weather_compact
+import src.weather_retention
+import src.weather_rollup
+import src.weather_watermark
+import src.wu_records
+import src.wu_storage
+
+# Column ids in the order rows are written
+PWS_COL_NAMES = ['id', 'latitude', 'longitude', 'city', 'neighborhood']
+# Observation records carry the same attributes in the same order
+OBSERVATION_COL_NAMES = list(src.wu_records.Observation.__slots__)
+
+# Callables handed each committed batch of observation rows (OBSERVATION_COL_NAMES order),
+# e.g. the read side cache in src/weather_query.py
+OBSERVATION_LISTENERS = []
+
+def add_observation_listener(listener):
+    """Call listener(observation_rows) after every observation insert in this process"""
+    OBSERVATION_LISTENERS.append(listener)
+
+def notify_observation_listeners(observation_rows):
+    """Hand committed observation rows to the listeners"""
+    for listener in OBSERVATION_LISTENERS:
+        listener(observation_rows)
+
+# Helper
+def float_matches_stored(stored, wire):
+    """Helper for checking if the LAT or LON have changed.
+
+    stored: float as read back from a FLOAT column
+    wire: float as returned by the REST API
+    returns: True if storing 'wire' would leave the column unchanged
+
+    Remarks:  FLOAT columns are single precision, and MySQL hands them back rounded to
+    6 significant digits.  As floats in python and as returned by the REST API they are
+    much longer.  So just comparing stored values to those on the wire is not enough.
+    Rounding both sides to the same 6 digits avoids writes that are not needed
+    """
+    if stored is None:
+        return False
+    return float(str('{0:.6g}').format(stored)) == float(str('{0:.6g}').format(wire))
+
+def sqlite_path(conf):
+    """Database file for the sqlite backend, next to the scripts unless configured"""
+    return conf.values['sqlite_path'] or conf.values['database_name'] + '.sqlite3'
+
+def connection_factory(conf):
+    """Callable that opens a new connection to the configured backend, with the database
+    selected.  The driver modules are only imported for the backend in use, so the sqlite
+    backend runs without MySQLdb or the MySQL login file"""
+    backend = conf.values['storage_backend']
+    if backend == 'sqlite':
+        import src.wu_sqlite_wrapper
+        return src.wu_sqlite_wrapper.connection_factory(sqlite_path(conf))
+    elif backend == 'mysql':
+        import src.mysql_user_info #.GITIGNORED
+        import src.wu_mysql_wrapper
+        return src.wu_mysql_wrapper.connection_factory(src.mysql_user_info.MYSQL_HOST, src.mysql_user_info.MYSQL_DB_USER,
+                                                       src.mysql_user_info.MYSQL_DB_PASS, conf.values['database_name'])
+    raise ValueError(str('Unknown storage_backend {0}').format(backend))
+
+def open_weather_database(conf):
+    """Connect using the config information, open (or create) the database and tables.
+    Returns the connected wrapper"""
+    if conf.values['storage_backend'] == 'mysql':
+        import src.mysql_user_info #.GITIGNORED
+        import src.wu_mysql_wrapper
+        # MySQLdb wrapper for weather data
+        dbw = src.wu_mysql_wrapper.WeatherUpdateDatabase()
+
+        # Connect to the host using the config information
+        dbw.connect(src.mysql_user_info.MYSQL_HOST, src.mysql_user_info.MYSQL_DB_USER, src.mysql_user_info.MYSQL_DB_PASS)
+
+        # Open the database (or create it if the first time)
+        dbw.open_or_create_database(conf.values['database_name'])
+    else:
+        # The sqlite file is created on connect
+        dbw = connection_factory(conf)()
+    setup_tables(dbw, conf)
+    return dbw
+
+def connect_weather_database(conf):
+    """Connect straight to the (already created) database, skipping the table setup"""
+    return connection_factory(conf)()
+
+def open_connection_pool(conf):
+    """Pool of connections to the (already created) database for concurrent workers"""
+    return src.wu_storage.WeatherConnectionPool(connection_factory(conf), conf.values['db_pool_size'])
+
+def setup_observation_table(dbw, conf, table_name, observation_cols, indexes, foreign_key):
+    """Create an observation table, or migrate an existing one to the current indexes and
+    partitioning
+    observation_cols: list of column definitions
+    indexes: list of (index name, list of column ids, unique)
+    foreign_key: (constraint name, constraint definition), declared unless partitioned"""
+    # The constraint prevents deletion of PWS data so long as OBSERVATION data references it.
+    # It is declared with the table since not every backend can add one later.  A
+    # partitioned table cannot have it: store_pws always runs before the observations are
+    # stored, which keeps every station valid there too
+    partitioned = src.weather_retention.partitioning_enabled(dbw, conf)
+    if partitioned:
+        # Monthly partitions on time, so expiring a month is a partition drop (see src/weather_retention.py)
+        table_created = dbw.open_or_create_table(table_name, 'id', *observation_cols,
+                                                 partition_by=('time', src.weather_retention.upcoming_months(conf)))
+    else:
+        table_created = dbw.open_or_create_table(table_name, 'id', *(observation_cols + [foreign_key[1]]))
+
+    # The station/time key is unique - a station only reports once per timestamp, and it makes
+    # per-station history and latest-reading lookups index range scans.  time on its own
+    # serves time-range queries across all stations.  Tables created before the indexes
+    # existed are migrated here too, duplicates already stored have to go before the unique
+    # key can be added
+    for index_name, index_cols, index_unique in indexes:
+        if table_created or not dbw.index_exists(table_name, index_name):
+            if index_unique and not table_created:
+                removed = dbw.delete_duplicate_rows(table_name, 'id', index_cols)
+                print(str('REMOVED {0} DUPLICATE OBSERVATIONS').format(removed))
+            dbw.add_index(table_name, index_name, index_cols, index_unique)
+
+    if partitioned:
+        if not dbw.get_partitions(table_name):
+            # Existing table from before partitioning was turned on.  The months start at the
+            # oldest stored row, and the foreign key has to go
+            oldest = src.weather_retention.oldest_observation_time(dbw, conf)
+            print('PARTITIONING THE OBSERVATION TABLE (THIS REBUILDS IT)...')
+            dbw.partition_existing_table(table_name, 'id', 'time', src.weather_retention.upcoming_months(conf, oldest), foreign_key[0])
+        src.weather_retention.ensure_partitions(dbw, conf)
+
+def widen_weather_lookup(dbw, conf):
+    """Weather lookup tables from before the hash key held the text in a VARCHAR(60).  A
+    longer text was cut short by the insert, and then not found, so its observations lost
+    their weather.  Rebuild the table with the full width column, keeping the ids.  The view
+    reads the table, it is taken down meanwhile"""
+    lookup_table_name = conf.values['weather_lookup_table_name']
+    print(str('WIDENING THE {0} TABLE').format(lookup_table_name))
+    rows = [(weather_id, values[0], src.weather_compact.weather_hash(values[0])) for weather_id, values in
+            dbw.get_rows_keyed_by_column(lookup_table_name, 'id', ['name']).items()]
+    view = dbw.view_exists(conf.values['observation_table_name'])
+    if view:
+        dbw.drop_view(conf.values['observation_table_name'])
+    new_table_name = lookup_table_name + '_new'
+    dbw.drop_table(new_table_name)
+    dbw.open_or_create_table(new_table_name, 'id', *src.weather_compact.WEATHER_LOOKUP_COL_DEFS)
+    dbw.add_rows_to_table(new_table_name, ['id', 'name', 'name_hash'], rows)
+    dbw.drop_table(lookup_table_name)
+    dbw.rename_table(new_table_name, lookup_table_name)
+    if view:
+        dbw.create_view(conf.values['observation_table_name'], src.weather_compact.view_select(conf))
+    dbw.commit()
+    dbw.schema_info.clear()
+
+def setup_compact_tables(dbw, conf):
+    """Create the compact observation table and the weather lookup table, and give the PWS
+    table the per station columns (see src/weather_compact.py)"""
+    for col_definition in src.weather_compact.STATION_COL_DEFS:
+        if not dbw.column_exists(conf.values['pws_table_name'], col_definition.split()[0]):
+            dbw.add_column(conf.values['pws_table_name'], col_definition)
+    if not dbw.open_or_create_table(conf.values['weather_lookup_table_name'], 'id', *src.weather_compact.WEATHER_LOOKUP_COL_DEFS):
+        if not dbw.column_exists(conf.values['weather_lookup_table_name'], 'name_hash'):
+            widen_weather_lookup(dbw, conf)
+
+    # Index names are per database on some backends, so these carry the table name
+    table_name = conf.values['compact_observation_table_name']
+    indexes = [(table_name + '_station_time', ['station_key', 'time'], True), (table_name + '_time', ['time'], False)]
+    foreign_key = ('station_key_ref', str('CONSTRAINT station_key_ref FOREIGN KEY (station_key) REFERENCES {0} (autoid)').format(conf.values['pws_table_name']))
+    setup_observation_table(dbw, conf, table_name, list(src.weather_compact.COMPACT_COL_DEFS), indexes, foreign_key)
+
+def setup_tables(dbw, conf):
+    """Create the PWS and OBSERVATION tables, or migrate existing ones to the current indexes"""
+    # Testing and schema changes only (should normally be False)
+    if conf.values['drop_all_tables']:
+        # Deletes every observation table (or view) and the PWS table from the database
+        if dbw.view_exists(conf.values['observation_table_name']):
+            dbw.drop_view(conf.values['observation_table_name'])
+        for table_name in [conf.values['observation_table_name'], src.weather_compact.legacy_table_name(conf),
+                           conf.values['compact_observation_table_name'], conf.values['weather_lookup_table_name'],
+                           conf.values['pws_table_name']]:
+            dbw.drop_table(table_name)
+        dbw.schema_info.clear()
+
+    # Create Table for the PWS data.  elevation and zip are only filled in with the compact schema
+    pws_cols = ['id VARCHAR(20) UNIQUE', 'latitude FLOAT', 'longitude FLOAT', 'city TEXT', 'neighborhood TEXT'] + src.weather_compact.STATION_COL_DEFS
+    dbw.open_or_create_table(conf.values['pws_table_name'], 'autoid', *pws_cols)
+
+    if conf.values['observation_partitioning'] and not src.weather_retention.partitioning_enabled(dbw, conf):
+        print('THIS STORAGE BACKEND DOES NOT PARTITION TABLES, observation_partitioning IS IGNORED')
+
+    compact = src.weather_compact.compact_schema(dbw, conf)
+    if compact or (conf.values['compact_observations'] and not dbw.table_exists(conf.values['observation_table_name'])):
+        # Compact tables, with the view under the observation table name for the readers
+        setup_compact_tables(dbw, conf)
+        if not compact:
+            dbw.create_view(conf.values['observation_table_name'], src.weather_compact.view_select(conf))
+            dbw.schema_info.clear()
+    elif dbw.table_exists(src.weather_compact.legacy_table_name(conf)):
+        # Part way through the switch over, the name is kept free for the view
+        print('COMPACT MIGRATION IN PROGRESS, RUN weather_migrate_compact.py TO FINISH IT')
+    else:
+        # Create Table for OBSERVATION data
+        partitioned = src.weather_retention.partitioning_enabled(dbw, conf)
+        observation_cols = ['station_id VARCHAR(20)', 'time DATETIME NOT NULL' if partitioned else 'time DATETIME', 'weather TEXT', 'temp_f FLOAT', 'temp_c FLOAT', 'relative_humidity TINYINT', 'uv_index FLOAT', 'precip_in FLOAT', 'pressure_in FLOAT', 'pressure_mb FLOAT', 'latitude FLOAT', 'longitude FLOAT', 'elevation INT', 'city TEXT', 'zip TEXT']
+        indexes = [('station_time', ['station_id', 'time'], True), ('time_idx', ['time'], False)]
+        foreign_key = ('station_id_ref', str('CONSTRAINT station_id_ref FOREIGN KEY (station_id) REFERENCES {0} (id)').format(conf.values['pws_table_name']))
+        setup_observation_table(dbw, conf, conf.values['observation_table_name'], observation_cols, indexes, foreign_key)
+        if conf.values['compact_observations']:
+            print('THE OBSERVATION TABLE IS STILL WIDE, RUN weather_migrate_compact.py TO MOVE IT TO THE COMPACT SCHEMA')
+    src.weather_watermark.setup_watermark_table(dbw, conf)
+    dbw.commit()
+
+    if conf.values['rollup_enabled']:
+        src.weather_rollup.setup_rollup_tables(dbw, conf)
+
+def load_known_pws(dbw, conf):
+    """Every known station in one query, as a dict of id to (lat, lon, city, neighborhood)"""
+    return dbw.get_rows_keyed_by_column(conf.values['pws_table_name'], 'id', PWS_COL_NAMES[1:])
+
+def store_pws(dbw, conf, nearby_pws, known_pws=None):
+    """Insert new stations and update changed ones in a single statement
+    nearby_pws: list of Station records from the geolookup
+    known_pws: dict from load_known_pws, loaded here if not given.  It is updated with
+    whatever gets written, so a long running caller can keep it between cycles
+    returns: the number of stations written"""
+    if known_pws is None:
+        known_pws = load_known_pws(dbw, conf)
+
+    # Check each PWS returned from the cloud against the known stations in memory.
+    # Unchanged stations cost no round trips
+    changed_pws_rows = []
+    for pws_info in nearby_pws:
+        cols = known_pws.get(pws_info.id)
+        if cols is not None:
+            print('FOUND AN EXISTING PWS...')
+            # LAT and LON get truncated when written to the table.  So we need to simulate
+            # that before checking, otherwise it will appear to be updating all the time
+            if (float_matches_stored(cols[0], pws_info.lat) and float_matches_stored(cols[1], pws_info.lon)
+                    and str(cols[2]) == pws_info.city and str(cols[3]) == pws_info.neighborhood):
+                # The entry exists in the table, but it did not appear to be any different
+                print('...IT DID NOT CHANGE')
+                continue
+
+        changed_pws_rows.append((pws_info.id, pws_info.lat, pws_info.lon, pws_info.city, pws_info.neighborhood))
+
+    # New and changed stations all go in a single upsert, keyed on the unique id column
+    if changed_pws_rows:
+        dbw.upsert_rows_in_table(conf.values['pws_table_name'], PWS_COL_NAMES, changed_pws_rows, PWS_COL_NAMES[1:], key_names=['id'])
+        dbw.commit()
+        for row in changed_pws_rows:
+            known_pws[row[0]] = row[1:]
+
+    return len(changed_pws_rows)
+
+def rollup_after_insert(dbw, conf, rollup):
+    """Bring the rollups up to date after an insert, if enabled.  This runs after the insert is
+    committed, in its own transactions.  If it is cut short, the watermark still points at
+    the rows that were left, and the next run picks them up"""
+    if rollup is None:
+        rollup = conf.values['rollup_enabled'] and conf.values['rollup_on_insert']
+    if rollup:
+        src.weather_rollup.update_rollups(dbw, conf)
+
+def insert_observation_rows(dbw, conf, observation_rows):
+    """Insert observation rows (OBSERVATION_COL_NAMES order) into whichever observation
+    schema the database has.  Nothing is committed here.  The schema is looked up once per
+    connection, and weather_migrate_compact.py can swap the wide table for the view under a
+    long lived one.  So a failed insert drops the lookups and is tried once more (after
+    rolling back, with anything else left uncommitted on the connection)"""
+    try:
+        write_observation_rows(dbw, conf, observation_rows)
+    except dbw.driver_error:
+        dbw.db.rollback()
+        dbw.schema_info.clear()
+        write_observation_rows(dbw, conf, observation_rows)
+
+def write_observation_rows(dbw, conf, observation_rows):
+    """insert_observation_rows without the retry"""
+    if src.weather_compact.compact_schema(dbw, conf):
+        dbw.add_rows_to_table(conf.values['compact_observation_table_name'], src.weather_compact.COMPACT_COL_NAMES,
+                              src.weather_compact.encode_rows(dbw, conf, observation_rows), conf.values['insert_batch_size'], ignore_duplicates=True)
+    else:
+        dbw.add_rows_to_table(conf.values['observation_table_name'], OBSERVATION_COL_NAMES, observation_rows, conf.values['insert_batch_size'], ignore_duplicates=True)
+
+def store_observations(dbw, conf, observations, rollup=None):
+    """Add new observations to the table as multi-row INSERTs and a single commit.  Raises
+    if the commit fails (after rolling back)
+    observations: list of Observation records from function_to_extract_observation_data
+    rollup: False to leave the rollups to a later catch-up (None follows the config)"""
+    # Each observation is a new row.  Polling faster than a station reports returns the same
+    # reading again, those collide with the (station_id, time) key and are skipped.  The values
+    # are passed as parameters, so strings do not need their quotes escaped
+    observation_rows = [observation.row() for observation in observations]
+
+    # A failed commit raises, so the caller knows the rows are not stored (the store pipeline
+    # spools them) and the listeners never hear of them
+    insert_observation_rows(dbw, conf, observation_rows)
+    dbw.commit(raise_errors=True)
+    notify_observation_listeners(observation_rows)
+    rollup_after_insert(dbw, conf, rollup)
+
+def store_observation_columns(dbw, conf, columns, rollup=None):
+    """Same as store_observations, for a batch parsed into src.wu_batch_parser.ObservationColumns"""
+    observation_rows = list(columns.rows())
+    insert_observation_rows(dbw, conf, observation_rows)
+    dbw.commit(raise_errors=True)
+    notify_observation_listeners(observation_rows)
+    rollup_after_insert(dbw, conf, rollup)
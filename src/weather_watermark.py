@@ -0,0 +1,31 @@
+"""This module keeps named watermarks: for each incremental job (rollups, exports...) the
+id of the last observation it has dealt with.  Moving a watermark in the same transaction
+as the job's own writes makes each step happen exactly once"""
+
+def setup_watermark_table(dbw, conf):
+    """Create the watermark table if needed"""
+    if conf.values['drop_all_tables']:
+        dbw.drop_table(conf.values['watermark_table_name'])
+    dbw.open_or_create_table(conf.values['watermark_table_name'], 'id', 'name VARCHAR(40) UNIQUE', 'last_id BIGINT')
+
+def get_watermark(dbw, conf, name):
+    """Id of the last observation the named job has dealt with, 0 if it never ran"""
+    rows = dbw.get_rows_by_column_id(conf.values['watermark_table_name'], 'name', name, ['last_id'])
+    return rows[0][0] if rows else 0
+
+def lock_watermark(dbw, conf, name):
+    """Same as get_watermark, also locking the watermark until the transaction ends, so
+    another run of the same job waits for this one instead of dealing with the same rows.
+    Nothing is committed here"""
+    table_name = conf.values['watermark_table_name']
+    rows = dbw.lock_rows_by_column_id(table_name, 'name', name, ['last_id'])
+    if not rows:
+        # The job never ran, add its row to lock
+        dbw.add_rows_to_table(table_name, ['name', 'last_id'], [(name, 0)], ignore_duplicates=True)
+        rows = dbw.lock_rows_by_column_id(table_name, 'name', name, ['last_id'])
+    return rows[0][0]
+
+def set_watermark(dbw, conf, name, last_id):
+    """Move the named watermark.  Nothing is committed here"""
+    dbw.upsert_rows_in_table(conf.values['watermark_table_name'], ['name', 'last_id'], [(name, last_id)],
+                             ['last_id'], key_names=['name'])
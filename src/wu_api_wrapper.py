@@ -1,27 +1,51 @@
 """This module encapsulates the api calls to weather underground and the data returned"""
 import src.weather_conf
+import src.wu_rate_limiter
+import src.wu_response_cache
+import src.wu_batch_parser
+import src.wu_http_client
+import src.wu_records
+import src.wu_station_index
+import src.wu_metrics
 import json
-from lxml import html #3.7.2 worked and 3.8 did not (IDLE vs ANACONDA for VSCODE)
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import random
+import threading
 
-# Only pull this in for live, otherwise the script is much faster
-conf = src.weather_conf.WeatherConfig()
-if conf.values['use_live_server']:
-    import requests
+# Per request echo, sampled (see debug_log_sample_every)
+REST_LOG = src.wu_metrics.SampledLog('wu.rest')
 
 class WeatherUnderground():
     """Wrapper for the REST calls and processing for WeatherUnderground"""
 
-    def __init__(self):
-        """Initialize the API wrapper"""
-        self.conf = src.weather_conf.WeatherConfig()
+    def __init__(self, conf=None):
+        """Initialize the API wrapper
+        conf: WeatherConfig to use, a default one is built if not given"""
+        if conf is None:
+            conf = src.weather_conf.WeatherConfig()
+        self.conf = conf
         self.live = self.conf.values['use_live_server']
         self.primary_url = self.conf.values['endpoint_url']
         self.station_url_format = self.conf.values['endpoint_url_stationid']
         self.save_response = self.conf.values['save_live_response']
         self.pws_max_distance = self.conf.values['pws_max_distance_km']
         self.pws_max = self.conf.values['pws_max_extract']
+        self.concurrent_fetch = self.conf.values['use_concurrent_fetch']
+        self.fetch_max_workers = self.conf.values['fetch_max_workers']
+        # Shared by every live call so the quotas hold across threads
+        self.limiter = src.wu_rate_limiter.QuotaLimiter(self.conf.values['api_calls_per_minute'], self.conf.values['api_calls_per_day'])
+        # Pooled, retrying client for the live calls (requests is only imported for live)
+        self.http = src.wu_http_client.WeatherHttpClient(self.conf) if self.live else None
+        self.lat_lon = self.conf.values['lat_lon']
+        self.station_index = None
+        self.station_index_lock = threading.Lock()
+        if self.conf.values['use_station_index']:
+            self.station_index = src.wu_station_index.StationIndex(self.conf.values['station_index_path'])
+        self.station_index_ttl = self.conf.values['station_index_ttl']
+        self.cache = src.wu_response_cache.ResponseCache(self.conf.values['response_cache_dir'],
+                                                         self.conf.values['response_cache_ttl'],
+                                                         self.conf.values['response_cache_max_bytes'])
 
     def get_weather_and_pws_info(self):
         """Finds nearby pws, queries them for conditions and returns both sets of results"""
@@ -29,55 +53,136 @@ class WeatherUnderground():
         nearby_pws = self.get_nearby_pws_info()
         
         # Go through the list and query each pws for their current conditions
-        observations = []
-        for pws_info in nearby_pws:
-            pws_weather = self.get_pws_weather_response(pws_info['id'])
-            observations.append(pws_weather)
+        pws_ids = [pws_info.id for pws_info in nearby_pws]
+        if self.concurrent_fetch and len(pws_ids) > 1:
+            observations = self.get_pws_weather_responses(pws_ids)
+        else:
+            observations = []
+            for pws_id in pws_ids:
+                pws_weather = self.get_pws_weather_response(pws_id)
+                observations.append(pws_weather)
 
-        # Return both lists of dictionaries
+        # Return both lists (Station and Observation records)
         return (nearby_pws, observations)
 
-    def get_server_response(self, query):
-        """Generic server query - returns the json response"""
-        json_bytes = None
+    def get_server_response(self, query, kind, use_cache=True):
+        """Generic server query - returns the json response
+        query: full query URL
+        kind: endpoint type ('geolookup' or 'conditions'), selects the cache TTL
+        use_cache: False to skip reading the cache when live (the response is still saved)"""
+        # Fresh cached responses cost no quota and no round trip.  Offline, replay whatever
+        # was stored for this exact query no matter how old it is
+        if use_cache or not self.live:
+            json_bytes = self.cache.get(query, kind, ignore_ttl=not self.live)
+            if json_bytes is not None:
+                src.wu_metrics.METRICS.increment('cache_hits')
+                return json.loads(json_bytes)
 
         if self.live:
-            print('REST QUERY: ' + query)
-            json_bytes = requests.get(query)
-            parsed_json = json.loads(json_bytes.content)
+            # Each attempt waits for the per minute and per day quotas, see wu_http_client.py
+            REST_LOG.debug('REST QUERY: %s', query)
+            start = src.wu_metrics.METRICS.start()
+            json_bytes = self.http.get(query, self.limiter)
+            src.wu_metrics.METRICS.observe('rest', start, len(json_bytes))
+            parsed_json = json.loads(json_bytes)
             if self.save_response:
-                with open("RESPONSE_PARSED.txt", "wb") as bin_file:
-                    bin_file.write(json_bytes.content)
+                self.cache.put(query, kind, json_bytes)
         else:
-            # Read a previous response for testing
-            with open("RESPONSE_PARSED.txt", "rb") as bin_file:
-                json_bytes = bin_file.read()
-                parsed_json = json.loads(json_bytes)
+            # Offline only replays the cache, which a live run with save_live_response fills
+            raise LookupError(str('No cached {0} response to replay, run live with save_live_response first').format(kind))
 
         return parsed_json
 
-    def get_nearby_pws_info(self):
-        """Query the server for a list of pws (personal weather stations)"""
-        # return a list of dictionaries holding the pws_info data
+    def get_nearby_pws_info(self, lat_lon=None):
+        """Query the server for a list of pws (personal weather stations)
+        lat_lon: 'lat,lon' string to search around, defaults to the configured location"""
+        # return a list of Station records holding the pws_info data
+        if lat_lon is None:
+            lat_lon = self.lat_lon
+        point = tuple(float(value) for value in lat_lon.split(','))
 
         # Look in weather_conf.py for settings on location, search radius, number returned
-        parsed_json = self.get_server_response(self.primary_url)
+        if self.station_index is not None:
+            with self.station_index_lock:
+                nearby = None
+                if self.station_index.area_is_fresh(point[0], point[1], self.station_index_ttl):
+                    nearby = self.station_index.within_radius(point[0], point[1], self.pws_max_distance)
+            if nearby is not None:
+                # The stations around here are already known, no need to ask the server
+                response_dicts = [dict(station, distance_km=km) for km, station in nearby]
+                return self.function_to_select_nearby_pws(response_dicts)
+
+        if lat_lon == self.lat_lon:
+            query = self.primary_url
+        else:
+            query = self.conf.values['endpoint_url_base'] + lat_lon + '.json'
+        parsed_json = self.get_server_response(query, 'geolookup')
 
         # Extract relevant info from the server response and return it
-        nearyby_pws_info = self.function_to_extract_nearby_pws(parsed_json)
+        nearyby_pws_info = self.function_to_extract_nearby_pws(parsed_json, point)
         return nearyby_pws_info
 
-    def get_pws_weather_response(self, pws_id):
+    def get_nearby_pws_for_locations(self, locations):
+        """Run the nearby pws search for every 'lat,lon' in locations in parallel, then merge
+        the results so each station appears once (with its smallest distance).  Stations
+        come back in the order they were first found, locations in the order given"""
+        workers = max(1, min(self.fetch_max_workers, len(locations)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            station_lists = list(executor.map(self.get_nearby_pws_info, locations))
+
+        merged = {}
+        for station_list in station_lists:
+            for pws_info in station_list:
+                if pws_info.id not in merged or pws_info.distance_km < merged[pws_info.id].distance_km:
+                    merged[pws_info.id] = pws_info
+        return list(merged.values())
+
+    def get_pws_weather_response(self, pws_id, use_cache=True):
         pws_query = self.station_url_format.format(pws_id)
-        server_response = self.get_server_response(pws_query)
+        server_response = self.get_server_response(pws_query, 'conditions', use_cache)
         # Extract the observation data from this specific pws request
         ob_info = self.function_to_extract_observation_data(server_response)
         return ob_info
 
-    def function_to_extract_nearby_pws(self, response):
+    def get_pws_weather_responses(self, pws_ids, use_cache=True):
+        """Query several pws concurrently.  Results are returned in the same order as
+        pws_ids, so the database stage sees the same sequence as a serial run"""
+        workers = max(1, min(self.fetch_max_workers, len(pws_ids)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(lambda pws_id: self.get_pws_weather_response(pws_id, use_cache), pws_ids))
+
+    def get_pws_weather_outcomes(self, pws_ids, use_cache=True):
+        """Same as get_pws_weather_responses, but a station that fails (HTTP error, no
+        current_observation...) does not lose the others' readings
+        returns: list of (observation, exception) in pws_ids order, one of the two None"""
+        workers = max(1, min(self.fetch_max_workers, len(pws_ids)))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.get_pws_weather_response, pws_id, use_cache) for pws_id in pws_ids]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append((future.result(), None))
+            except Exception as e:
+                outcomes.append((None, e))
+        return outcomes
+
+    def function_to_extract_nearby_pws(self, response, point=None):
         # Find the list of dicts that enclose the nearvy stations info
         response_dicts = response['location']['nearby_weather_stations']['pws']['station']
 
+        # Remember every station returned, not just the ones used this run
+        if self.station_index is not None and point is not None:
+            with self.station_index_lock:
+                self.station_index.add_geolookup(point[0], point[1], response_dicts)
+                self.station_index.save()
+
+        return self.function_to_select_nearby_pws(response_dicts)
+
+    def function_to_select_nearby_pws(self, response_dicts):
+        """Pick up to pws_max stations within pws_max_distance from a list of station dicts.
+        Only the ones picked are turned into Station records"""
+        response_dicts = list(response_dicts)
+
         # just so we don't always get the same X ones
         random.shuffle(response_dicts)
 
@@ -89,47 +194,60 @@ class WeatherUnderground():
 
         # Trim down stations - we could also just stop after adding 
         # but right now I like to be able to see the full list before it's trimmed
-        return eligible_pws_stations[:self.pws_max]
+        return [src.wu_records.Station.from_geolookup(station_dict) for station_dict in eligible_pws_stations[:self.pws_max]]
 
     def function_to_extract_observation_data(self, response):
         
+        start = src.wu_metrics.METRICS.start()
         CURRENT_OBS = response['current_observation']
-        ob_data = {}
         
         OB_TIME = datetime.strptime(CURRENT_OBS['observation_time_rfc822'], '%a, %d %b %Y %H:%M:%S %z')
         OB_TIME = OB_TIME.strftime('%Y-%m-%d %H:%M:%S')
-        
-        ob_data['station_id'] = str(CURRENT_OBS['station_id'])
-        ob_data['time'] = OB_TIME
-        ob_data['weather'] = str(CURRENT_OBS['weather'])
-        ob_data['temp_f'] = float(CURRENT_OBS['temp_f'])
-        ob_data['temp_c'] = float(CURRENT_OBS['temp_c'])
-        ob_data['relative_humidity'] = int(CURRENT_OBS['relative_humidity'].replace('%', ''))
-        ob_data['uv_index'] = float(CURRENT_OBS['UV'].strip())
-    
-        # Precip might be '--' instead of blank or 0, so convert it to 0
-        # it can also be -999.00 or 999 so there's that to deal with
-        ob_data['precip_in'] = float(CURRENT_OBS['precip_today_in'].replace('-', '').strip())
-        if ob_data['precip_in'] == 999:
-            ob_data['precip_in'] = 0.0
-    
-        ob_data['pressure_in'] = float(CURRENT_OBS['pressure_in'].strip())
-        ob_data['pressure_mb'] = float(CURRENT_OBS['pressure_mb'].strip())
-        ob_data['latitude'] = float(CURRENT_OBS['observation_location']['latitude'].strip())
-        ob_data['longitude'] = float(CURRENT_OBS['observation_location']['longitude'].strip())
-        ob_data['elevation'] = int(str(CURRENT_OBS['observation_location']['elevation']).replace('ft', '').strip())
-        ob_data['city'] = str(CURRENT_OBS['observation_location']['city'])
-        ob_data['zip'] = str(CURRENT_OBS['display_location']['zip'])
-        
+
+        # Sentinels ('--', -999, ...) are stored as NULL, the same as the batch parser.
+        # Precip might be '--' instead of blank or 0, it can also be -999.00 or 999, and a
+        # missing precip reading counts as 0
+        parse_number = src.wu_batch_parser.parse_number
+        MISSING = src.wu_batch_parser.MISSING_VALUES
+        LOCATION = CURRENT_OBS['observation_location']
+
+        # Built straight into the record, no intermediate dict
+        ob_data = src.wu_records.Observation(
+            str(CURRENT_OBS['station_id']),
+            OB_TIME,
+            str(CURRENT_OBS['weather']),
+            parse_number(CURRENT_OBS['temp_f'], float, MISSING),
+            parse_number(CURRENT_OBS['temp_c'], float, MISSING),
+            parse_number(str(CURRENT_OBS['relative_humidity']).replace('%', ''), src.wu_batch_parser.whole_number, MISSING),
+            parse_number(CURRENT_OBS['UV'], float, MISSING),
+            parse_number(CURRENT_OBS['precip_today_in'], float, src.wu_batch_parser.PRECIP_MISSING_VALUES, '0'),
+            parse_number(CURRENT_OBS['pressure_in'], float, MISSING),
+            parse_number(CURRENT_OBS['pressure_mb'], float, MISSING),
+            parse_number(LOCATION['latitude'], float, MISSING),
+            parse_number(LOCATION['longitude'], float, MISSING),
+            parse_number(str(LOCATION['elevation']).replace('ft', ''), src.wu_batch_parser.whole_number, MISSING),
+            str(LOCATION['city']),
+            str(CURRENT_OBS['display_location']['zip']))
+
+        src.wu_metrics.METRICS.observe('parse', start)
         return ob_data
 
+    def function_to_extract_observation_columns(self, responses):
+        """Batch version of function_to_extract_observation_data for backfills and replays.
+        Returns a src.wu_batch_parser.ObservationColumns instead of a list of Observation records"""
+        start = src.wu_metrics.METRICS.start()
+        columns = src.wu_batch_parser.extract_observation_columns(responses)
+        src.wu_metrics.METRICS.observe('parse_batch', start)
+        src.wu_metrics.METRICS.increment('parse_batch_rows', len(columns))
+        return columns
+
     def print_pws_info(self, pws_info):
         """Helper to dump PWS data"""
         # print some info on them
         print()
-        print('ID: ' + str(pws_info['id']))
-        print('KM: ' + str(pws_info['distance_km']))
-        print('NEIGHBORHOOD: ' + str(pws_info['neighborhood']))
+        print('ID: ' + str(pws_info.id))
+        print('KM: ' + str(pws_info.distance_km))
+        print('NEIGHBORHOOD: ' + str(pws_info.neighborhood))
 
 
     def print_weather_observation(self, observation_record):
@@ -137,21 +255,21 @@ class WeatherUnderground():
         record = observation_record
 
         print()
-        print('STATION ID: ' + record['station_id'])
-        print('TIME: ' + str(record['time']))
-        print('WEATHER: ' + record['weather'])
-        print('T(F): ' + str(record['temp_f']))
-        print('T(C): ' + str(record['temp_c']))
-        print('REL HUM: ' + str(record['relative_humidity']) + '%')
-        print('UV: ' + str(record['uv_index']))
-        print('PRECIP(IN): ' + str(record['precip_in']))
-        print('PRESSURE(IN): ' + str(record['pressure_in']))
-        print('PRESSURE(MB): ' + str(record['pressure_mb']))
-        print('LATITUDE: ' + str(record['latitude']))
-        print('LONGITUDE: ' + str(record['longitude']))
-        print('ELEVATION(ft): ' + str(record['elevation']))
-        print('CITY: ' + record['city'])
-        print('ZIPCODE: ' + record['zip'])
+        print('STATION ID: ' + record.station_id)
+        print('TIME: ' + str(record.time))
+        print('WEATHER: ' + record.weather)
+        print('T(F): ' + str(record.temp_f))
+        print('T(C): ' + str(record.temp_c))
+        print('REL HUM: ' + str(record.relative_humidity) + '%')
+        print('UV: ' + str(record.uv_index))
+        print('PRECIP(IN): ' + str(record.precip_in))
+        print('PRESSURE(IN): ' + str(record.pressure_in))
+        print('PRESSURE(MB): ' + str(record.pressure_mb))
+        print('LATITUDE: ' + str(record.latitude))
+        print('LONGITUDE: ' + str(record.longitude))
+        print('ELEVATION(ft): ' + str(record.elevation))
+        print('CITY: ' + record.city)
+        print('ZIPCODE: ' + record.zip)
 
     
     
\ No newline at end of file
@@ -0,0 +1,150 @@
+"""This module collects several locations in one cycle.  The geolookups run in parallel,
+the station sets are merged so each station is queried once, then the fetch/store work
+is split across worker processes.  With use_store_pipeline the workers only fetch, and
+the observations are stored by a single store worker while the fetches are still running"""
+import math
+import multiprocessing
+import src.weather_conf
+import src.weather_store
+import src.wu_api_wrapper
+import src.wu_pipeline
+import src.wu_rate_limiter
+
+KM_PER_DEG_LAT = 111.2
+
+def grid_locations(grid):
+    """'lat,lon' strings for a grid of points step_km apart covering the bounding box
+    grid: dict with 'south', 'west', 'north', 'east' and 'step_km'"""
+    lat_step = grid['step_km'] / KM_PER_DEG_LAT
+    mid_lat = math.radians((grid['south'] + grid['north']) / 2)
+    lon_step = grid['step_km'] / (KM_PER_DEG_LAT * max(math.cos(mid_lat), 1e-6))
+
+    locations = []
+    lat = grid['south']
+    while lat <= grid['north'] + 1e-9:
+        lon = grid['west']
+        while lon <= grid['east'] + 1e-9:
+            locations.append(str('{0:.6f},{1:.6f}').format(lat, lon))
+            lon += lon_step
+        lat += lat_step
+    return locations
+
+def configured_locations(conf):
+    """Every location to cover: lat_lon, then extra_locations, then the grid (no repeats)"""
+    locations = [conf.values['lat_lon']] + list(conf.values['extra_locations'])
+    if conf.values['location_grid']:
+        locations += grid_locations(conf.values['location_grid'])
+    return list(dict.fromkeys(locations))
+
+def worker_config(conf_values):
+    """WeatherConfig for a worker process holding the collecting process's values, so
+    settings changed after the config was built (endpoint_host, storage_backend...) carry
+    over.  The values dict pickles, the config is rebuilt around it"""
+    conf = src.weather_conf.WeatherConfig()
+    conf.values = dict(conf_values)
+    return conf
+
+def worker_wrapper(conf, limiter):
+    """WeatherUnderground wrapper for a worker process
+    limiter: the QuotaLimiter (or a proxy to the one served by a QuotaManager) shared by
+    every worker, so together they stay within the quotas"""
+    wu = src.wu_api_wrapper.WeatherUnderground(conf)
+    wu.limiter = limiter
+    return wu
+
+def shared_limiter(manager, wu):
+    """QuotaLimiter served by the manager to the worker processes.  It starts with what the
+    collecting process has left after its geolookups, not with full buckets"""
+    return manager.QuotaLimiter(wu.conf.values['api_calls_per_minute'], wu.conf.values['api_calls_per_day'],
+                                wu.limiter.available())
+
+def fetch_into_queue(conf_values, station_ids, limiter, observation_queue):
+    """Worker process body with the store pipeline: query the conditions for station_ids
+    and push each observation onto the pipeline's queue.  Returns the number fetched
+    conf_values: the collecting process's conf.values"""
+    if not station_ids:
+        return 0
+
+    conf = worker_config(conf_values)
+    wu = worker_wrapper(conf, limiter)
+    return src.wu_pipeline.fetch_into(wu, station_ids, observation_queue.put)
+
+def fetch_and_store(conf_values, station_ids, limiter):
+    """Worker process body: query the conditions for station_ids and store them over this
+    process's own connection.  Returns the number of observations fetched
+    conf_values: the collecting process's conf.values"""
+    if not station_ids:
+        return 0
+
+    conf = worker_config(conf_values)
+    wu = worker_wrapper(conf, limiter)
+    observations = wu.get_pws_weather_responses(station_ids)
+
+    dbw = src.weather_store.connect_weather_database(conf)
+    try:
+        # The rollups are advanced once by collect(), workers running it side by side could
+        # move the watermark past each other's uncommitted rows
+        src.weather_store.store_observations(dbw, conf, observations, rollup=False)
+    finally:
+        dbw.close_connection()
+    return len(observations)
+
+def fetch_through_pipeline(conf, wu, chunks):
+    """Fetch the chunks in worker processes while this process stores what they return.
+    The store worker is the only writer, the rollups are left to collect()
+    returns: number of observations fetched"""
+    process_count = len(chunks)
+    if process_count == 1:
+        pipeline = src.wu_pipeline.StorePipeline(conf, 'collector', rollup=False)
+        pipeline.start()
+        try:
+            fetched = fetch_into_queue(conf.values, chunks[0], wu.limiter, pipeline)
+        finally:
+            stored, spooled = pipeline.finish()
+    else:
+        # A managed queue and limiter can be handed to the pool's processes
+        with src.wu_rate_limiter.QuotaManager() as manager, multiprocessing.Pool(process_count) as pool:
+            limiter = shared_limiter(manager, wu)
+            pipeline = src.wu_pipeline.StorePipeline(conf, 'collector', manager.Queue(conf.values['pipeline_queue_size']), rollup=False)
+            pipeline.start()
+            try:
+                fetched = sum(pool.starmap(fetch_into_queue, [(conf.values, chunk, limiter, pipeline.queue) for chunk in chunks]))
+            finally:
+                stored, spooled = pipeline.finish()
+                wu.limiter.set_available(limiter.available())
+    if spooled:
+        print(str('{0} OBSERVATIONS SPOOLED UNTIL THE DATABASE IS BACK').format(spooled))
+    return fetched
+
+def collect(conf, wu, dbw):
+    """Run one collection cycle over every configured location
+    wu: WeatherUnderground wrapper used for the geolookups
+    dbw: connected WeatherUpdateDatabase with the tables set up, used for the PWS rows
+    returns: (merged station list, number of observations fetched)"""
+    locations = configured_locations(conf)
+    stations = wu.get_nearby_pws_for_locations(locations)
+    print(str('{0} LOCATIONS, {1} UNIQUE PWS').format(len(locations), len(stations)))
+
+    # Stations go in first, observations reference them
+    src.weather_store.store_pws(dbw, conf, stations)
+
+    # Deal the stations out round robin, one chunk per process
+    process_count = max(1, min(conf.values['collector_processes'], len(stations)))
+    station_ids = [pws_info.id for pws_info in stations]
+    chunks = [station_ids[start::process_count] for start in range(process_count)]
+
+    if conf.values['use_store_pipeline']:
+        fetched = fetch_through_pipeline(conf, wu, chunks)
+    elif process_count == 1:
+        fetched = fetch_and_store(conf.values, chunks[0], wu.limiter)
+    else:
+        with src.wu_rate_limiter.QuotaManager() as manager, multiprocessing.Pool(process_count) as pool:
+            limiter = shared_limiter(manager, wu)
+            try:
+                fetched = sum(pool.starmap(fetch_and_store, [(conf.values, chunk, limiter) for chunk in chunks]))
+            finally:
+                # Whatever the workers spent counts against this process's quota too
+                wu.limiter.set_available(limiter.available())
+
+    src.weather_store.rollup_after_insert(dbw, conf, None)
+    return (stations, fetched)
@@ -0,0 +1,112 @@
+"""This module holds the HTTP client behind the WeatherUnderground REST calls.  One keep-alive
+session is shared by every call, each attempt has connect and read timeouts, responses are
+gzip compressed, and failed attempts are retried with jittered backoff inside an overall
+deadline.  So a hung or flaky station costs a bounded amount of time rather than the run"""
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import src.wu_metrics
+
+# Status codes worth another attempt.  Other 4xx (429 rate limiting included) are final,
+# retrying them would only burn more quota
+RETRY_STATUS_CODES = frozenset([500, 502, 503, 504])
+
+class WeatherHttpClient():
+    """Pooled, retrying HTTP GET client.  Every attempt takes its own token from the quota
+    limiter passed in, so retries and hedges stay within the API quotas"""
+
+    def __init__(self, conf):
+        """Initialize the client.  requests is only imported here, so offline runs that
+        never build a client do not need it
+        conf: WeatherConfig"""
+        import requests
+        import requests.adapters
+        self.requests = requests
+        self.connect_timeout = conf.values['http_connect_timeout_s']
+        self.read_timeout = conf.values['http_read_timeout_s']
+        self.max_retries = conf.values['http_max_retries']
+        self.backoff_base = conf.values['http_backoff_base_s']
+        self.backoff_max = conf.values['http_backoff_max_s']
+        self.deadline = conf.values['http_deadline_s']
+        self.hedge_after = conf.values['http_hedge_after_s']
+
+        # Enough pooled connections for every fetch worker plus its hedge
+        pool_size = conf.values['http_pool_size']
+        self.session = requests.Session()
+        # Retries are done here, where they can take quota and respect the deadline
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        self.hedge_executor = None
+        if self.hedge_after is not None:
+            self.hedge_executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def close(self):
+        """Close the pooled connections"""
+        if self.hedge_executor is not None:
+            self.hedge_executor.shutdown(wait=False)
+        self.session.close()
+
+    def backoff(self, attempt):
+        """Seconds to sleep before retry number 'attempt' (from 0): full jitter over an
+        exponentially growing window, so workers that failed together retry apart"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def fetch(self, query):
+        """One attempt.  Returns the body, raises on a timeout, a dropped connection or an
+        error status"""
+        response = self.session.get(query, timeout=(self.connect_timeout, self.read_timeout))
+        response.raise_for_status()
+        return response.content
+
+    def fetch_hedged(self, query, limiter):
+        """One attempt, with a second identical request sent if the first has not answered
+        within hedge_after seconds.  The hedge only goes out if the quota has a token to
+        spare right now, and whichever answers first wins"""
+        primary = self.hedge_executor.submit(self.fetch, query)
+        done, pending = wait([primary], timeout=self.hedge_after)
+        if done or not limiter.try_acquire():
+            return primary.result()
+
+        src.wu_metrics.METRICS.increment('rest_hedges')
+        src.wu_metrics.METRICS.increment('api_quota_used')
+        hedge = self.hedge_executor.submit(self.fetch, query)
+        futures = [primary, hedge]
+        while futures:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None:
+                    if future is hedge:
+                        src.wu_metrics.METRICS.increment('rest_hedge_wins')
+                    # The other request finishes in the background, its answer is dropped
+                    return future.result()
+                if not futures:
+                    return future.result()
+
+    def get(self, query, limiter):
+        """GET query and return the response body
+        limiter: src.wu_rate_limiter.QuotaLimiter each attempt takes a token from
+        Raises the last error once the retries or the deadline run out"""
+        give_up_at = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            # Blocks until the per minute and per day quotas allow another call
+            limiter.acquire()
+            src.wu_metrics.METRICS.increment('api_quota_used')
+            try:
+                if self.hedge_executor is not None:
+                    return self.fetch_hedged(query, limiter)
+                return self.fetch(query)
+            except (self.requests.ConnectionError, self.requests.Timeout, self.requests.HTTPError) as e:
+                status = e.response.status_code if getattr(e, 'response', None) is not None else None
+                if status is not None and status not in RETRY_STATUS_CODES:
+                    raise
+                delay = self.backoff(attempt)
+                # Only retry if another full attempt still fits in the deadline
+                if attempt >= self.max_retries or time.monotonic() + delay + self.connect_timeout + self.read_timeout > give_up_at:
+                    raise
+                src.wu_metrics.METRICS.increment('rest_retries')
+                attempt += 1
+                time.sleep(delay)
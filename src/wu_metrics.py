@@ -0,0 +1,153 @@
+"""This module holds the hot path instrumentation for the WeatherUnderground scripts.  It
+counts and times REST calls, SQL statements, commits and parses, and can export the
+totals as a JSON snapshot file or a Prometheus text endpoint.  When disabled (the
+default) every hook returns straight away"""
+import json
+import logging
+import os
+import threading
+import time
+
+class Metrics():
+    """Per operation counters: calls, total and max seconds, bytes moved"""
+
+    def __init__(self):
+        """Initialize empty (and disabled)"""
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # name -> [count, total seconds, max seconds, bytes]
+        self.operations = {}
+        # name -> value, for plain counters such as API quota used
+        self.counters = {}
+
+    def start(self):
+        """Start timing an operation.  Returns None when disabled, pass it to observe()"""
+        if not self.enabled:
+            return None
+        return time.perf_counter()
+
+    def observe(self, name, start, nbytes=0):
+        """Record one operation that began at start (from start())"""
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            stats[3] += nbytes
+
+    def increment(self, name, amount=1):
+        """Add to a plain counter"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self):
+        """Everything recorded so far as a dict"""
+        with self.lock:
+            operations = {name: {'count': stats[0], 'seconds_total': round(stats[1], 6),
+                                 'seconds_max': round(stats[2], 6), 'bytes_total': stats[3]}
+                          for name, stats in self.operations.items()}
+            counters = dict(self.counters)
+        return {'timestamp': time.time(), 'uptime_s': round(time.time() - self.started, 3),
+                'operations': operations, 'counters': counters}
+
+    def write_json(self, path):
+        """Write the snapshot with temp-file-and-rename so readers never see half a file"""
+        import tempfile
+        folder = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        with os.fdopen(fd, 'w') as temp_file:
+            json.dump(self.snapshot(), temp_file, indent=2)
+        os.replace(temp_path, path)
+
+    def prometheus_text(self):
+        """The snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+        for name, stats in sorted(snapshot['operations'].items()):
+            lines.append(str('# TYPE wu_{0}_total counter').format(name))
+            lines.append(str('wu_{0}_total {1}').format(name, stats['count']))
+            lines.append(str('# TYPE wu_{0}_seconds_total counter').format(name))
+            lines.append(str('wu_{0}_seconds_total {1}').format(name, stats['seconds_total']))
+            lines.append(str('# TYPE wu_{0}_seconds_max gauge').format(name))
+            lines.append(str('wu_{0}_seconds_max {1}').format(name, stats['seconds_max']))
+            lines.append(str('# TYPE wu_{0}_bytes_total counter').format(name))
+            lines.append(str('wu_{0}_bytes_total {1}').format(name, stats['bytes_total']))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(str('# TYPE wu_{0}_total counter').format(name))
+            lines.append(str('wu_{0}_total {1}').format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        """Serve /metrics (Prometheus) and /metrics.json on localhost:port from a daemon thread"""
+        # Only loaded when serving, it pulls in a good part of the email package
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.snapshot()).encode('utf-8'), 'application/json'
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+class SampledLog():
+    """Debug logger that only emits every Nth message, for per statement/per request echo"""
+
+    # Shared rate, set from WeatherConfig by configure()
+    sample_every = 1
+
+    def __init__(self, name):
+        self.log = logging.getLogger(name)
+        self.seen = 0
+
+    def enabled(self):
+        """True if DEBUG is on for this logger (check before building the message)"""
+        return self.log.isEnabledFor(logging.DEBUG)
+
+    def debug(self, message, *args):
+        """Log message at DEBUG if this is a sampled call and DEBUG is on"""
+        if not self.log.isEnabledFor(logging.DEBUG):
+            return
+        self.seen += 1
+        if self.seen % SampledLog.sample_every == 0:
+            self.log.debug(message, *args)
+
+# Shared by every module in the process
+METRICS = Metrics()
+
+def configure(conf):
+    """Set up logging and the metrics exports from WeatherConfig"""
+    logging.basicConfig(level=conf.values['log_level'], format='%(name)s %(levelname)s: %(message)s')
+    SampledLog.sample_every = max(1, int(conf.values['debug_log_sample_every']))
+    METRICS.enabled = conf.values['metrics_enabled']
+    if METRICS.enabled and conf.values['metrics_port']:
+        METRICS.serve(conf.values['metrics_port'])
+
+def finish(conf):
+    """Write the JSON snapshot, if one is configured.  Call at the end of a run"""
+    if METRICS.enabled and conf.values['metrics_json_path']:
+        METRICS.write_json(conf.values['metrics_json_path'])
@@ -1,53 +1,43 @@
 """This module implements a thin wrapper for MySQLdb for the WeatherUnderground scripts"""
 import MySQLdb
-
-class WeatherUpdateDatabase():
-    """Thin wrapper class for MySQLdb for use with weather data.  The goal is to have
-    this as generic as possible, so it could be resused"""
-
-    def __init__(self):
-        """Initialize the SQL wrapper"""
-        self.db = None
-        self.cursor = None
-        self.dbname = None
-        self.verbose = True
-
-    def connect(self, hostname, username, password):
-        """Connect to an instance of MySQL"""
+import MySQLdb.cursors
+import src.wu_storage
+
+class WeatherUpdateDatabase(src.wu_storage.WeatherStorage):
+    """Thin wrapper class for MySQLdb for use with weather data.  The shared SQL lives in
+    src.wu_storage.WeatherStorage, this adds the MySQL connection and schema lookups"""
+
+    # SQL templates by (statement kind, table, columns...), shared by every connection
+    statements = {}
+    placeholder = '%s'
+    autokey_definition = '{0} integer primary key auto_increment'
+    table_options = ' ENGINE=InnoDB'
+    insert_ignore = 'INSERT IGNORE INTO'
+    driver_error = MySQLdb.Error
+    upsert_clause = 'ON DUPLICATE KEY UPDATE'
+    new_value = 'VALUES({0})'
+    least_function = 'LEAST'
+    greatest_function = 'GREATEST'
+    supports_partitioning = True
+
+    # Partitions below the first month and past the last month of a partitioned table
+    PARTITION_OLDEST = 'p_old'
+    PARTITION_FUTURE = 'pmax'
+
+    def connect(self, hostname, username, password, database_name=None):
+        """Connect to an instance of MySQL, optionally selecting an existing database"""
         if self.verbose:
             print(str("CONNECTING TO SQL HOST {0}, User:{1}, Pass:*****").format(hostname, username))
 
         # Pass through to MySQLdb
-        self.db = MySQLdb.connect(host=hostname, user=username, passwd=password)
+        if database_name is None:
+            self.db = MySQLdb.connect(host=hostname, user=username, passwd=password)
+        else:
+            self.db = MySQLdb.connect(host=hostname, user=username, passwd=password, db=database_name)
+            self.dbname = database_name
         # Save our cursor
         self.cursor = self.db.cursor()
 
-    def close_connection(self):
-        """Close the current connection"""
-        if self.verbose:
-            print('CLOSING DATABASE...')
-        self.db.close()
-
-    def execute(self, sql):
-        """Execute the given SQL statement"""
-        # This is extremely useful when debugging constructed SQL statements that are failing
-        if self.verbose:
-            print('SQL: ' + sql)
-        self.cursor.execute(sql)
-
-    def commit(self):
-        """Attempt to commit the database, exceptions are rolled back"""
-
-        try:
-            self.db.commit()
-            if self.verbose:
-                print('COMMITTED.')
-        except (MySQLdb.Error) as e:
-            print(e)
-            self.db.rollback()
-            if self.verbose:
-                print('ROLLED BACK.')
-
     def open_or_create_database(self, database_name):
         """Check if the database exists, and if it does not, create it.
         Either way, select the database for use"""
@@ -58,16 +48,13 @@ class WeatherUpdateDatabase():
         self.dbname = database_name
 
         # Check the schema for the existance of the database, should only be one by name
-        db_exists = False
-        sql = str('SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME = \'{0}\'').format(database_name)
-        self.execute(sql)
-        if self.cursor.rowcount == 1:
-            self.cursor.fetchall()
-            db_exists = True
+        sql = 'SELECT SCHEMA_NAME FROM INFORMATION_SCHEMA.SCHEMATA WHERE SCHEMA_NAME = %s'
+        self.execute(sql, (database_name,))
+        db_exists = len(self.cursor.fetchall()) == 1
+        if db_exists:
             if self.verbose:
                 print('OPENING DATABASE...')
-            
-        if not db_exists:
+        else:
             sql = str('CREATE DATABASE {0}').format(database_name)
             if self.verbose:
                 print('CREATING DATABASE...')
@@ -77,159 +64,127 @@ class WeatherUpdateDatabase():
         self.execute('USE ' + database_name)
         return not db_exists
 
-    def drop_table(self, table_name):
-        """Deletes the table from the database if it exists"""
-        sql = 'DROP TABLE IF EXISTS ' + table_name
-        self.execute(sql)
+    def index_exists(self, table_name, index_name):
+        """True if the table in the current database has an index with this name"""
+        sql = 'SELECT 1 FROM information_schema.statistics WHERE table_schema=%s AND table_name=%s AND index_name=%s'
+        self.execute(sql, (self.dbname, table_name, index_name))
+        return len(self.cursor.fetchall()) > 0
 
-    def open_or_create_table(self, table_name, autokey_name, *args):
-        """Create or open a table
-        table_name: name of the table
-        autokey_name: Table must have an integer autokey, use this name for it
-        *args: list of column definitions
-        """
-        if not self.table_exists(table_name): 
-            sql = str('CREATE TABLE {0} ({1} integer primary key auto_increment').format(table_name, autokey_name)
-            for arg in args:
-                sql += ', ' + arg
-            sql += ') ENGINE=InnoDB'
-            self.execute(sql)
-            return True
-        return False
-    
-    def add_foreign_key_constraint(self, table_name, key_name, refs_table_name, refs_col_id):
-        """Adds a foreign key constraint for a table.  This is used to prevent deletions on data
-        that references the key
+    def add_index(self, table_name, index_name, col_names, unique=False):
+        """Adds a (possibly unique) secondary index over the given columns
         table_name: name of the table
-        key_name: foreign key name
-        refs_table_name: table key is referencing
-        refs_col_id: col in referenced table for foreign key
-        """
-        sql = str("ALTER TABLE {0} ADD CONSTRAINT {1}_ref FOREIGN KEY ({1}) REFERENCES {2} ({3})").format(table_name, key_name, refs_table_name, refs_col_id)
+        index_name: name of the new index
+        col_names: list of column ids, in key order
+        unique: True to reject rows that duplicate the key"""
+        sql = str("ALTER TABLE {0} ADD {1}INDEX {2} ({3})").format(table_name, 'UNIQUE ' if unique else '', index_name, ', '.join(col_names))
         self.execute(sql)
 
+    def delete_duplicate_rows(self, table_name, autokey_name, col_names):
+        """Deletes rows that repeat the values of col_names, keeping the oldest (lowest
+        autokey) of each set.  Needed before a unique index can be added to existing data"""
+        sql = str("DELETE newer FROM {0} newer JOIN {0} older ON {1} AND newer.{2} > older.{2}").format(
+            table_name, ' AND '.join(str('newer.{0} = older.{0}').format(col_name) for col_name in col_names), autokey_name)
+        self.execute(sql)
+        return self.cursor.rowcount
+
     def table_exists(self, table_name):
         """True if the table exists in the current database"""
         # It's possible to have the same table name in another database, like when you switch
         # the name to test changes w/o destroying the old data.  Without the database name
         # this query will find those tables (and we don't care if they exist here)
-        sql = str("SELECT * FROM information_schema.tables WHERE table_name ='{0}' AND table_schema='{1}'").format(table_name, self.dbname)
-        self.execute(sql)
-        
-        if self.cursor.rowcount > 0:
-            self.cursor.fetchall()
-            return True
-        return False
-
-    def row_exists_in_table(self, table_name, column_id, column_value):
-        """True if the row exists in table"""
-        sql = str("SELECT * FROM {0} WHERE {1}='{2}'").format(table_name, column_id, column_value)
-        self.execute(sql)
-        
-        if self.cursor.rowcount > 0:
-            self.cursor.fetchall()
-            return True
-        return False
-
-    def get_row_in_table(self, table_name, column_id, column_value):
-        """Gets a single row in the table by column id.  This works only when the column id is
-        unique, which in our case it always will be (likely the station_id)"""
-        sql = str("SELECT * FROM {0} WHERE {1}='{2}'").format(table_name, column_id, column_value)
-        self.execute(sql)
-        
-        # If a row with the given column_id exists in the table, it will be fetched here
-        values = []
-        if self.cursor.rowcount > 0:
-            cols = self.cursor.fetchall()
-            values.extend(cols)
-
-        # fetchall returns a list of rows, however, there should only ever be 1 row here
-        # so we could use fetchone instead above, or just return the first item in fetchall
-        return values[0]
-    
-    def get_column_values_by_id(self, table_name, column_id):
-        """Gets all column values with the matching column id"""
-        sql = str('SELECT {0} FROM {1}').format(column_id, table_name)
-        self.execute(sql)
-
+        # Views are listed here too, those are left to view_exists
+        sql = "SELECT 1 FROM information_schema.tables WHERE table_name=%s AND table_schema=%s AND table_type='BASE TABLE'"
+        self.execute(sql, (table_name, self.dbname))
+        return len(self.cursor.fetchall()) > 0
+
+    def view_exists(self, view_name):
+        """True if the view exists in the current database"""
+        sql = 'SELECT 1 FROM information_schema.views WHERE table_name=%s AND table_schema=%s'
+        self.execute(sql, (view_name, self.dbname))
+        return len(self.cursor.fetchall()) > 0
+
+    def column_exists(self, table_name, col_name):
+        """True if the table in the current database has this column"""
+        sql = 'SELECT 1 FROM information_schema.columns WHERE table_schema=%s AND table_name=%s AND column_name=%s'
+        self.execute(sql, (self.dbname, table_name, col_name))
+        return len(self.cursor.fetchall()) > 0
+
+    def stream_cursor(self):
+        """Server side cursor, rows are read off the socket as they are fetched"""
+        return self.db.cursor(MySQLdb.cursors.SSCursor)
+
+    # Monthly RANGE partitions.  MySQL requires every unique key of a partitioned table to
+    # include the partition column, and partitioned InnoDB tables cannot have foreign keys
+    # (either way).  So the autokey becomes PRIMARY KEY (autokey, partition col), and the
+    # reference to the stations has to be kept by the caller
+    def lock_rows_by_column_id(self, table_name, query_key_name, query_key_value, col_data):
+        """Same as get_rows_by_column_id, also write locking the rows until the transaction
+        ends.  A locking read sees the latest committed rows, not the transaction's snapshot"""
+        sql = self.cached_statement(('lock_rows', table_name, query_key_name) + tuple(col_data),
+                                    lambda: str('SELECT {0} FROM {1} WHERE {2}=%s FOR UPDATE').format(', '.join(col_data), table_name, query_key_name))
+        self.execute(sql, (query_key_value,))
         return self.cursor.fetchall()
 
-    # SELECT col_id0 [, col_id1, cold_id2, ...] FROM table_id WHERE pk_id=pk_val)
-    # SELECT weather, temp_f, relative_humidity, city, time FROM {0} WHERE station_id = \'{1}\'').format('weather_nearby', station_id)
-    def get_rows_by_column_id(self, table_name, query_key_name, query_key_value, col_data):
-        """Gets a list of rows of the specified columns given a column id
-        table_name: name of the table
-        query_key_name: col id that is the pivot
-        query_key_value: value to pivot on
-        col_data: list of column ids to return
-        """
-        # Used to look up weather data for a given station id
-        sql = "SELECT "
-        for col_id in col_data:
-            sql += col_id + ','
-
-        # Strip off that last ,
-        sql = sql[:-1]
-
-        sql += ' FROM ' + table_name + ' WHERE ' + query_key_name + '=\'' + str(query_key_value) + '\''
-        self.execute(sql)
-        return self.cursor.fetchall()
-
-    # "INSERT INTO table_id(col0_name[, col1_name...]) VALUES(val_0 [, val_1, ...])"
-    def add_row_to_table(self, table_name, col_data):
-        """Add a new row into the table
-        table_name: name of the table
-        col_data: list of tuples that contain column (id, val, quote?)"""
-
-        arg_count = len(col_data)
-        tups = col_data
-        
-        # The trick here is building the INSERT and VALUE portions of the SQL
-        # separately, then joining them
-        sqlfront = str("INSERT INTO {0}(").format(table_name)
-        sqlvalues = str("VALUES(")
-
-        for value_index in range(arg_count):
-            sqlfront += str("{0}").format(tups[value_index][0])
-            if tups[value_index][2]: # Quote enclosed
-                sqlvalues += "'" +  tups[value_index][1] + "'"
-            else:
-                sqlvalues += str("{0}").format(tups[value_index][1])
-
-            # Next in sequence, or cap off the end of the strings
-            if value_index != arg_count-1:
-                sqlfront += ", "
-                sqlvalues += ", "
-            else:
-                sqlfront += ") "
-                sqlvalues += ")"
-
-        # Now join the INSERT and VALUE strings and execute
-        sql = sqlfront + sqlvalues
-        self.execute(sql)
-
-    # "UPDATE table_name SET col0_name=val_0 [, col1_name=val_1, ...] WHERE primary_key_name=primary_key_value"
-    def update_row_by_primary_key(self, table_name, primary_key_name, primary_key_value, col_data):
-        """Update an existing row, specified by its primary key
-        table_name: name of the table
-        col_data: list of tuples that contain column (id, val, quote?)"""
-        # Slightly easier than the insert case, since we set the values as we go in the SQL
-        arg_count = len(col_data)
-        tups = col_data
-        
-        sql = str("UPDATE {0} SET ").format(table_name)
-        
-        for value_index in range(arg_count):
-            if tups[value_index][2]: # Quote enclosed
-                sql += str("{0}='{1}'").format(tups[value_index][0], tups[value_index][1])
-            else:
-                sql += str("{0}={1}").format(tups[value_index][0], tups[value_index][1])
-            
-            if value_index != arg_count-1:
-                sql += ", "
-            else:
-                sql += " "
-
-        # Add the conditional to restrict to the row with the matching primary key value
-        sql += str("WHERE {0}='{1}'").format(primary_key_name, primary_key_value)
-        self.execute(sql)
+    def month_partition_specs(self, months):
+        """PARTITION clauses for one partition per month start in months, each holding that
+        month only.  Partitions are named pYYYYMM"""
+        return [str("PARTITION p{0} VALUES LESS THAN (TO_DAYS('{1}'))").format(
+            month.strftime('%Y%m'), src.wu_storage.add_months(month, 1).isoformat()) for month in months]
+
+    def partition_options(self, partition_col, months):
+        """PARTITION BY clause: everything before the first month, one partition per month,
+        then everything after"""
+        specs = [str("PARTITION {0} VALUES LESS THAN (TO_DAYS('{1}'))").format(self.PARTITION_OLDEST, months[0].isoformat())]
+        specs += self.month_partition_specs(months)
+        specs.append(str('PARTITION {0} VALUES LESS THAN MAXVALUE').format(self.PARTITION_FUTURE))
+        return str('PARTITION BY RANGE (TO_DAYS({0})) ({1})').format(partition_col, ', '.join(specs))
+
+    def partitioned_table_statement(self, table_name, autokey_name, col_defs, partition_col, months):
+        """CREATE TABLE for a table range partitioned by month on partition_col"""
+        return str('CREATE TABLE {0} ({1} integer auto_increment, {2}, PRIMARY KEY ({1}, {3})){4} {5}').format(
+            table_name, autokey_name, ', '.join(col_defs), partition_col, self.table_options,
+            self.partition_options(partition_col, months))
+
+    def partition_existing_table(self, table_name, autokey_name, partition_col, months, foreign_key_name=None):
+        """Convert an existing table to monthly partitions.  This rebuilds the whole table
+        foreign_key_name: constraint to drop first (partitioned tables cannot have one)"""
+        if foreign_key_name is not None:
+            self.execute(str('ALTER TABLE {0} DROP FOREIGN KEY {1}').format(table_name, foreign_key_name))
+        self.execute(str('ALTER TABLE {0} DROP PRIMARY KEY, ADD PRIMARY KEY ({1}, {2}) {3}').format(
+            table_name, autokey_name, partition_col, self.partition_options(partition_col, months)))
+
+    def get_partitions(self, table_name):
+        """List of (partition name, upper bound as TO_DAYS or 'MAXVALUE', approximate rows),
+        in order.  Empty if the table is not partitioned"""
+        sql = str('SELECT partition_name, partition_description, table_rows FROM information_schema.partitions '
+                  'WHERE table_schema=%s AND table_name=%s AND partition_name IS NOT NULL ORDER BY partition_ordinal_position')
+        self.execute(sql, (self.dbname, table_name))
+        return list(self.cursor.fetchall())
+
+    def add_month_partitions(self, table_name, partition_col, months):
+        """Split new months off the catch-all future partition.  It is normally empty, so
+        this is quick"""
+        specs = self.month_partition_specs(months)
+        specs.append(str('PARTITION {0} VALUES LESS THAN MAXVALUE').format(self.PARTITION_FUTURE))
+        self.execute(str('ALTER TABLE {0} REORGANIZE PARTITION {1} INTO ({2})').format(table_name, self.PARTITION_FUTURE, ', '.join(specs)))
+
+    def drop_partitions(self, table_name, partition_names):
+        """Drop whole partitions and every row in them.  This only touches metadata, so it is
+        quick whatever the size, and leaves no fragmentation behind"""
+        self.execute(str('ALTER TABLE {0} DROP PARTITION {1}').format(table_name, ', '.join(partition_names)))
+
+    def archive_partition(self, table_name, partition_name, archive_table_name):
+        """Move a partition's rows into a new, unpartitioned table of the same layout.  The
+        partition is swapped with the empty table, no rows are copied.  The partition is
+        left empty, drop it afterwards"""
+        self.execute(str('CREATE TABLE {0} LIKE {1}').format(archive_table_name, table_name))
+        self.execute(str('ALTER TABLE {0} REMOVE PARTITIONING').format(archive_table_name))
+        self.execute(str('ALTER TABLE {0} EXCHANGE PARTITION {1} WITH TABLE {2}').format(table_name, partition_name, archive_table_name))
+
+def connection_factory(hostname, username, password, database_name):
+    """Callable for src.wu_storage.WeatherConnectionPool that opens MySQL connections"""
+    def connect():
+        dbw = WeatherUpdateDatabase()
+        dbw.connect(hostname, username, password, database_name)
+        return dbw
+    return connect
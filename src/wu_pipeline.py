@@ -0,0 +1,230 @@
+"""This module overlaps fetching and storing.  Fetch workers push parsed observations into
+a bounded queue and a single store worker drains it in batches over its own connection.
+When the database is down, or the store worker is falling behind, batches go to an
+append-only spool file instead, and are replayed once the database keeps up again.  So a
+slow API never leaves the connection idle, and a slow or missing database never loses a
+reading"""
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import src.weather_store
+import src.wu_metrics
+import src.wu_records
+
+# Put on the queue by finish(), tells the store worker no more observations are coming
+STOP = None
+
+class ObservationSpool():
+    """Append-only file of observations, one JSON row per line.  Lines are only ever added,
+    and the file is emptied once everything in it is stored, so a crash at any point loses
+    at most a half written last line.  That line is cut off when the spool is opened, so
+    the next append starts on a line of its own"""
+
+    def __init__(self, path):
+        """Initialize the spool
+        path: spool file, created on the first append"""
+        self.path = path
+        self.count = 0
+        if os.path.exists(path):
+            self.truncate_torn_line()
+            with open(path, 'r', encoding='utf-8') as spool_file:
+                self.count = sum(1 for line in spool_file)
+
+    def truncate_torn_line(self):
+        """Cut the file back to its last complete line"""
+        with open(self.path, 'rb+') as spool_file:
+            size = spool_file.seek(0, os.SEEK_END)
+            end = size
+            # Look back from the end a block at a time for the last newline
+            while end > 0:
+                step = min(4096, end)
+                spool_file.seek(end - step)
+                newline = spool_file.read(step).rfind(b'\n')
+                if newline >= 0:
+                    end = end - step + newline + 1
+                    break
+                end -= step
+            if end < size:
+                print(str('CUTTING A HALF WRITTEN LINE ({0} BYTES) OFF {1}').format(size - end, self.path))
+                spool_file.truncate(end)
+
+    def __len__(self):
+        return self.count
+
+    def append(self, observations):
+        """Add observations to the end of the file and flush them to disk"""
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as spool_file:
+            for observation in observations:
+                spool_file.write(json.dumps(observation.row()) + '\n')
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+        self.count += len(observations)
+        src.wu_metrics.METRICS.increment('pipeline_spooled', len(observations))
+
+    def batches(self, batch_size):
+        """Yields lists of Observation records read back from the file, in the order spooled.
+        A last line cut short by a crash is skipped.  Lines that do not decode are copied to
+        <spool>.bad for a look by hand, and skipped"""
+        if not os.path.exists(self.path):
+            return
+        batch = []
+        with open(self.path, 'r', encoding='utf-8', errors='replace') as spool_file:
+            for line_number, line in enumerate(spool_file, 1):
+                if not line.endswith('\n'):
+                    break
+                try:
+                    observation = src.wu_records.Observation(*json.loads(line))
+                except (ValueError, TypeError) as e:
+                    print(str('SKIPPING SPOOL LINE {0} OF {1}, KEPT IN {1}.bad: {2}').format(line_number, self.path, e))
+                    with open(self.path + '.bad', 'a', encoding='utf-8') as bad_file:
+                        bad_file.write(line)
+                    continue
+                batch.append(observation)
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    def clear(self):
+        """Empty the file, once all of it is stored"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.count = 0
+
+class StorePipeline():
+    """Bounded queue between the fetch workers and one store worker thread"""
+
+    def __init__(self, conf, name, observation_queue=None, rollup=None):
+        """Initialize the pipeline
+        conf: WeatherConfig
+        name: spool file name under spool_dir, one per pipeline user (collector, daemon...)
+        observation_queue: queue to drain, e.g. a multiprocessing.Manager().Queue for fetch
+        workers in other processes (default a queue.Queue of pipeline_queue_size)
+        rollup: passed to store_observations (None follows the config)"""
+        self.conf = conf
+        self.rollup = rollup
+        self.queue = observation_queue if observation_queue is not None else queue.Queue(conf.values['pipeline_queue_size'])
+        self.spool = ObservationSpool(os.path.join(conf.values['spool_dir'], name + '.jsonl'))
+        self.batch_size = conf.values['pipeline_batch_size']
+        self.batch_wait = conf.values['pipeline_batch_wait_s']
+        self.high_water = int(conf.values['pipeline_queue_size'] * conf.values['pipeline_high_water'])
+        self.retry_interval = conf.values['pipeline_retry_s']
+
+        self.dbw = None
+        self.retry_at = 0.0
+        self.stored = 0
+        self.thread = None
+
+    def put(self, observation):
+        """Hand one observation to the store worker.  Blocks while the queue is full, which
+        holds the fetch workers back rather than growing memory"""
+        self.queue.put(observation)
+
+    def start(self):
+        """Start the store worker thread"""
+        self.thread = threading.Thread(target=self.run, name='store_pipeline', daemon=True)
+        self.thread.start()
+
+    def finish(self):
+        """Wait for the store worker to store (or spool) everything queued so far
+        returns: (observations stored, observations left in the spool)"""
+        self.queue.put(STOP)
+        self.thread.join()
+        return (self.stored, len(self.spool))
+
+    def next_batch(self):
+        """Up to batch_size observations, waiting at most batch_wait for the batch to fill
+        returns: (list of observations, True once STOP was seen)"""
+        batch = []
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                observation = self.queue.get(timeout=max(0.0, deadline - time.time()))
+            except queue.Empty:
+                break
+            if observation is STOP:
+                return (batch, True)
+            batch.append(observation)
+        return (batch, False)
+
+    def database(self):
+        """The store connection, reconnecting once the retry interval has passed
+        returns: the connected wrapper, None while the database is considered down"""
+        if self.dbw is None and time.time() >= self.retry_at:
+            try:
+                self.dbw = src.weather_store.connect_weather_database(self.conf)
+            except Exception as e:
+                print(str('STORE PIPELINE CANNOT CONNECT: {0}').format(e))
+                self.retry_at = time.time() + self.retry_interval
+        return self.dbw
+
+    def store(self, observations):
+        """Store a batch.  On failure the connection is dropped and retried later
+        returns: True if the batch was committed"""
+        dbw = self.database()
+        if dbw is None:
+            return False
+        try:
+            src.weather_store.store_observations(dbw, self.conf, observations, self.rollup)
+        except Exception as e:
+            print(str('STORE PIPELINE LOST THE DATABASE: {0}').format(e))
+            try:
+                dbw.close_connection()
+            except Exception:
+                pass
+            self.dbw = None
+            self.retry_at = time.time() + self.retry_interval
+            return False
+        self.stored += len(observations)
+        return True
+
+    def replay_spool(self):
+        """Store everything in the spool, then empty it.  Rows stored before a failure part
+        way through are stored again next time, the (station_id, time) key skips them"""
+        if not len(self.spool):
+            return
+        print(str('REPLAYING {0} SPOOLED OBSERVATIONS').format(len(self.spool)))
+        for batch in self.spool.batches(self.conf.values['insert_batch_size']):
+            if not self.store(batch):
+                return
+            src.wu_metrics.METRICS.increment('pipeline_replayed', len(batch))
+        self.spool.clear()
+
+    def run(self):
+        """Store worker body: drain the queue until STOP"""
+        # Whatever an earlier run could not store goes first
+        self.replay_spool()
+        stopping = False
+        while not stopping:
+            batch, stopping = self.next_batch()
+            if batch:
+                # While the database is down, or the backlog keeps growing, new batches only
+                # go to the spool so the queue keeps draining
+                if len(self.spool) or self.queue.qsize() >= self.high_water or not self.store(batch):
+                    self.spool.append(batch)
+            # Catch up from the spool once the queue is quiet and the database is back
+            if len(self.spool) and self.queue.qsize() < self.high_water and self.database() is not None:
+                self.replay_spool()
+        if self.dbw is not None:
+            self.dbw.close_connection()
+        if len(self.spool):
+            print(str('{0} OBSERVATIONS LEFT IN {1} FOR THE NEXT RUN').format(len(self.spool), self.spool.path))
+
+def fetch_into(wu, pws_ids, put, use_cache=True):
+    """Query several pws concurrently, handing each observation to put() as it is parsed
+    rather than collecting the whole run first
+    returns: number of observations fetched"""
+    workers = max(1, min(wu.fetch_max_workers, len(pws_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(lambda pws_id: put(wu.get_pws_weather_response(pws_id, use_cache)), pws_id)
+                   for pws_id in pws_ids]
+        # Surface the first failure once every query has had its go
+        for future in futures:
+            future.result()
+    return len(futures)
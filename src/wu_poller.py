@@ -0,0 +1,135 @@
+"""This module implements a long running poller that keeps its connections open and
+schedules each nearby PWS on its own adaptive interval"""
+import heapq
+import time
+import src.weather_store
+import src.wu_metrics
+
+class StationPoller():
+    """Polls each station on its own interval.  A station whose observation time moved
+    since the last query is polled more often, one that returned the same reading is
+    backed off, always within the bounds and the API quota from WeatherConfig"""
+
+    def __init__(self, wu, dbw, conf, pipeline=None):
+        """Initialize the poller
+        wu: WeatherUnderground wrapper (holds the quota limiter and response cache)
+        dbw: connected WeatherUpdateDatabase with the tables already set up
+        conf: WeatherConfig
+        pipeline: started src.wu_pipeline.StorePipeline to hand new readings to, instead
+        of storing them here between polls
+        """
+        self.wu = wu
+        self.dbw = dbw
+        self.conf = conf
+        self.pipeline = pipeline
+        self.start_interval = conf.values['poll_interval_s']
+        self.min_interval = conf.values['poll_min_interval_s']
+        self.max_interval = conf.values['poll_max_interval_s']
+        self.factor = conf.values['poll_backoff_factor']
+        self.refresh_interval = conf.values['response_cache_ttl']['geolookup']
+        self.per_call_s = max(60.0 / conf.values['api_calls_per_minute'], 24 * 60 * 60.0 / conf.values['api_calls_per_day'])
+
+        # station id -> {'interval', 'due', 'last_time'}
+        self.stations = {}
+        # (due, station id) - entries are stale once the station's 'due' has moved on
+        self.schedule = []
+        self.known_pws = None
+        self.next_refresh = 0.0
+
+    def quota_floor(self):
+        """Smallest interval that keeps every station within the sustained API quota"""
+        return max(self.min_interval, len(self.stations) * self.per_call_s)
+
+    def refresh_stations(self, now):
+        """Re-run the geolookup (served from the response cache within its TTL), store the
+        stations and bring the schedule in line with them"""
+        # If the geolookup fails, retry after the shortest interval rather than spinning
+        self.next_refresh = now + self.min_interval
+        nearby_pws = self.wu.get_nearby_pws_info()
+        if self.known_pws is None:
+            self.known_pws = src.weather_store.load_known_pws(self.dbw, self.conf)
+        src.weather_store.store_pws(self.dbw, self.conf, nearby_pws, self.known_pws)
+
+        # Keep the learned interval for stations we already had, new ones are due now
+        station_ids = [pws_info.id for pws_info in nearby_pws]
+        self.stations = {station_id: self.stations.get(station_id, {'interval': self.start_interval, 'due': now, 'last_time': None})
+                         for station_id in station_ids}
+        self.schedule = [(state['due'], station_id) for station_id, state in self.stations.items()]
+        heapq.heapify(self.schedule)
+        self.next_refresh = now + self.refresh_interval
+
+    def pop_due(self, now):
+        """Remove and return the ids of every station due at 'now'"""
+        due_ids = []
+        while self.schedule and self.schedule[0][0] <= now:
+            due, station_id = heapq.heappop(self.schedule)
+            state = self.stations.get(station_id)
+            if state is not None and state['due'] == due:
+                due_ids.append(station_id)
+        return due_ids
+
+    def reschedule(self, station_id, changed, now):
+        """Shrink the interval on a new reading, grow it on a stale one, then schedule"""
+        state = self.stations[station_id]
+        if changed:
+            state['interval'] = state['interval'] / self.factor
+        else:
+            state['interval'] = state['interval'] * self.factor
+        state['interval'] = min(self.max_interval, max(self.quota_floor(), state['interval']))
+        state['due'] = now + state['interval']
+        heapq.heappush(self.schedule, (state['due'], station_id))
+
+    def poll_once(self, now):
+        """Query every due station and store the readings that are new"""
+        if now >= self.next_refresh:
+            self.refresh_stations(now)
+
+        due_ids = self.pop_due(now)
+        if not due_ids:
+            return 0
+
+        # Skip the response cache, the point here is to see whether the station moved on
+        outcomes = self.wu.get_pws_weather_outcomes(due_ids, use_cache=False)
+
+        new_observations = []
+        for station_id, (observation, error) in zip(due_ids, outcomes):
+            if error is not None:
+                # Keep the station scheduled (backed off) so it is retried, the others go on
+                print(str('QUERY FOR {0} FAILED: {1}').format(station_id, error))
+                self.reschedule(station_id, False, now)
+                continue
+            changed = observation.time != self.stations[station_id]['last_time']
+            if changed:
+                self.stations[station_id]['last_time'] = observation.time
+                new_observations.append(observation)
+            self.reschedule(station_id, changed, now)
+
+        if self.pipeline is not None:
+            for observation in new_observations:
+                self.pipeline.put(observation)
+        elif new_observations:
+            src.weather_store.store_observations(self.dbw, self.conf, new_observations)
+        return len(new_observations)
+
+    def next_wakeup(self):
+        """Time of the next scheduled station or geolookup refresh, whichever is first"""
+        if self.schedule:
+            return min(self.schedule[0][0], self.next_refresh)
+        return self.next_refresh
+
+    def run(self):
+        """Poll until interrupted (Ctrl+C)"""
+        try:
+            while True:
+                try:
+                    stored = self.poll_once(time.time())
+                    if stored:
+                        print(str('{0} {1} NEW OBSERVATIONS').format('QUEUED' if self.pipeline is not None else 'STORED', stored))
+                except Exception as e:
+                    # One bad response or a dropped connection should not end the daemon
+                    print(e)
+                src.wu_metrics.finish(self.conf)
+
+                time.sleep(max(0.0, self.next_wakeup() - time.time()))
+        except KeyboardInterrupt:
+            print('POLLER STOPPED.')
@@ -0,0 +1,98 @@
+"""This module implements a token bucket limiter for the WeatherUnderground API quotas"""
+from multiprocessing.managers import SyncManager
+import threading
+import time
+
+class TokenBucket():
+    """A single token bucket.  Holds up to 'capacity' tokens and refills them evenly
+    over 'period' seconds"""
+
+    def __init__(self, capacity, period):
+        """Initialize the bucket full
+        capacity: maximum number of tokens (calls) allowed in the period
+        period: length of the period in seconds
+        """
+        self.capacity = float(capacity)
+        self.rate = self.capacity / float(period)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def refill(self, now):
+        """Add the tokens earned since the last refill, capped at capacity"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self):
+        """Seconds until a token is available (0 if one is available now)"""
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class QuotaLimiter():
+    """Thread safe limiter that enforces both the per minute and per day API quotas.
+    Every call to acquire() blocks until a token is available in both buckets"""
+
+    def __init__(self, calls_per_minute, calls_per_day, available=None):
+        """Initialize the limiter from the quotas in WeatherConfig
+        available: tokens left in each bucket (from available()), full buckets if not given"""
+        self.lock = threading.Lock()
+        self.buckets = [TokenBucket(calls_per_minute, 60), TokenBucket(calls_per_day, 24 * 60 * 60)]
+        self.calls_made = 0
+        if available is not None:
+            self.set_available(available)
+
+    def available(self):
+        """Tokens left in each bucket now (per minute, per day), so another limiter can carry
+        on with only the remaining allowance"""
+        with self.lock:
+            now = time.monotonic()
+            for bucket in self.buckets:
+                bucket.refill(now)
+            return [bucket.tokens for bucket in self.buckets]
+
+    def set_available(self, available):
+        """Set the tokens left in each bucket, e.g. after another limiter spent some"""
+        with self.lock:
+            now = time.monotonic()
+            for bucket, tokens in zip(self.buckets, available):
+                bucket.tokens = min(bucket.capacity, tokens)
+                bucket.last = now
+
+    def acquire(self):
+        """Block until a call is allowed by every bucket, then consume a token from each"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = 0.0
+                for bucket in self.buckets:
+                    bucket.refill(now)
+                    wait = max(wait, bucket.wait_time())
+
+                if wait == 0.0:
+                    for bucket in self.buckets:
+                        bucket.tokens -= 1
+                    self.calls_made += 1
+                    return
+
+            # Sleep outside the lock so other threads can check in
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Consume a token from each bucket only if every one has a token now
+        returns: True if the call is allowed, never blocks"""
+        with self.lock:
+            now = time.monotonic()
+            for bucket in self.buckets:
+                bucket.refill(now)
+            if any(bucket.wait_time() > 0.0 for bucket in self.buckets):
+                return False
+            for bucket in self.buckets:
+                bucket.tokens -= 1
+            self.calls_made += 1
+            return True
+
+class QuotaManager(SyncManager):
+    """Manager process that can serve one QuotaLimiter to several processes, so together
+    they stay within the quotas.  Being a SyncManager it also serves queues"""
+
+QuotaManager.register('QuotaLimiter', QuotaLimiter)
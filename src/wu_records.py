@@ -0,0 +1,61 @@
+"""This module holds the record types passed between the REST, store and report steps of the
+WeatherUnderground scripts.  They use __slots__, so an instance is a fixed block of
+attribute pointers rather than a dict, which is several times smaller per record"""
+from operator import attrgetter
+
+class Observation():
+    """One conditions reading, attributes named (and ordered) as the observation table's columns"""
+
+    __slots__ = ('station_id', 'time', 'weather', 'temp_f', 'temp_c', 'relative_humidity',
+                 'uv_index', 'precip_in', 'pressure_in', 'pressure_mb', 'latitude',
+                 'longitude', 'elevation', 'city', 'zip')
+
+    def __init__(self, station_id, time, weather, temp_f, temp_c, relative_humidity, uv_index, precip_in,
+                 pressure_in, pressure_mb, latitude, longitude, elevation, city, zip):
+        self.station_id = station_id
+        self.time = time
+        self.weather = weather
+        self.temp_f = temp_f
+        self.temp_c = temp_c
+        self.relative_humidity = relative_humidity
+        self.uv_index = uv_index
+        self.precip_in = precip_in
+        self.pressure_in = pressure_in
+        self.pressure_mb = pressure_mb
+        self.latitude = latitude
+        self.longitude = longitude
+        self.elevation = elevation
+        self.city = city
+        self.zip = zip
+
+    def row(self):
+        """Value tuple in column order, the shape add_rows_to_table expects"""
+        return OBSERVATION_ROW(self)
+
+    def __repr__(self):
+        return str('Observation({0}, {1})').format(self.station_id, self.time)
+
+# Reads every attribute in one C level call
+OBSERVATION_ROW = attrgetter(*Observation.__slots__)
+
+class Station():
+    """One PWS as returned by the geolookup, trimmed to the fields the scripts use"""
+
+    __slots__ = ('id', 'lat', 'lon', 'city', 'neighborhood', 'distance_km')
+
+    def __init__(self, id, lat, lon, city, neighborhood, distance_km):
+        self.id = id
+        self.lat = lat
+        self.lon = lon
+        self.city = city
+        self.neighborhood = neighborhood
+        self.distance_km = distance_km
+
+    @classmethod
+    def from_geolookup(cls, station_dict):
+        """Station from one entry of the geolookup's nearby_weather_stations list"""
+        return cls(str(station_dict['id']), float(station_dict['lat']), float(station_dict['lon']),
+                   str(station_dict['city']), str(station_dict['neighborhood']), station_dict['distance_km'])
+
+    def __repr__(self):
+        return str('Station({0}, {1}km)').format(self.id, self.distance_km)
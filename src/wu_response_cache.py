@@ -0,0 +1,117 @@
+"""This module implements an on-disk cache of server responses keyed by the query URL"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+class ResponseCache():
+    """URL keyed response cache.  Each response is stored in its own file, whose
+    modification time is when it was stored and whose size counts towards the limit.
+    Entries expire per endpoint type, and the least recently used entries are evicted
+    once the total size goes over the limit.  There is no shared index, so the collector's
+    worker processes can all read and write the same folder: eviction looks at every
+    file in it, whichever process wrote it.  Hits are only remembered in memory, by the
+    process that made them"""
+
+    # Left behind by older versions, which kept the entries in an index file
+    INDEX_NAME = 'index.json'
+    # Temp files older than this (seconds) were left by a crashed writer
+    STALE_TEMP_AGE = 60 * 60
+
+    def __init__(self, cache_dir, ttl_by_kind, max_bytes):
+        """Initialize the cache
+        cache_dir: folder to hold the cached responses (created if missing)
+        ttl_by_kind: dict of endpoint type (e.g. 'geolookup') to time to live in seconds
+        max_bytes: total size of the cached responses before eviction kicks in
+        """
+        self.cache_dir = cache_dir
+        self.ttl_by_kind = ttl_by_kind
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # key -> time of this process's last hit
+        self.last_used = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        try:
+            os.remove(os.path.join(self.cache_dir, self.INDEX_NAME))
+        except OSError:
+            pass
+
+    def key_for(self, url):
+        """The file name for a URL.  Hashed so the API key in the URL never hits the disk"""
+        return hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json'
+
+    def atomic_write(self, file_name, content):
+        """Write to a temp file in the same folder then rename over the target, so a reader
+        never sees a partially written file"""
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                temp_file.write(content)
+            os.replace(temp_path, os.path.join(self.cache_dir, file_name))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def get(self, url, kind, ignore_ttl=False):
+        """Return the cached bytes for the URL, or None if missing or expired
+        ignore_ttl: True to return stale entries (used when replaying offline)"""
+        key = self.key_for(url)
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(path, 'rb') as bin_file:
+                stored = os.fstat(bin_file.fileno()).st_mtime
+                now = time.time()
+                if not ignore_ttl and now - stored > self.ttl_by_kind.get(kind, 0):
+                    return None
+                content = bin_file.read()
+        except OSError:
+            return None
+
+        with self.lock:
+            self.last_used[key] = now
+        return content
+
+    def put(self, url, kind, content):
+        """Store the response bytes for the URL, then evict down to the size limit"""
+        key = self.key_for(url)
+        with self.lock:
+            self.atomic_write(key, content)
+            self.last_used[key] = time.time()
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes (caller holds the lock).
+        An entry was last used when it was stored, or when this process last hit it"""
+        entries = []
+        total = 0
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            if entry.name.endswith('.tmp'):
+                if now - stat.st_mtime > self.STALE_TEMP_AGE:
+                    self.remove(entry.name)
+                continue
+            total += stat.st_size
+            entries.append((max(stat.st_mtime, self.last_used.get(entry.name, 0)), stat.st_size, entry.name))
+        if total <= self.max_bytes:
+            return
+
+        for last_used, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            total -= size
+            self.remove(key)
+
+    def remove(self, file_name):
+        """Delete a file from the cache folder, another process may have beaten us to it"""
+        self.last_used.pop(file_name, None)
+        try:
+            os.remove(os.path.join(self.cache_dir, file_name))
+        except OSError:
+            pass
@@ -0,0 +1,244 @@
+"""This module is a local stand-in for the WeatherUnderground geolookup and conditions
+endpoints, for load and scale testing without network access or API quota.
+
+Run it with
+    python -m src.wu_simulator --stations 5000 --port 8080
+then set endpoint_host in weather_conf.py to 'http://localhost:8080'"""
+import argparse
+import collections
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import src.wu_station_index
+
+GEOLOOKUP_PATH = re.compile(r'^/api/[^/]+/geolookup/q/(-?[0-9.]+),(-?[0-9.]+)\.json$')
+CONDITIONS_PATH = re.compile(r'^/api/[^/]+/conditions/q/pws:([A-Za-z0-9_]+)\.json$')
+
+WEATHER_TYPES = ['Clear', 'Partly Cloudy', 'Mostly Cloudy', 'Overcast', 'Light Rain', 'Rain', 'Haze', 'Fog']
+DAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+class SimulatedStations():
+    """A fixed set of synthetic stations scattered around a center point.  Every station
+    reports on its own interval, and a reading stays the same until the next report, the
+    same way a real station looks when polled faster than it reports"""
+
+    def __init__(self, count, center_lat, center_lon, spread_km, sentinel_rate, seed=0):
+        """Initialize the stations
+        count: number of stations
+        center_lat, center_lon: middle of the area
+        spread_km: stations fall within this distance of the center
+        sentinel_rate: fraction of readings that carry '--' / -999 style values
+        seed: makes the station set repeatable between runs
+        """
+        self.sentinel_rate = sentinel_rate
+        self.seed = seed
+        self.stations = {}
+        self.index = src.wu_station_index.StationIndex(None)
+
+        rng = random.Random(seed)
+        km_per_deg_lon = src.wu_station_index.KM_PER_DEG_LAT * max(math.cos(math.radians(center_lat)), 1e-6)
+        for number in range(count):
+            # Uniform over the disc
+            km = spread_km * math.sqrt(rng.random())
+            angle = rng.random() * 2 * math.pi
+            station = {
+                'id': str('KSIM{0:06d}').format(number),
+                'neighborhood': str('Sim Neighborhood {0}').format(number % 500),
+                'city': str('Sim City {0}').format(number % 50),
+                'state': 'CA',
+                'country': 'US',
+                'lat': round(center_lat + km * math.sin(angle) / src.wu_station_index.KM_PER_DEG_LAT, 6),
+                'lon': round(center_lon + km * math.cos(angle) / km_per_deg_lon, 6),
+                # Extra fields used to generate readings, not part of the geolookup output
+                'report_s': rng.choice([60, 150, 300, 600, 900]),
+                'phase_s': rng.randrange(900),
+                'base_temp_f': rng.uniform(50, 75),
+                'elevation_ft': rng.randrange(0, 2000),
+                'zip': str('9{0:04d}').format(number % 10000),
+            }
+            self.stations[station['id']] = station
+            self.index.add_station(station)
+
+    def geolookup(self, lat, lon, radius_km, max_stations):
+        """Geolookup response: up to max_stations within radius_km, nearest first"""
+        nearby = self.index.within_radius(lat, lon, radius_km)[:max_stations]
+        station_dicts = []
+        for km, station in nearby:
+            station_dicts.append({
+                'neighborhood': station['neighborhood'], 'city': station['city'], 'state': station['state'],
+                'country': station['country'], 'id': station['id'], 'lat': station['lat'], 'lon': station['lon'],
+                'distance_km': int(round(km)), 'distance_mi': int(round(km * 0.621371)),
+            })
+        return {'response': {'version': '0.1'},
+                'location': {'type': 'CITY', 'lat': str(lat), 'lon': str(lon),
+                             'nearby_weather_stations': {'pws': {'station': station_dicts}}}}
+
+    def conditions(self, station_id, now):
+        """Conditions response for the station's most recent report at 'now', or None if
+        the station does not exist"""
+        station = self.stations.get(station_id)
+        if station is None:
+            return None
+
+        # Time of the last report, the reading is seeded by it so it only changes per report
+        reported = int((now - station['phase_s']) // station['report_s']) * station['report_s'] + station['phase_s']
+        rng = random.Random(zlib.crc32(str('{0}:{1}:{2}').format(self.seed, station_id, reported).encode('utf-8')))
+        local = time.localtime(reported)
+        offset = -time.altzone if local.tm_isdst > 0 else -time.timezone
+        rfc822 = str('{0}, {1:02d} {2} {3} {4:02d}:{5:02d}:{6:02d} {7}{8:02d}{9:02d}').format(
+            DAYS[local.tm_wday], local.tm_mday, MONTHS[local.tm_mon - 1], local.tm_year,
+            local.tm_hour, local.tm_min, local.tm_sec, '-' if offset < 0 else '+', abs(offset) // 3600, (abs(offset) % 3600) // 60)
+
+        # Daily temperature swing peaking mid afternoon, plus noise
+        hour = local.tm_hour + local.tm_min / 60.0
+        temp_f = station['base_temp_f'] + 12 * math.sin(2 * math.pi * (hour - 9) / 24) + rng.gauss(0, 1)
+        pressure_mb = 1013 + 8 * math.sin(2 * math.pi * reported / (5 * 24 * 3600)) + rng.gauss(0, 0.5)
+
+        precip = str('{0:.2f}').format(max(0.0, rng.gauss(0, 0.1)))
+        uv = str(max(0, int(round(8 * math.sin(math.pi * (hour - 6) / 14)))) if 6 <= hour <= 20 else 0)
+        temp_text = round(temp_f, 1)
+        # Some stations send placeholders instead of readings
+        if rng.random() < self.sentinel_rate:
+            precip = rng.choice(['--', '-999.00'])
+        if rng.random() < self.sentinel_rate:
+            temp_text = -999
+
+        return {'response': {'version': '0.1'},
+                'current_observation': {
+                    'station_id': station_id,
+                    'observation_time_rfc822': rfc822,
+                    'weather': rng.choice(WEATHER_TYPES),
+                    'temp_f': temp_text,
+                    'temp_c': round((temp_f - 32) * 5 / 9, 1) if temp_text != -999 else -999,
+                    'relative_humidity': str('{0}%').format(rng.randrange(10, 100)),
+                    'UV': uv,
+                    'precip_today_in': precip,
+                    'pressure_in': str('{0:.2f}').format(pressure_mb * 0.02953),
+                    'pressure_mb': str(int(round(pressure_mb))),
+                    'observation_location': {'latitude': str(station['lat']), 'longitude': str(station['lon']),
+                                             'elevation': str('{0} ft').format(station['elevation_ft']),
+                                             'city': station['city']},
+                    'display_location': {'zip': station['zip']},
+                }}
+
+class SimulatorSettings():
+    """Knobs for the server behaviour"""
+
+    def __init__(self, latency_ms, latency_jitter_ms, error_rate, calls_per_minute, geolookup_radius_km, geolookup_max):
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.error_rate = error_rate
+        # 0 turns the rate limit off
+        self.calls_per_minute = calls_per_minute
+        self.geolookup_radius_km = geolookup_radius_km
+        self.geolookup_max = geolookup_max
+        self.lock = threading.Lock()
+        self.recent_calls = collections.deque()
+
+    def over_rate_limit(self, now):
+        """Count the call, True if it goes over the per minute limit"""
+        if not self.calls_per_minute:
+            return False
+        with self.lock:
+            while self.recent_calls and now - self.recent_calls[0] >= 60:
+                self.recent_calls.popleft()
+            if len(self.recent_calls) >= self.calls_per_minute:
+                return True
+            self.recent_calls.append(now)
+            return False
+
+def make_handler(stations, settings):
+    """Request handler class bound to the station set and settings"""
+
+    class SimulatorHandler(BaseHTTPRequestHandler):
+        """Answers the geolookup and conditions URLs the way the real API does"""
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_error_json(self, status, error_type, description):
+            self.send_json(status, {'response': {'version': '0.1', 'error': {'type': error_type, 'description': description}}})
+
+        def do_GET(self):
+            now = time.time()
+            delay_ms = settings.latency_ms + random.uniform(0, settings.latency_jitter_ms)
+            if delay_ms > 0:
+                time.sleep(delay_ms / 1000.0)
+
+            if settings.over_rate_limit(now):
+                self.send_error_json(429, 'invalidkey', 'this key has exceeded the allowable rate limit')
+                return
+            if random.random() < settings.error_rate:
+                self.send_error_json(500, 'internal', 'simulated server error')
+                return
+
+            match = GEOLOOKUP_PATH.match(self.path)
+            if match:
+                self.send_json(200, stations.geolookup(float(match.group(1)), float(match.group(2)),
+                                                      settings.geolookup_radius_km, settings.geolookup_max))
+                return
+
+            match = CONDITIONS_PATH.match(self.path)
+            if match:
+                payload = stations.conditions(match.group(1), now)
+                if payload is None:
+                    self.send_error_json(200, 'Station:OFFLINE', 'The station you\'re looking for either doesn\'t exist or is simply offline right now.')
+                else:
+                    self.send_json(200, payload)
+                return
+
+            self.send_error_json(404, 'unknownfeature', 'not a geolookup or conditions query')
+
+        def log_message(self, format, *args):
+            # Per request logging would dominate the cost under load
+            pass
+
+    return SimulatorHandler
+
+def make_server(port, stations, settings):
+    """HTTP server (one thread per connection) on localhost:port, not started yet"""
+    return ThreadingHTTPServer(('127.0.0.1', port), make_handler(stations, settings))
+
+def main():
+    parser = argparse.ArgumentParser(description='Local WeatherUnderground geolookup/conditions simulator')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--stations', type=int, default=1000, help='number of synthetic stations')
+    parser.add_argument('--center', default='37.392089,-122.083347', help='lat,lon the stations surround')
+    parser.add_argument('--spread-km', type=float, default=30.0, help='stations fall within this distance of the center')
+    parser.add_argument('--sentinel-rate', type=float, default=0.02, help='fraction of readings with --/-999 values')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='fixed delay added to every response')
+    parser.add_argument('--latency-jitter-ms', type=float, default=0.0, help='random extra delay, 0 to this many ms')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered with HTTP 500')
+    parser.add_argument('--calls-per-minute', type=int, default=0, help='rate limit, 0 for none')
+    parser.add_argument('--geolookup-radius-km', type=float, default=40.0)
+    parser.add_argument('--geolookup-max', type=int, default=50, help='stations returned per geolookup')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    center = [float(value) for value in args.center.split(',')]
+    stations = SimulatedStations(args.stations, center[0], center[1], args.spread_km, args.sentinel_rate, args.seed)
+    settings = SimulatorSettings(args.latency_ms, args.latency_jitter_ms, args.error_rate, args.calls_per_minute,
+                                 args.geolookup_radius_km, args.geolookup_max)
+
+    server = make_server(args.port, stations, settings)
+    print(str('SIMULATING {0} PWS ON http://127.0.0.1:{1} (Ctrl+C TO STOP)').format(args.stations, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('SIMULATOR STOPPED.')
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
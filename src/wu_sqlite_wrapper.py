@@ -0,0 +1,112 @@
+"""This module implements a thin wrapper for the built-in sqlite3 module for the
+WeatherUnderground scripts.  The database is a single local file in WAL mode, so no
+server is needed and readers never block the writer"""
+import os
+import sqlite3
+import src.wu_storage
+
+class WeatherSqliteDatabase(src.wu_storage.WeatherStorage):
+    """Thin wrapper class for sqlite3 for use with weather data.  The shared SQL lives in
+    src.wu_storage.WeatherStorage, this adds the SQLite connection and schema lookups"""
+
+    # SQL templates by (statement kind, table, columns...), shared by every connection
+    statements = {}
+    placeholder = '?'
+    autokey_definition = '{0} INTEGER PRIMARY KEY AUTOINCREMENT'
+    table_options = ''
+    insert_ignore = 'INSERT OR IGNORE INTO'
+    driver_error = sqlite3.Error
+    # SQLite needs the conflicting unique key spelled out
+    upsert_clause = 'ON CONFLICT({0}) DO UPDATE SET'
+    new_value = 'excluded.{0}'
+    # The scalar (two argument) forms of MIN and MAX
+    least_function = 'MIN'
+    greatest_function = 'MAX'
+
+    def connect(self, path):
+        """Open (or create) the database file at path.  The journal is switched to WAL, which
+        persists in the file, and synchronous=NORMAL is safe under WAL: a crash can lose the
+        last commits but never corrupts the database"""
+        if self.verbose:
+            print(str("OPENING SQLITE DATABASE {0}").format(path))
+
+        folder = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        # The pool may hand a connection to a different thread than the one that opened it,
+        # but never to two at once
+        self.db = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.cursor = self.db.cursor()
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.fetchall()
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
+        self.cursor.execute('PRAGMA foreign_keys=ON')
+        self.dbname = path
+
+    def open_or_create_database(self, database_name):
+        """The file is the database, it was opened (or created) by connect()"""
+        if self.verbose:
+            print('OPENING DATABASE...')
+        return False
+
+    def index_exists(self, table_name, index_name):
+        """True if the table has an index with this name"""
+        sql = "SELECT 1 FROM sqlite_master WHERE type='index' AND tbl_name=? AND name=?"
+        self.execute(sql, (table_name, index_name))
+        return self.cursor.fetchone() is not None
+
+    def add_index(self, table_name, index_name, col_names, unique=False):
+        """Adds a (possibly unique) secondary index over the given columns
+        table_name: name of the table
+        index_name: name of the new index
+        col_names: list of column ids, in key order
+        unique: True to reject rows that duplicate the key"""
+        sql = str("CREATE {0}INDEX {1} ON {2} ({3})").format('UNIQUE ' if unique else '', index_name, table_name, ', '.join(col_names))
+        self.execute(sql)
+
+    def delete_duplicate_rows(self, table_name, autokey_name, col_names):
+        """Deletes rows that repeat the values of col_names, keeping the oldest (lowest
+        autokey) of each set.  Needed before a unique index can be added to existing data"""
+        sql = str("DELETE FROM {0} WHERE {1} NOT IN (SELECT MIN({1}) FROM {0} GROUP BY {2})").format(
+            table_name, autokey_name, ', '.join(col_names))
+        self.execute(sql)
+        return self.cursor.rowcount
+
+    def table_exists(self, table_name):
+        """True if the table exists in the database file"""
+        sql = "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?"
+        self.execute(sql, (table_name,))
+        return self.cursor.fetchone() is not None
+
+    def view_exists(self, view_name):
+        """True if the view exists in the database file"""
+        sql = "SELECT 1 FROM sqlite_master WHERE type='view' AND name=?"
+        self.execute(sql, (view_name,))
+        return self.cursor.fetchone() is not None
+
+    def column_exists(self, table_name, col_name):
+        """True if the table has this column"""
+        self.execute(str('PRAGMA table_info({0})').format(table_name))
+        return any(row[1] == col_name for row in self.cursor.fetchall())
+
+    def stream_cursor(self):
+        """sqlite3 cursors already step through the result as rows are fetched"""
+        return self.db.cursor()
+
+    def lock_rows_by_column_id(self, table_name, query_key_name, query_key_value, col_data):
+        """Same as get_rows_by_column_id, also taking the database's write lock until the
+        transaction ends.  SQLite has no row locks, writing the rows (unchanged) starts the
+        write transaction, so other writers wait for this one"""
+        sql = self.cached_statement(('lock_rows', table_name, query_key_name),
+                                    lambda: str('UPDATE {0} SET {1}={1} WHERE {1}=?').format(table_name, query_key_name))
+        self.execute(sql, (query_key_value,))
+        return self.get_rows_by_column_id(table_name, query_key_name, query_key_value, col_data)
+
+def connection_factory(path):
+    """Callable for src.wu_storage.WeatherConnectionPool that opens SQLite connections"""
+    def connect():
+        dbw = WeatherSqliteDatabase()
+        dbw.connect(path)
+        return dbw
+    return connect
@@ -0,0 +1,132 @@
+"""This module keeps a persistent grid index of every PWS the geolookup has returned, so
+radius and nearest station queries can be answered locally"""
+import json
+import math
+import os
+import tempfile
+import time
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEG_LAT = 111.2
+
+def distance_km(lat_a, lon_a, lat_b, lon_b):
+    """Great circle (haversine) distance between two points in km"""
+    lat_a, lon_a, lat_b, lon_b = map(math.radians, (lat_a, lon_a, lat_b, lon_b))
+    h = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(h)))
+
+class StationIndex():
+    """Stations bucketed into a lat/lon grid of cell_deg sized cells.  A radius query only
+    looks at the cells the circle overlaps.  Also remembers which points the geolookup
+    was run for, and when, so callers know when the local copy is too old"""
+
+    def __init__(self, path, cell_deg=0.05):
+        """Initialize the index, loading it from path if it exists
+        path: JSON file the index is saved to, None for an in-memory only index
+        cell_deg: size of a grid cell in degrees (0.05 is roughly 5km)
+        """
+        self.path = path
+        self.cell_deg = cell_deg
+        # station id -> station dict (as returned by the geolookup)
+        self.stations = {}
+        # (lat cell, lon cell) -> set of station ids
+        self.grid = {}
+        # list of {'lat', 'lon', 'fetched'} for every geolookup done
+        self.areas = []
+        self.load()
+
+    def cell_for(self, lat, lon):
+        """Grid cell holding the point"""
+        return (int(math.floor(lat / self.cell_deg)), int(math.floor(lon / self.cell_deg)))
+
+    def load(self):
+        """Read the saved index, if any"""
+        if self.path is None:
+            return
+        try:
+            with open(self.path, 'r') as index_file:
+                saved = json.load(index_file)
+        except (OSError, ValueError):
+            return
+
+        self.areas = saved.get('areas', [])
+        for station in saved.get('stations', []):
+            self.add_station(station)
+
+    def save(self):
+        """Write the index with temp-file-and-rename so a crash never leaves half a file"""
+        folder = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as temp_file:
+                json.dump({'areas': self.areas, 'stations': list(self.stations.values())}, temp_file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def add_station(self, station):
+        """Add or replace one station (dict with at least id, lat and lon)"""
+        station_id = str(station['id'])
+        old = self.stations.get(station_id)
+        if old is not None:
+            self.grid[self.cell_for(float(old['lat']), float(old['lon']))].discard(station_id)
+
+        self.stations[station_id] = station
+        self.grid.setdefault(self.cell_for(float(station['lat']), float(station['lon'])), set()).add(station_id)
+
+    def add_geolookup(self, lat, lon, stations):
+        """Record a geolookup around (lat, lon) and every station it returned"""
+        for station in stations:
+            self.add_station(station)
+        self.areas = [area for area in self.areas if (area['lat'], area['lon']) != (lat, lon)]
+        self.areas.append({'lat': lat, 'lon': lon, 'fetched': time.time()})
+
+    def area_is_fresh(self, lat, lon, ttl):
+        """True if a geolookup for this exact point was done within ttl seconds"""
+        now = time.time()
+        return any((area['lat'], area['lon']) == (lat, lon) and now - area['fetched'] <= ttl for area in self.areas)
+
+    def within_radius(self, lat, lon, radius_km):
+        """Stations within radius_km of the point, nearest first, as (distance_km, station)"""
+        lat_cells = int(math.ceil(radius_km / KM_PER_DEG_LAT / self.cell_deg))
+        # Cells get narrower towards the poles, so more of them are needed in longitude
+        cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+        lon_cells = int(math.ceil(radius_km / (KM_PER_DEG_LAT * cos_lat) / self.cell_deg))
+
+        # Only walk the cells when there are fewer of them than occupied cells, otherwise
+        # checking every station is cheaper
+        if (2 * lat_cells + 1) * (2 * lon_cells + 1) > len(self.grid):
+            candidates = self.stations.keys()
+        else:
+            center = self.cell_for(lat, lon)
+            # Wrap longitude cells around the antimeridian
+            lon_cells_total = int(round(360 / self.cell_deg))
+            lon_cell_min = -(lon_cells_total // 2)
+            candidates = set()
+            for lat_cell in range(center[0] - lat_cells, center[0] + lat_cells + 1):
+                for lon_cell in range(center[1] - lon_cells, center[1] + lon_cells + 1):
+                    wrapped = (lon_cell - lon_cell_min) % lon_cells_total + lon_cell_min
+                    candidates.update(self.grid.get((lat_cell, wrapped), ()))
+
+        found = []
+        for station_id in candidates:
+            station = self.stations[station_id]
+            km = distance_km(lat, lon, float(station['lat']), float(station['lon']))
+            if km <= radius_km:
+                found.append((km, station))
+
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+    def nearest(self, lat, lon, k):
+        """The k stations nearest the point, as (distance_km, station).  The search radius
+        doubles until k are found, everything inside the radius is known so those k are
+        the true nearest"""
+        radius_km = self.cell_deg * KM_PER_DEG_LAT
+        while True:
+            found = self.within_radius(lat, lon, radius_km)
+            if len(found) >= k or radius_km > math.pi * EARTH_RADIUS_KM:
+                return found[:k]
+            radius_km *= 2
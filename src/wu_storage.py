@@ -0,0 +1,519 @@
+"""This module holds the storage interface shared by the database wrappers for the
+WeatherUnderground scripts.  The SQL here is common to every backend, each backend fills
+in its driver and the few statements that differ (see wu_mysql_wrapper.py and
+wu_sqlite_wrapper.py)"""
+import datetime
+import queue
+import threading
+from contextlib import contextmanager
+import src.wu_metrics
+
+# Per statement echo, sampled (see debug_log_sample_every)
+SQL_LOG = src.wu_metrics.SampledLog('wu.sql')
+
+# Month helpers for the time partitioned tables
+def month_start(day):
+    """First day of the month holding day (a date or datetime), as a date"""
+    return datetime.date(day.year, day.month, 1)
+
+def add_months(day, months):
+    """First day of the month 'months' after (or before, if negative) the month of day"""
+    index = day.year * 12 + day.month - 1 + months
+    return datetime.date(index // 12, index % 12 + 1, 1)
+
+class WeatherStorage():
+    """Base class for the database wrappers.  The goal is to have this as generic as
+    possible, so it could be resused.  Values are always passed to the driver as
+    parameters, only table and column ids are built into the SQL"""
+
+    # SQL templates by (statement kind, table, columns...).  Each backend declares its own
+    # so templates with different placeholders never mix
+    statements = {}
+    # Parameter placeholder of the driver
+    placeholder = '%s'
+    # Column definition of the integer autokey, {0} is its name
+    autokey_definition = '{0} integer primary key auto_increment'
+    # Appended to CREATE TABLE
+    table_options = ''
+    # INSERT that skips rows colliding with a unique key
+    insert_ignore = 'INSERT IGNORE INTO'
+    # Exception type raised by the driver
+    driver_error = Exception
+    # Clause that turns an INSERT into an upsert, {0} is the comma separated unique key
+    upsert_clause = 'ON DUPLICATE KEY UPDATE'
+    # How an upsert assignment refers to the value that was being inserted, {0} is the column
+    new_value = 'VALUES({0})'
+    # Two argument minimum and maximum functions
+    least_function = 'LEAST'
+    greatest_function = 'GREATEST'
+    # True if tables can be range partitioned by month (see open_or_create_table)
+    supports_partitioning = False
+
+    def __init__(self):
+        """Initialize the SQL wrapper"""
+        self.db = None
+        self.cursor = None
+        self.dbname = None
+        self.verbose = True
+        # Per connection cache for schema dependent helpers (see weather_compact.py)
+        self.schema_info = {}
+
+    # Backend specific - connection and schema lookups
+    def open_or_create_database(self, database_name):
+        """Open the database, creating it if needed.  Returns True if it was created"""
+        raise NotImplementedError
+
+    def table_exists(self, table_name):
+        """True if the table exists in the current database"""
+        raise NotImplementedError
+
+    def view_exists(self, view_name):
+        """True if the view exists in the current database"""
+        raise NotImplementedError
+
+    def column_exists(self, table_name, col_name):
+        """True if the table in the current database has this column"""
+        raise NotImplementedError
+
+    def index_exists(self, table_name, index_name):
+        """True if the table in the current database has an index with this name"""
+        raise NotImplementedError
+
+    def add_index(self, table_name, index_name, col_names, unique=False):
+        """Adds a (possibly unique) secondary index over the given columns"""
+        raise NotImplementedError
+
+    def delete_duplicate_rows(self, table_name, autokey_name, col_names):
+        """Deletes rows that repeat the values of col_names, keeping the oldest"""
+        raise NotImplementedError
+
+    def stream_cursor(self):
+        """A cursor that does not buffer the whole result set"""
+        raise NotImplementedError
+
+    def lock_rows_by_column_id(self, table_name, query_key_name, query_key_value, col_data):
+        """Same as get_rows_by_column_id, also write locking the rows until the transaction
+        ends.  The values read are the latest committed ones"""
+        raise NotImplementedError
+
+    def partitioned_table_statement(self, table_name, autokey_name, col_defs, partition_col, months):
+        """CREATE TABLE for a table range partitioned by month on partition_col"""
+        raise NotImplementedError
+
+    # Common to every backend
+    def close_connection(self):
+        """Close the current connection"""
+        if self.verbose:
+            print('CLOSING DATABASE...')
+        self.db.close()
+
+    def execute(self, sql, params=None):
+        """Execute the given SQL statement, with placeholders filled from params"""
+        # This is extremely useful when debugging constructed SQL statements that are failing
+        if self.verbose and SQL_LOG.enabled():
+            SQL_LOG.debug('SQL: %s %s', sql, '' if params is None else tuple(params))
+        start = src.wu_metrics.METRICS.start()
+        if params is None:
+            self.cursor.execute(sql)
+        else:
+            self.cursor.execute(sql, params)
+        src.wu_metrics.METRICS.observe('sql', start)
+
+    def executemany(self, sql, rows):
+        """Execute the given parameterized SQL statement once per row of values, inside the
+        current transaction"""
+        if self.verbose:
+            SQL_LOG.debug('SQL: %s (%d ROWS)', sql, len(rows))
+        start = src.wu_metrics.METRICS.start()
+        self.cursor.executemany(sql, rows)
+        src.wu_metrics.METRICS.observe('sql', start)
+        src.wu_metrics.METRICS.increment('sql_rows', len(rows))
+
+    def cached_statement(self, key, build):
+        """Return the SQL template for key, building it with build() the first time"""
+        sql = self.statements.get(key)
+        if sql is None:
+            sql = build()
+            self.statements[key] = sql
+        return sql
+
+    def placeholders(self, count):
+        """'%s, %s, ...' (or '?, ?, ...') for count values"""
+        return ', '.join([self.placeholder] * count)
+
+    def commit(self, raise_errors=False):
+        """Attempt to commit the database, exceptions are rolled back
+        raise_errors: True to raise the error again after the rollback, for callers that
+        have to know the rows did not make it (e.g. to spool them)"""
+
+        try:
+            start = src.wu_metrics.METRICS.start()
+            self.db.commit()
+            src.wu_metrics.METRICS.observe('commit', start)
+            if self.verbose:
+                print('COMMITTED.')
+        except (self.driver_error) as e:
+            print(e)
+            self.db.rollback()
+            if self.verbose:
+                print('ROLLED BACK.')
+            if raise_errors:
+                raise
+
+    def drop_table(self, table_name):
+        """Deletes the table from the database if it exists"""
+        sql = 'DROP TABLE IF EXISTS ' + table_name
+        self.execute(sql)
+
+    def rename_table(self, table_name, new_table_name):
+        """Renames the table"""
+        self.execute(str('ALTER TABLE {0} RENAME TO {1}').format(table_name, new_table_name))
+
+    def add_column(self, table_name, col_definition):
+        """Adds a column to an existing table
+        col_definition: column id and type, e.g. 'zip VARCHAR(10)'"""
+        self.execute(str('ALTER TABLE {0} ADD COLUMN {1}').format(table_name, col_definition))
+
+    def create_view(self, view_name, select_sql):
+        """Creates a view over select_sql"""
+        self.execute(str('CREATE VIEW {0} AS {1}').format(view_name, select_sql))
+
+    def drop_view(self, view_name):
+        """Deletes the view from the database if it exists"""
+        self.execute('DROP VIEW IF EXISTS ' + view_name)
+
+    def open_or_create_table(self, table_name, autokey_name, *args, partition_by=None):
+        """Create or open a table
+        table_name: name of the table
+        autokey_name: Table must have an integer autokey, use this name for it
+        *args: list of column (and table constraint) definitions
+        partition_by: optional (column id, list of month start dates) to range partition the
+        new table by month on that column (backends with supports_partitioning only)
+        """
+        if not self.table_exists(table_name):
+            if partition_by is not None:
+                sql = self.partitioned_table_statement(table_name, autokey_name, args, partition_by[0], partition_by[1])
+            else:
+                sql = str('CREATE TABLE {0} ({1}').format(table_name, self.autokey_definition.format(autokey_name))
+                for arg in args:
+                    sql += ', ' + arg
+                sql += ')' + self.table_options
+            self.execute(sql)
+            return True
+        return False
+
+    def row_exists_in_table(self, table_name, column_id, column_value):
+        """True if the row exists in table"""
+        sql = self.cached_statement(('exists', table_name, column_id),
+                                    lambda: str("SELECT 1 FROM {0} WHERE {1}={2} LIMIT 1").format(table_name, column_id, self.placeholder))
+        self.execute(sql, (column_value,))
+        return self.cursor.fetchone() is not None
+
+    def get_row_in_table(self, table_name, column_id, column_value):
+        """Gets a single row in the table by column id.  This works only when the column id is
+        unique, which in our case it always will be (likely the station_id)"""
+        sql = self.cached_statement(('get_row', table_name, column_id),
+                                    lambda: str("SELECT * FROM {0} WHERE {1}={2}").format(table_name, column_id, self.placeholder))
+        self.execute(sql, (column_value,))
+
+        # There should only ever be 1 row here
+        return self.cursor.fetchall()[0]
+
+    def get_column_values_by_id(self, table_name, column_id):
+        """Gets all column values with the matching column id"""
+        sql = str('SELECT {0} FROM {1}').format(column_id, table_name)
+        self.execute(sql)
+
+        return self.cursor.fetchall()
+
+    def get_rows_keyed_by_column(self, table_name, key_name, col_data):
+        """Gets every row of the table in one query, as a dict keyed by a unique column
+        table_name: name of the table
+        key_name: unique column id to key the dict on
+        col_data: list of column ids for the value tuples
+        """
+        sql = str('SELECT {0}, {1} FROM {2}').format(key_name, ', '.join(col_data), table_name)
+        self.execute(sql)
+        return {row[0]: tuple(row[1:]) for row in self.cursor.fetchall()}
+
+    # SELECT col_id0 [, col_id1, cold_id2, ...] FROM table_id WHERE pk_id=pk_val)
+    # SELECT weather, temp_f, relative_humidity, city, time FROM {0} WHERE station_id = \'{1}\'').format('weather_nearby', station_id)
+    def get_rows_by_column_id(self, table_name, query_key_name, query_key_value, col_data):
+        """Gets a list of rows of the specified columns given a column id
+        table_name: name of the table
+        query_key_name: col id that is the pivot
+        query_key_value: value to pivot on
+        col_data: list of column ids to return
+        """
+        # Used to look up weather data for a given station id
+        sql = self.cached_statement(('get_rows', table_name, query_key_name) + tuple(col_data),
+                                    lambda: str('SELECT {0} FROM {1} WHERE {2}={3}').format(', '.join(col_data), table_name, query_key_name, self.placeholder))
+        self.execute(sql, (query_key_value,))
+        return self.cursor.fetchall()
+
+    # SELECT col_id0 [, col_id1, ...] FROM table_id WHERE key_id > %s ORDER BY key_id LIMIT %s
+    def get_rows_after_key(self, table_name, key_name, after_value, col_data, limit):
+        """Gets up to limit rows whose (indexed) key is past after_value, in key order.  Paging
+        on the key rather than OFFSET keeps every page an index range scan
+        table_name: name of the table
+        key_name: column id to page on, usually the autokey
+        after_value: last key already seen
+        col_data: list of column ids to return, the key first is handy for the next page
+        limit: rows per page"""
+        sql = self.cached_statement(('after_key', table_name, key_name) + tuple(col_data),
+                                    lambda: str('SELECT {0} FROM {1} WHERE {2}>{3} ORDER BY {2} LIMIT {3}').format(
+                                        ', '.join(col_data), table_name, key_name, self.placeholder))
+        self.execute(sql, (after_value, limit))
+        return self.cursor.fetchall()
+
+    # SELECT col_id0 [, ...] FROM table_id WHERE key_id=%s ORDER BY order_id DESC LIMIT 1
+    def get_last_row_by_column(self, table_name, key_name, key_value, order_name, col_data):
+        """Gets the row with the highest order_name value among those matching key_value, None
+        if there are none.  With an index on (key_name, order_name) this reads one entry
+        table_name: name of the table
+        key_name: column id to match
+        key_value: value to match
+        order_name: column id the last row is picked by
+        col_data: list of column ids to return"""
+        sql = self.cached_statement(('last_row', table_name, key_name, order_name) + tuple(col_data),
+                                    lambda: str('SELECT {0} FROM {1} WHERE {2}={3} ORDER BY {4} DESC LIMIT 1').format(
+                                        ', '.join(col_data), table_name, key_name, self.placeholder, order_name))
+        self.execute(sql, (key_value,))
+        return self.cursor.fetchone()
+
+    # SELECT col_id0 [, ...] FROM table_id WHERE key_id=%s AND range_id>=%s AND range_id<%s ORDER BY range_id LIMIT %s
+    def get_rows_in_range(self, table_name, key_name, key_value, range_name, start_value, end_value, col_data, limit):
+        """Gets up to limit rows matching key_value with start_value <= range_name < end_value,
+        in range_name order.  An index range scan with an index on (key_name, range_name)"""
+        sql = self.cached_statement(('range_rows', table_name, key_name, range_name) + tuple(col_data),
+                                    lambda: str('SELECT {0} FROM {1} WHERE {2}={3} AND {4}>={3} AND {4}<{3} ORDER BY {4} LIMIT {3}').format(
+                                        ', '.join(col_data), table_name, key_name, self.placeholder, range_name))
+        self.execute(sql, (key_value, start_value, end_value, limit))
+        return self.cursor.fetchall()
+
+    # SELECT key_id FROM table_id WHERE col_id < %s ORDER BY col_id LIMIT %s
+    def get_keys_before(self, table_name, key_name, col_name, before_value, limit):
+        """Gets up to limit key values of rows whose (indexed) col_name is before before_value,
+        oldest first.  Used to delete old rows a small chunk at a time"""
+        sql = self.cached_statement(('keys_before', table_name, key_name, col_name),
+                                    lambda: str('SELECT {0} FROM {1} WHERE {2}<{3} ORDER BY {2} LIMIT {3}').format(
+                                        key_name, table_name, col_name, self.placeholder))
+        self.execute(sql, (before_value, limit))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    # DELETE FROM table_id WHERE key_id IN (%s [, %s, ...])
+    def delete_rows_by_key(self, table_name, key_name, key_values):
+        """Deletes the rows with the given key values.  Nothing is committed here
+        returns: number of rows deleted"""
+        if not key_values:
+            return 0
+        sql = str('DELETE FROM {0} WHERE {1} IN ({2})').format(table_name, key_name, self.placeholders(len(key_values)))
+        self.execute(sql, tuple(key_values))
+        return self.cursor.rowcount
+
+    # SELECT col_id0 [, col_id1, ...] FROM table_id ORDER BY order_col0 [, order_col1, ...]
+    def stream_rows(self, table_name, col_data, order_by, chunk_size=1000):
+        """Generator over every row of the table in the given order.  Uses an unbuffered
+        cursor and fetches chunk_size rows at a time, so memory use does not grow with
+        the size of the table.  No other statement should run on this connection until
+        the generator is exhausted or closed
+        table_name: name of the table
+        col_data: list of column ids to return
+        order_by: list of column ids to sort on
+        chunk_size: rows held in memory at once"""
+        for rows in self.stream_chunks(table_name, col_data, order_by, chunk_size):
+            for row in rows:
+                yield row
+
+    # SELECT col_id0 [, ...] FROM table_id [WHERE key_id > %s AND key_id <= %s] ORDER BY order_col0 [, ...]
+    def stream_chunks(self, table_name, col_data, order_by, chunk_size=1000, key_range=None):
+        """Same as stream_rows, but yields the rows a chunk (list of up to chunk_size rows)
+        at a time
+        key_range: optional (key column id, after value, through value) to only return rows
+        with after < key <= through"""
+        sql = str('SELECT {0} FROM {1}').format(', '.join(col_data), table_name)
+        params = None
+        if key_range is not None:
+            sql += str(' WHERE {0}>{1} AND {0}<={1}').format(key_range[0], self.placeholder)
+            params = (key_range[1], key_range[2])
+        sql += ' ORDER BY ' + ', '.join(order_by)
+        if self.verbose:
+            SQL_LOG.debug('SQL: %s', sql)
+
+        stream_cursor = self.stream_cursor()
+        try:
+            if params is None:
+                stream_cursor.execute(sql)
+            else:
+                stream_cursor.execute(sql, params)
+            while True:
+                rows = stream_cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            stream_cursor.close()
+
+    # "INSERT INTO table_id(col0_name[, col1_name...]) VALUES(%s [, %s, ...])"
+    def add_row_to_table(self, table_name, col_data):
+        """Add a new row into the table
+        table_name: name of the table
+        col_data: list of tuples that contain column (id, val[, quote?]).  The quote flag is
+        no longer needed since values are passed as parameters, it is ignored"""
+        col_names = tuple(tup[0] for tup in col_data)
+        sql = self.cached_statement(('insert', table_name) + col_names,
+                                    lambda: str("INSERT INTO {0}({1}) VALUES({2})").format(table_name, ', '.join(col_names), self.placeholders(len(col_names))))
+        self.execute(sql, tuple(tup[1] for tup in col_data))
+
+    # "UPDATE table_name SET col0_name=%s [, col1_name=%s, ...] WHERE primary_key_name=%s"
+    def update_row_by_primary_key(self, table_name, primary_key_name, primary_key_value, col_data):
+        """Update an existing row, specified by its primary key
+        table_name: name of the table
+        col_data: list of tuples that contain column (id, val[, quote?]).  The quote flag is
+        ignored, as for add_row_to_table"""
+        col_names = tuple(tup[0] for tup in col_data)
+        sql = self.cached_statement(('update', table_name, primary_key_name) + col_names,
+                                    lambda: str("UPDATE {0} SET {1} WHERE {2}={3}").format(
+                                        table_name, ', '.join(str('{0}={1}').format(col_name, self.placeholder) for col_name in col_names),
+                                        primary_key_name, self.placeholder))
+        self.execute(sql, tuple(tup[1] for tup in col_data) + (primary_key_value,))
+
+    # "INSERT INTO table_id(col0_name[, col1_name...]) VALUES(%s [, %s...]), (...), ..."
+    def add_rows_to_table(self, table_name, col_names, rows, batch_size=500, ignore_duplicates=False):
+        """Add many new rows into the table, batch_size rows per statement.  Values are passed
+        to the driver as parameters, so no quoting or escaping is needed by the caller.
+        Nothing is committed here, call commit() once after the whole batch
+        table_name: name of the table
+        col_names: list of column ids
+        rows: list of value tuples, in the same order as col_names
+        ignore_duplicates: True to silently skip rows that collide with a unique key"""
+        if not rows:
+            return
+
+        sql = self.cached_statement(('insert_many', table_name, ignore_duplicates) + tuple(col_names),
+                                    lambda: str("{0} {1}({2}) VALUES({3})").format(self.insert_ignore if ignore_duplicates else 'INSERT INTO',
+                                                                                  table_name, ', '.join(col_names), self.placeholders(len(col_names))))
+        for start in range(0, len(rows), batch_size):
+            self.executemany(sql, rows[start:start + batch_size])
+
+    # "INSERT INTO table_id(col0_name[, ...]) VALUES(%s [, ...]) <upsert_clause> col0_name=<new_value> [, ...]"
+    def upsert_statement(self, table_name, col_names, key_names, assignments):
+        """SQL for an INSERT that applies assignments (list of 'col=expr') on a key collision"""
+        return str("INSERT INTO {0}({1}) VALUES({2}) {3} {4}").format(
+            table_name, ', '.join(col_names), self.placeholders(len(col_names)),
+            self.upsert_clause.format(', '.join(key_names or ())), ', '.join(assignments))
+
+    def upsert_rows_in_table(self, table_name, col_names, rows, update_col_names, batch_size=500, key_names=None):
+        """Insert rows, or update them in place when they collide with a unique key.  New and
+        changed rows all go in the same statement.  Nothing is committed here
+        table_name: name of the table
+        col_names: list of column ids
+        rows: list of value tuples, in the same order as col_names
+        update_col_names: columns to overwrite when the row already exists
+        key_names: the unique key columns rows collide on (required by some backends)"""
+        if not rows:
+            return
+
+        key = ('upsert', table_name, tuple(col_names), tuple(update_col_names), tuple(key_names or ()))
+        sql = self.cached_statement(key, lambda: self.upsert_statement(
+            table_name, col_names, key_names,
+            [str('{0}={1}').format(col_name, self.new_value.format(col_name)) for col_name in update_col_names]))
+        for start in range(0, len(rows), batch_size):
+            self.executemany(sql, rows[start:start + batch_size])
+
+    def merge_rows_in_table(self, table_name, col_names, rows, key_names, merge_ops, batch_size=500):
+        """Insert rows, or fold them into the existing row when they collide with a unique key.
+        Used for running aggregates, where a new partial result is combined with the stored
+        one.  Nothing is committed here
+        table_name: name of the table
+        col_names: list of column ids
+        rows: list of value tuples, in the same order as col_names
+        key_names: the unique key columns rows collide on
+        merge_ops: dict of column id to 'sum', 'min' or 'max'.  NULLs are ignored by min and
+        max, columns not listed are overwritten"""
+        if not rows:
+            return
+
+        def assignment(col_name):
+            old, new = col_name, self.new_value.format(col_name)
+            op = merge_ops.get(col_name)
+            if op == 'sum':
+                return str('{0}={0}+{1}').format(old, new)
+            elif op in ('min', 'max'):
+                function = self.least_function if op == 'min' else self.greatest_function
+                return str('{0}={1}(COALESCE({0}, {2}), COALESCE({2}, {0}))').format(old, function, new)
+            return str('{0}={1}').format(old, new)
+
+        key = ('merge', table_name, tuple(col_names), tuple(key_names), tuple(sorted(merge_ops.items())))
+        sql = self.cached_statement(key, lambda: self.upsert_statement(
+            table_name, col_names, key_names, [assignment(col_name) for col_name in col_names if col_name not in key_names]))
+        for start in range(0, len(rows), batch_size):
+            self.executemany(sql, rows[start:start + batch_size])
+
+class WeatherConnectionPool():
+    """Small pool of connected storage wrappers, one connection each, so concurrent
+    workers never share a connection or cursor.  Connections are opened on demand up to
+    'size', after that callers wait for one to be returned"""
+
+    def __init__(self, connect, size=4):
+        """Initialize the pool (no connections are opened yet)
+        connect: callable returning a new connected wrapper with the database selected"""
+        self.connect = connect
+        self.size = size
+        self.idle = queue.Queue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take an idle connection, open a new one if under size, otherwise wait"""
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if len(self.opened) < self.size:
+                dbw = self.connect()
+                self.opened.append(dbw)
+                return dbw
+
+        return self.idle.get()
+
+    def release(self, dbw):
+        """Hand a connection back to the pool"""
+        self.idle.put(dbw)
+
+    @contextmanager
+    def connection(self):
+        """with pool.connection() as dbw: ... - anything left uncommitted after an exception
+        is rolled back before the connection goes back in the pool"""
+        dbw = self.acquire()
+        try:
+            yield dbw
+        except Exception:
+            dbw.db.rollback()
+            raise
+        finally:
+            self.release(dbw)
+
+    @contextmanager
+    def read_connection(self):
+        """with pool.read_connection() as dbw: ... - for reads only.  The read transaction is
+        always ended before the connection goes back in the pool.  MySQL (autocommit off,
+        REPEATABLE READ) would otherwise keep answering from the snapshot taken by the
+        connection's first read, and never see rows stored since by other writers"""
+        dbw = self.acquire()
+        try:
+            yield dbw
+        finally:
+            try:
+                dbw.db.rollback()
+            finally:
+                self.release(dbw)
+
+    def close_all(self):
+        """Close every connection the pool opened"""
+        with self.lock:
+            for dbw in self.opened:
+                dbw.close_connection()
+            self.opened = []
@@ -0,0 +1,166 @@
+"""Tests for src/weather_area.py, skipped when numpy is not installed
+
+    python -m pytest tests
+    python -m unittest discover tests"""
+import datetime
+import math
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+if numpy is not None:
+    import src.weather_area
+    import src.wu_station_index
+
+NAN = float('nan')
+
+class FakeConf():
+    """Just the values load_slice and grid_axes read"""
+
+    def __init__(self):
+        self.values = {'area_step_minutes': 10, 'observation_table_name': 'weather_nearby', 'report_chunk_size': 2,
+                       'pws_table_name': 'pws_nearby', 'lat_lon': '37.0,-122.0', 'area_radius_km': None,
+                       'pws_max_distance_km': 3, 'area_grid_size': 5}
+
+class FakeStorage():
+    """Answers the two reads load_slice makes from canned rows"""
+
+    def __init__(self, observation_rows, pws):
+        self.observation_rows = observation_rows
+        self.pws = pws
+
+    def stream_chunks(self, table_name, col_data, order_by, chunk_size=1000, key_range=None):
+        rows = [row for row in sorted(self.observation_rows, key=lambda row: row[1])
+                if key_range[1] < row[1] <= key_range[2]]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+    def get_rows_keyed_by_column(self, table_name, key_name, col_data):
+        return dict(self.pws)
+
+@unittest.skipIf(numpy is None, 'needs numpy')
+class AreaStatisticsTest(unittest.TestCase):
+
+    def test_mean_median_and_outlier(self):
+        stats = src.weather_area.area_statistics(numpy.array([[70.0, 71.0, 72.0, 73.0, 200.0, NAN]]))
+        self.assertEqual(stats['count'][0], 5)
+        self.assertAlmostEqual(stats['mean'][0], 97.2)
+        self.assertAlmostEqual(stats['median'][0], 72.0)
+        # 200 is far outside the spread of the others
+        self.assertAlmostEqual(stats['robust_mean'][0], 71.5)
+        self.assertEqual(stats['outliers'][0], 1)
+
+    def test_mad_keeps_close_readings(self):
+        stats = src.weather_area.area_statistics(numpy.array([[70.0, 71.0, 72.0, 73.0, 74.0]]), outlier_z=3.5)
+        self.assertEqual(stats['outliers'][0], 0)
+        self.assertAlmostEqual(stats['robust_mean'][0], 72.0)
+
+    def test_zero_mad_falls_back_to_mean_deviation(self):
+        # Whole number readings, more than half of them equal: one off is not an outlier
+        stats = src.weather_area.area_statistics(numpy.array([[1007.0, 1007.0, 1007.0, 1008.0, 1008.0],
+                                                              [70.0, 70.0, 70.0, 70.0, 90.0],
+                                                              [70.0, 70.0, 70.0, 70.0, 70.0]]))
+        self.assertEqual(list(stats['outliers']), [0, 1, 0])
+        self.assertAlmostEqual(stats['robust_mean'][0], 1007.4)
+        self.assertAlmostEqual(stats['robust_mean'][1], 70.0)
+
+    def test_placeholders_are_not_readings(self):
+        stats = src.weather_area.area_statistics(numpy.array([[70.0, -999.0, 72.0, -9999.0]]))
+        self.assertEqual(stats['count'][0], 2)
+        self.assertAlmostEqual(stats['mean'][0], 71.0)
+        self.assertAlmostEqual(stats['median'][0], 71.0)
+        self.assertEqual(stats['outliers'][0], 0)
+
+    def test_step_without_readings(self):
+        stats = src.weather_area.area_statistics(numpy.array([[NAN, NAN], [1.0, 3.0]]))
+        self.assertEqual(list(stats['count']), [0, 2])
+        self.assertTrue(math.isnan(stats['mean'][0]) and math.isnan(stats['robust_mean'][0]))
+        self.assertAlmostEqual(stats['mean'][1], 2.0)
+
+@unittest.skipIf(numpy is None, 'needs numpy')
+class IdwGridTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lats = numpy.array([37.00, 37.02, 36.98])
+        self.lons = numpy.array([-122.00, -122.02, -121.97])
+        self.grid_lats = numpy.array([36.98, 37.00, 37.02])
+        self.grid_lons = numpy.array([-122.02, -122.00, -121.97])
+
+    def test_distance_matrix_matches_station_index(self):
+        distances = src.weather_area.distance_matrix_km(self.lats, self.lons, self.grid_lats, self.grid_lons)
+        for a in range(3):
+            for b in range(3):
+                self.assertAlmostEqual(distances[a, b], src.wu_station_index.distance_km(
+                    self.lats[a], self.lons[a], self.grid_lats[b], self.grid_lons[b]), places=9)
+
+    def test_grid(self):
+        values = numpy.array([[60.0, 70.0, 80.0],
+                              [60.0, NAN, -999.0],
+                              [NAN, NAN, NAN]])
+        grid = src.weather_area.IdwInterpolator(power=2.0).interpolate(values, self.lats, self.lons, self.grid_lats, self.grid_lons)
+        self.assertEqual(grid.shape, (3, 3, 3))
+        # A grid point on a station takes its reading, the rest stay within the readings
+        self.assertAlmostEqual(grid[0, 1, 1], 60.0, places=3)
+        self.assertAlmostEqual(grid[0, 2, 0], 70.0, places=3)
+        self.assertTrue(numpy.all((grid[0] >= 60.0) & (grid[0] <= 80.0)))
+        # Missing readings and placeholders are left out of their step
+        self.assertTrue(numpy.allclose(grid[1], 60.0))
+        self.assertTrue(numpy.all(numpy.isnan(grid[2])))
+
+    def test_grid_matches_direct_idw(self):
+        values = numpy.array([[60.0, 70.0, 80.0]])
+        grid = src.weather_area.IdwInterpolator(power=2.0).interpolate(values, self.lats, self.lons, self.grid_lats, self.grid_lons)
+        for row, lat in enumerate(self.grid_lats):
+            for col, lon in enumerate(self.grid_lons):
+                # Same floor as the interpolator's min_distance_km
+                weights = [max(src.wu_station_index.distance_km(lat, lon, s_lat, s_lon), 0.01) ** -2.0
+                           for s_lat, s_lon in zip(self.lats, self.lons)]
+                expected = sum(w * v for w, v in zip(weights, values[0])) / sum(weights)
+                self.assertAlmostEqual(grid[0, row, col], expected, places=9)
+
+    def test_weights_cached_per_station_set(self):
+        interpolator = src.weather_area.IdwInterpolator(max_cached=1)
+        weights = interpolator.weights(self.lats, self.lons, self.grid_lats, self.grid_lons)
+        self.assertIs(interpolator.weights(self.lats.copy(), self.lons.copy(), self.grid_lats, self.grid_lons), weights)
+        interpolator.weights(self.lats[:2], self.lons[:2], self.grid_lats, self.grid_lons)
+        self.assertEqual(len(interpolator.weight_cache), 1)
+        self.assertIsNot(interpolator.weights(self.lats, self.lons, self.grid_lats, self.grid_lons), weights)
+
+    def test_grid_axes(self):
+        lats, lons = src.weather_area.grid_axes(FakeConf())
+        self.assertEqual((len(lats), len(lons)), (5, 5))
+        self.assertAlmostEqual(lats[2], 37.0)
+        self.assertAlmostEqual(lons[2], -122.0)
+        self.assertAlmostEqual(src.wu_station_index.distance_km(lats[0], -122.0, lats[-1], -122.0), 6.0, places=1)
+
+@unittest.skipIf(numpy is None, 'needs numpy')
+class LoadSliceTest(unittest.TestCase):
+
+    def test_readings_bucketed_by_step_and_station(self):
+        rows = [('KB', '2017-07-16 10:01:00', 70.0, 50, 1013.0),
+                ('KA', '2017-07-16 10:02:00', 68.0, 55, 1012.0),
+                ('KA', '2017-07-16 10:08:00', 69.0, 56, -9999.0),
+                ('KA', '2017-07-16 10:15:00', -999.0, 57, 1011.0),
+                ('KC', '2017-07-16 10:05:00', 99.0, 10, 1000.0),
+                ('KB', '2017-07-16 10:20:00', 72.0, 52, 1014.0),
+                ('KA', '2017-07-16 10:30:00', 1.0, 1, 1.0)]
+        pws = {'KA': (37.0, -122.0, 'X', ''), 'KB': (37.01, -122.01, 'X', ''), 'KC': (None, None, 'X', '')}
+        observation_slice = src.weather_area.load_slice(FakeStorage(rows, pws), FakeConf(), datetime.datetime(2017, 7, 16, 10, 0),
+                                                        datetime.datetime(2017, 7, 16, 10, 20))
+        # KC has no coordinates, 10:30 is past the end, 10:20 belongs to the last step
+        self.assertEqual(observation_slice.station_ids, ['KA', 'KB'])
+        self.assertEqual(len(observation_slice), 2)
+        temp_f = observation_slice.values['temp_f']
+        pressure_mb = observation_slice.values['pressure_mb']
+        # The later of KA's two readings in the first step is kept
+        self.assertEqual(temp_f[0, 0], 69.0)
+        self.assertTrue(math.isnan(pressure_mb[0, 0]))
+        self.assertTrue(math.isnan(temp_f[1, 0]))
+        self.assertEqual(pressure_mb[1, 0], 1011.0)
+        self.assertEqual(list(temp_f[:, 1]), [70.0, 72.0])
+
+if __name__ == '__main__':
+    unittest.main()
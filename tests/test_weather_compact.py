@@ -0,0 +1,97 @@
+"""Tests for the compact schema and its migration (src/weather_compact.py and
+src/weather_compact_migration.py), on a SQLite file
+
+    python -m pytest tests
+    python -m unittest discover tests"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import src.weather_compact
+import src.weather_compact_migration
+import src.weather_store
+import src.wu_records
+import src.wu_sqlite_wrapper
+
+LONG_WEATHER = 'Light Thunderstorms and Rain with Small Hail, Fog Patches and Blowing Widespread Dust'
+
+class FakeConf():
+    """Just the values the table setup, the inserts and the migration read"""
+
+    def __init__(self, compact):
+        self.values = {'drop_all_tables': False, 'observation_table_name': 'weather_nearby', 'pws_table_name': 'pws_nearby',
+                       'compact_observation_table_name': 'weather_obs', 'weather_lookup_table_name': 'weather_text',
+                       'watermark_table_name': 'job_watermark', 'compact_observations': compact,
+                       'observation_partitioning': False, 'rollup_enabled': False, 'insert_batch_size': 500,
+                       'migration_batch_size': 2, 'migration_pause_s': 0}
+
+def observation(station_id, minute, weather='Clear'):
+    return src.wu_records.Observation(station_id, str('2017-07-16 10:{0:02d}:00').format(minute), weather, 70.0, 21.1, 50,
+                                      1.0, 0.0, 29.9, 1013.0, 37.0, -122.0, 10, 'X', '94000')
+
+class CompactTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'compact.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def connect(self, compact):
+        dbw = src.wu_sqlite_wrapper.WeatherSqliteDatabase()
+        dbw.verbose = False
+        dbw.connect(self.path)
+        src.weather_store.setup_tables(dbw, FakeConf(compact))
+        src.weather_store.store_pws(dbw, FakeConf(compact), [src.wu_records.Station('KA', 37.0, -122.0, 'X', '', 1.0)])
+        return dbw
+
+    def weather(self, dbw):
+        dbw.execute('SELECT id, weather FROM weather_nearby ORDER BY id')
+        return dbw.cursor.fetchall()
+
+    def test_long_weather_text_is_kept(self):
+        dbw = self.connect(True)
+        src.weather_store.store_observations(dbw, FakeConf(True), [observation('KA', 0, LONG_WEATHER), observation('KA', 1)])
+        self.assertEqual(self.weather(dbw), [(1, LONG_WEATHER), (2, 'Clear')])
+        dbw.close_connection()
+
+    def test_writer_follows_the_migration(self):
+        writer = self.connect(False)
+        src.weather_store.store_observations(writer, FakeConf(False), [observation('KA', 0)])
+        self.assertFalse(writer.schema_info['compact'])
+
+        migrator = self.connect(False)
+        src.weather_compact_migration.migrate_to_compact(migrator, FakeConf(False))
+        migrator.close_connection()
+
+        # The writer still has the wide table cached, its insert is retried on the view's table
+        src.weather_store.store_observations(writer, FakeConf(False), [observation('KA', 1, 'Rain')])
+        self.assertTrue(writer.schema_info['compact'])
+        self.assertEqual(self.weather(writer), [(1, 'Clear'), (2, 'Rain')])
+        writer.close_connection()
+
+    def test_narrow_lookup_table_is_widened(self):
+        dbw = self.connect(True)
+        src.weather_store.store_observations(dbw, FakeConf(True), [observation('KA', 0, 'Rain'), observation('KA', 1)])
+        # As created before the hash key
+        dbw.drop_view('weather_nearby')
+        dbw.drop_table('weather_text')
+        dbw.open_or_create_table('weather_text', 'id', 'name VARCHAR(60) UNIQUE')
+        dbw.add_rows_to_table('weather_text', ['id', 'name'], [(7, 'Rain'), (9, 'Clear')])
+        dbw.execute('UPDATE weather_obs SET weather_id=7 WHERE id=1')
+        dbw.execute('UPDATE weather_obs SET weather_id=9 WHERE id=2')
+        dbw.create_view('weather_nearby', src.weather_compact.view_select(FakeConf(True)))
+        dbw.commit()
+        dbw.close_connection()
+
+        dbw = self.connect(True)
+        self.assertTrue(dbw.column_exists('weather_text', 'name_hash'))
+        self.assertEqual(self.weather(dbw), [(1, 'Rain'), (2, 'Clear')])
+        src.weather_store.store_observations(dbw, FakeConf(True), [observation('KA', 2, LONG_WEATHER), observation('KA', 3, 'Rain')])
+        self.assertEqual(self.weather(dbw)[2:], [(3, LONG_WEATHER), (4, 'Rain')])
+        dbw.close_connection()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+"""Tests for the columnar writers in src/weather_export.py, skipped when pyarrow is not
+installed
+
+    python -m pytest tests
+    python -m unittest discover tests"""
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import src.weather_export
+
+PWS_ROWS = [('KCASANFR123', 37.77, -122.42, 'San Francisco', 'Mission'),
+            ('KCAMOUNT1', 37.39, -122.08, 'Mountain View', None)]
+
+# Times come back as text from SQLite and as datetime from MySQL
+OBSERVATION_ROWS = [(1, 'KCASANFR123', '2017-07-16 10:00:00', 'Clear', 70.0, 21.1, 50, 1.0, 0.0, 29.9, 1013.0,
+                     37.77, -122.42, 10, 'San Francisco', '94110'),
+                    (2, 'KCAMOUNT1', datetime.datetime(2017, 7, 16, 10, 5), None, None, None, None, None, None, None,
+                     None, 37.39, -122.08, None, 'Mountain View', None)]
+
+class FakeConf():
+    """Just the values the exports read"""
+
+    def __init__(self, export_dir):
+        self.values = {'export_dir': export_dir, 'export_chunk_size': 1, 'pws_table_name': 'pws_nearby',
+                       'observation_table_name': 'weather_nearby'}
+
+class FakeStorage():
+    """Streams canned rows by table name"""
+
+    def __init__(self, rows_by_table):
+        self.rows_by_table = rows_by_table
+
+    def stream_chunks(self, table_name, col_data, order_by, chunk_size=1000, key_range=None):
+        rows = self.rows_by_table[table_name]
+        for start in range(0, len(rows), chunk_size):
+            yield rows[start:start + chunk_size]
+
+@unittest.skipIf(pyarrow is None, 'needs pyarrow')
+class ArrowExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.export_dir = tempfile.mkdtemp()
+        self.conf = FakeConf(self.export_dir)
+        self.dbw = FakeStorage({'pws_nearby': PWS_ROWS, 'weather_nearby': OBSERVATION_ROWS})
+
+    def tearDown(self):
+        shutil.rmtree(self.export_dir)
+
+    def read(self, path, export_format):
+        if export_format == 'parquet':
+            return pyarrow.parquet.read_table(path)
+        return pyarrow.ipc.open_file(path).read_all()
+
+    def export_both(self, export_format):
+        pws_path = src.weather_export.export_pws(self.dbw, self.conf, export_format)
+        observations_path = os.path.join(self.export_dir, 'weather_nearby' + src.weather_export.EXPORT_FORMATS[export_format])
+        count = src.weather_export.export_table(self.dbw, self.conf, 'weather_nearby', src.weather_export.EXPORT_OBSERVATION_COL_NAMES,
+                                                src.weather_export.OBSERVATION_COLUMN_TYPES, ['id'], observations_path, export_format)
+        self.assertEqual(count, 2)
+
+        pws = self.read(pws_path, export_format)
+        self.assertEqual(pws.schema.field('id').type, pyarrow.string())
+        self.assertEqual(pws.column('id').to_pylist(), ['KCASANFR123', 'KCAMOUNT1'])
+        self.assertEqual(pws.column('neighborhood').to_pylist(), ['Mission', None])
+
+        observations = self.read(observations_path, export_format)
+        self.assertEqual(observations.column_names, src.weather_export.EXPORT_OBSERVATION_COL_NAMES)
+        self.assertEqual(observations.schema.field('id').type, pyarrow.int64())
+        self.assertEqual(observations.column('id').to_pylist(), [1, 2])
+        self.assertEqual(observations.column('time').to_pylist(), [datetime.datetime(2017, 7, 16, 10, 0),
+                                                                   datetime.datetime(2017, 7, 16, 10, 5)])
+        self.assertEqual(observations.column('temp_f').to_pylist(), [70.0, None])
+        # Nothing is left under the temporary names
+        self.assertEqual(sorted(os.listdir(self.export_dir)), sorted([os.path.basename(pws_path), os.path.basename(observations_path)]))
+
+    def test_parquet(self):
+        self.export_both('parquet')
+
+    def test_arrow(self):
+        self.export_both('arrow')
+
+    def test_every_column_has_a_type(self):
+        import src.weather_store
+        self.assertEqual(set(src.weather_export.PWS_COLUMN_TYPES), set(src.weather_store.PWS_COL_NAMES))
+        self.assertEqual(set(src.weather_export.OBSERVATION_COLUMN_TYPES), set(src.weather_export.EXPORT_OBSERVATION_COL_NAMES))
+
+if __name__ == '__main__':
+    unittest.main()
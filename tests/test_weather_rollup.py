@@ -0,0 +1,139 @@
+"""Tests for the incremental rollups in src/weather_rollup.py, on a SQLite file
+
+    python -m pytest tests
+    python -m unittest discover tests"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import src.weather_rollup
+import src.weather_watermark
+import src.wu_sqlite_wrapper
+
+class FakeConf():
+    """Just the values the rollups read"""
+
+    def __init__(self, rollup_lag_s):
+        self.values = {'drop_all_tables': False, 'observation_table_name': 'weather_nearby',
+                       'watermark_table_name': 'job_watermark', 'rollup_hourly_table_name': 'weather_hourly',
+                       'rollup_daily_table_name': 'weather_daily', 'rollup_batch_size': 2, 'insert_batch_size': 500,
+                       'rollup_lag_s': rollup_lag_s}
+
+class FakeClock():
+    """Stands in for the time module in src.weather_rollup, sleeping moves it on"""
+
+    def __init__(self):
+        self.now = 1000000
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'rollup.sqlite3')
+        self.clock = FakeClock()
+        self.real_time = src.weather_rollup.time
+        src.weather_rollup.time = self.clock
+
+        dbw = self.connect()
+        dbw.open_or_create_table('weather_nearby', 'id', *['station_id VARCHAR(20)', 'time DATETIME', 'temp_f FLOAT',
+                                                            'relative_humidity TINYINT', 'pressure_mb FLOAT', 'precip_in FLOAT'])
+        src.weather_watermark.setup_watermark_table(dbw, FakeConf(0))
+        src.weather_rollup.setup_rollup_tables(dbw, FakeConf(0))
+        dbw.close_connection()
+
+    def tearDown(self):
+        src.weather_rollup.time = self.real_time
+        shutil.rmtree(self.folder)
+
+    def connect(self):
+        dbw = src.wu_sqlite_wrapper.WeatherSqliteDatabase()
+        dbw.verbose = False
+        dbw.connect(self.path)
+        return dbw
+
+    def insert(self, dbw, row_id, temp_f):
+        dbw.add_rows_to_table('weather_nearby', ['id', 'station_id', 'time', 'temp_f', 'relative_humidity', 'pressure_mb', 'precip_in'],
+                              [(row_id, 'KA', '2017-07-16 10:00:00', temp_f, 50, -999.0, None)])
+        dbw.commit()
+
+    def hourly(self, dbw):
+        return src.weather_rollup.get_rollups(dbw, FakeConf(0), 'hourly', 'KA', '2017-07-16', '2017-07-17')[0]
+
+    def test_without_lag_every_row_is_folded_once(self):
+        dbw = self.connect()
+        for row_id in range(1, 6):
+            self.insert(dbw, row_id, 60.0 + row_id)
+        self.assertEqual(src.weather_rollup.update_rollups(dbw, FakeConf(0)), 5)
+        self.assertEqual(src.weather_rollup.update_rollups(dbw, FakeConf(0)), 0)
+        hourly = self.hourly(dbw)
+        self.assertEqual(hourly['samples'], 5)
+        self.assertAlmostEqual(hourly['temp_f_avg'], 63.0)
+        self.assertIsNone(hourly['pressure_mb_avg'])
+        dbw.close_connection()
+
+    def test_late_commit_below_the_newest_id_is_folded(self):
+        dbw = self.connect()
+        conf = FakeConf(10)
+        self.insert(dbw, 1, 61.0)
+        self.insert(dbw, 2, 62.0)
+        # Id 3 is still committing when id 4 is stored and the rollups run
+        self.insert(dbw, 4, 64.0)
+        self.assertEqual(src.weather_rollup.update_rollups(dbw, conf), 0)
+
+        self.clock.now += 5
+        self.insert(dbw, 3, 63.0)
+        self.assertEqual(src.weather_rollup.update_rollups(dbw, conf), 0)
+
+        # Only the rows noted rollup_lag_s ago, the one stored since waits for the next note
+        self.clock.now += 5
+        self.insert(dbw, 5, 65.0)
+        self.assertEqual(src.weather_rollup.update_rollups(dbw, conf), 4)
+        self.assertEqual(src.weather_rollup.get_watermark(dbw, conf), 4)
+        self.assertEqual(self.hourly(dbw)['samples'], 4)
+
+        self.clock.now += 10
+        self.assertEqual(src.weather_rollup.update_rollups(dbw, conf), 1)
+        self.assertEqual(self.hourly(dbw)['samples'], 5)
+        dbw.close_connection()
+
+    def test_second_writer_waits_for_the_watermark(self):
+        first = self.connect()
+        second = self.connect()
+        second.execute('PRAGMA busy_timeout=100')
+        self.insert(first, 1, 61.0)
+
+        self.assertEqual(src.weather_watermark.lock_watermark(first, FakeConf(0), src.weather_rollup.WATERMARK_NAME), 0)
+        with self.assertRaises(sqlite3.OperationalError):
+            src.weather_rollup.update_rollups(second, FakeConf(0))
+        second.db.rollback()
+
+        # Once the first is done the second carries on from its watermark
+        src.weather_watermark.set_watermark(first, FakeConf(0), src.weather_rollup.WATERMARK_NAME, 1)
+        first.commit()
+        self.insert(first, 2, 62.0)
+        self.assertEqual(src.weather_rollup.update_rollups(second, FakeConf(0)), 1)
+        self.assertEqual(src.weather_rollup.get_watermark(second, FakeConf(0)), 2)
+        first.close_connection()
+        second.close_connection()
+
+    def test_catch_up_waits_out_the_lag(self):
+        dbw = self.connect()
+        conf = FakeConf(10)
+        for row_id in range(1, 4):
+            self.insert(dbw, row_id, 60.0)
+        self.assertEqual(src.weather_rollup.catch_up_rollups(dbw, conf), 3)
+        self.assertEqual(self.clock.sleeps, [10])
+        dbw.close_connection()
+
+if __name__ == '__main__':
+    unittest.main()
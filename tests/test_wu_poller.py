@@ -0,0 +1,84 @@
+"""Tests for the per-station polling in src/wu_poller.py
+
+    python -m pytest tests
+    python -m unittest discover tests"""
+import unittest
+
+import src.wu_poller
+import src.wu_records
+
+try:
+    import src.wu_api_wrapper as wu_api_wrapper
+except ImportError:
+    # The config needs the .gitignored src/wu_api_key.py
+    wu_api_wrapper = None
+
+class FakeConf():
+    """Just the values the poller reads"""
+
+    def __init__(self):
+        self.values = {'poll_interval_s': 600, 'poll_min_interval_s': 120, 'poll_max_interval_s': 7200,
+                       'poll_backoff_factor': 2.0, 'response_cache_ttl': {'geolookup': 86400},
+                       'api_calls_per_minute': 1000, 'api_calls_per_day': 1000000}
+
+class FakeWrapper():
+    """Canned conditions, a station id missing from them fails"""
+
+    def __init__(self, readings):
+        self.fetch_max_workers = 4
+        self.readings = readings
+
+    def get_pws_weather_response(self, pws_id, use_cache=True):
+        if pws_id not in self.readings:
+            raise KeyError('current_observation')
+        return src.wu_records.Observation(pws_id, self.readings[pws_id], 'Clear', 70.0, 21.0, 50, 1.0, 0.0,
+                                          29.9, 1013.0, 37.0, -122.0, 10, 'X', '94000')
+
+    def get_pws_weather_outcomes(self, pws_ids, use_cache=True):
+        outcomes = []
+        for pws_id in pws_ids:
+            try:
+                outcomes.append((self.get_pws_weather_response(pws_id, use_cache), None))
+            except KeyError as e:
+                outcomes.append((None, e))
+        return outcomes
+
+class FakePipeline():
+    """Collects what the poller queues"""
+
+    def __init__(self):
+        self.observations = []
+
+    def put(self, observation):
+        self.observations.append(observation)
+
+class PollOnceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.wu = FakeWrapper({'KA': '2017-07-16 10:00:00', 'KC': '2017-07-16 10:01:00'})
+        self.pipeline = FakePipeline()
+        self.poller = src.wu_poller.StationPoller(self.wu, None, FakeConf(), self.pipeline)
+        self.poller.next_refresh = float('inf')
+        for station_id in ['KA', 'KB', 'KC']:
+            self.poller.stations[station_id] = {'interval': 600, 'due': 0.0, 'last_time': None}
+            self.poller.schedule.append((0.0, station_id))
+
+    @unittest.skipIf(wu_api_wrapper is None, 'needs src/wu_api_key.py')
+    def test_outcomes_keep_the_order(self):
+        # The wrapper's own fan-out, over the canned conditions
+        outcomes = wu_api_wrapper.WeatherUnderground.get_pws_weather_outcomes(self.wu, ['KA', 'KB', 'KC'])
+        self.assertEqual([observation.station_id for observation, error in outcomes if error is None], ['KA', 'KC'])
+        self.assertIsNone(outcomes[1][0])
+        self.assertIsInstance(outcomes[1][1], KeyError)
+
+    def test_failed_station_does_not_lose_the_others(self):
+        self.assertEqual(self.poller.poll_once(1000.0), 2)
+        self.assertEqual([observation.station_id for observation in self.pipeline.observations], ['KA', 'KC'])
+        # Only the station that failed is backed off
+        self.assertEqual(self.poller.stations['KA']['interval'], 300)
+        self.assertEqual(self.poller.stations['KB']['interval'], 1200)
+        self.assertEqual(self.poller.stations['KC']['interval'], 300)
+        self.assertEqual(self.poller.stations['KB']['due'], 2200.0)
+
+if __name__ == '__main__':
+    unittest.main()
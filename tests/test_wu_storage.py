@@ -0,0 +1,46 @@
+"""Tests for the connection pool in src/wu_storage.py
+
+    python -m pytest tests
+    python -m unittest discover tests"""
+import unittest
+
+import src.wu_storage
+
+class FakeDb():
+    """Counts the transactions ended on it"""
+
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+class FakeWrapper():
+    """Just the connection the pool ends transactions on"""
+
+    def __init__(self):
+        self.db = FakeDb()
+
+class ReadConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = src.wu_storage.WeatherConnectionPool(FakeWrapper, size=1)
+
+    def test_read_transaction_ended_after_each_read(self):
+        # A connection holding its first snapshot would never see other writers' rows
+        with self.pool.read_connection() as first:
+            self.assertEqual(first.db.rollbacks, 0)
+        with self.pool.read_connection() as second:
+            self.assertIs(second, first)
+            self.assertEqual(second.db.rollbacks, 1)
+        self.assertEqual(first.db.rollbacks, 2)
+
+    def test_connection_returned_after_an_error(self):
+        with self.assertRaises(KeyError):
+            with self.pool.read_connection() as dbw:
+                raise KeyError('station')
+        self.assertEqual(dbw.db.rollbacks, 1)
+        self.assertIs(self.pool.acquire(), dbw)
+
+if __name__ == '__main__':
+    unittest.main()
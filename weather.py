@@ -0,0 +1,212 @@
+"""This module is the command line entry point for the WeatherUnderground scripts
+
+    python weather.py fetch          query the nearby PWS and print their conditions
+    python weather.py store          fetch, then store the PWS and observations
+    python weather.py report         print the stored observations by station
+    python weather.py export         write the tables out (see weather_export.py)
+    python weather.py area           area statistics and interpolated grids (needs numpy)
+
+The configuration is built once and handed to every step.  Each subcommand only imports
+the modules it uses, so a report never loads the REST client and a fetch never loads a
+database driver.  Check the startup cost of a subcommand with weather_startup_check.py, or
+by hand with
+
+    python -X importtime weather.py report --imports-only"""
+import argparse
+import src.weather_conf
+import src.wu_metrics
+
+def print_weather_info(wu, conf, weather_info):
+    """Print returned PWS/Weather data for console"""
+    print('_'*80)
+    print()
+    print(str('PWS FOUND NEARBY (MAX:{0:^2})').format(conf.values['pws_max_extract']))
+    for pws_info in weather_info[0]:
+        print('_'*80)
+        wu.print_pws_info(pws_info)
+
+    print()
+    print('_'*80)
+    print()
+    print('OBSERVATION DATA FOR THE PWS LISTED ABOVE')
+    for observation in weather_info[1]:
+        print('_'*80)
+        wu.print_weather_observation(observation)
+
+def fetch(conf, args):
+    """Query the nearby PWS and their conditions, and print them
+    returns: (list of Station records, list of Observation records)"""
+    import src.wu_api_wrapper
+    if args.imports_only:
+        return None
+
+    # This call goes to the cloud to get/parse/return data about nearby weather
+    # stations and conditions.  Look in src/wu_api_wrapper.py for the REST code
+    wu = src.wu_api_wrapper.WeatherUnderground(conf)
+    weather_info = wu.get_weather_and_pws_info()
+    print_weather_info(wu, conf, weather_info)
+    return weather_info
+
+def store(conf, args):
+    """Fetch, then add the PWS and observations to the database"""
+    import src.weather_store
+    weather_info = fetch(conf, args)
+    if args.imports_only:
+        return
+
+    print()
+    print('_'*80)
+    print()
+    print('ADD DATA TO DATABASE')
+    print('_'*80)
+    # Connect, then open (or create) the database and tables.  Look in src/weather_store.py
+    # for the schema
+    dbw = src.weather_store.open_weather_database(conf)
+
+    # New and changed PWS go in as one upsert, unchanged ones are skipped
+    src.weather_store.store_pws(dbw, conf, weather_info[0])
+    # ADD NEW OBSERVATIONS TO TABLE
+    src.weather_store.store_observations(dbw, conf, weather_info[1])
+    dbw.close_connection()
+
+    if args.report:
+        report(conf, args)
+
+def report(conf, args):
+    """Print the stored observations, grouped by station"""
+    import src.weather_store
+    if args.imports_only:
+        return
+
+    print()
+    print('PRINT THE OBSERVATION DATA FOR EACH STORED STATION')
+    print('_'*80)
+    print()
+    if not conf.values['print_db']:
+        print('PRINT DATABASE DISABLED BY SETTINGS...')
+        print('_'*80)
+        return
+
+    dbw = src.weather_store.open_weather_database(conf)
+    # One ordered pass over the observations, streamed in chunks.  The (station_id, time)
+    # key hands the rows back already grouped by station
+    column_names = ['station_id', 'weather', 'temp_f', 'relative_humidity', 'city', 'time', 'id']
+    weather_rows = dbw.stream_rows(conf.values['observation_table_name'], column_names, ['station_id', 'time'], conf.values['report_chunk_size'])
+
+    station_id = None
+    for weather_row in weather_rows:
+        # Header whenever we move on to the next station
+        if weather_row[0] != station_id:
+            station_id = weather_row[0]
+            print()
+            print('_'*80)
+            print(str('OBSERVATION DATA FOR PWS = "{0}"...').format(station_id))
+            print('_'*80)
+
+        print('_'*40)
+        print('ENTRYID: ' + str(weather_row[6]))
+        print('WEATHER: ' + str(weather_row[1]))
+        print('TEMP(F): ' + str(weather_row[2]))
+        print('HUM(%): ' + str(weather_row[3]))
+        print('CITY: ' + str(weather_row[4]))
+        print('TIME: ' + str(weather_row[5]))
+        print()
+    print('_'*80)
+    dbw.close_connection()
+
+def export(conf, args):
+    """Write the PWS table and the new (or all) observations to files"""
+    import src.weather_export
+    import src.weather_store
+    if args.imports_only:
+        return
+
+    if args.dir is not None:
+        conf.values['export_dir'] = args.dir
+    dbw = src.weather_store.open_weather_database(conf)
+    print('_'*80)
+    print()
+    print('EXPORTING TABLES')
+    print('_'*80)
+    src.weather_export.export_all(dbw, conf, args.format, args.full)
+    dbw.close_connection()
+
+def area(conf, args):
+    """Print the area statistics of the last hours, per time step, and save the grids"""
+    import datetime
+    import src.weather_area
+    import src.weather_store
+    if args.imports_only:
+        return
+
+    end_time = datetime.datetime.strptime(args.end, '%Y-%m-%d %H:%M:%S') if args.end else None
+    start_time, end_time = src.weather_area.default_window(args.hours, end_time)
+    dbw = src.weather_store.open_weather_database(conf)
+    observation_slice, statistics, grids, axes = src.weather_area.summarize(dbw, conf, start_time, end_time, grid=args.grid is not None)
+    dbw.close_connection()
+
+    print('_'*80)
+    print()
+    print(str('AREA CONDITIONS FROM {0} TO {1}, {2} STATIONS').format(start_time, end_time, len(observation_slice.station_ids)))
+    print('_'*80)
+    for measure in src.weather_area.MEASURES:
+        print(measure.upper() + ' (MEAN / MEDIAN / ROBUST MEAN, STATIONS, OUTLIERS)')
+        measure_stats = statistics[measure]
+        for step in range(len(observation_slice)):
+            if measure_stats['count'][step] == 0:
+                continue
+            print(str('    {0}  {1:8.2f} {2:8.2f} {3:8.2f}  {4:3d} {5:3d}').format(
+                observation_slice.step_starts[step].astype(datetime.datetime), measure_stats['mean'][step],
+                measure_stats['median'][step], measure_stats['robust_mean'][step],
+                int(measure_stats['count'][step]), int(measure_stats['outliers'][step])))
+    if args.grid is not None and grids[src.weather_area.MEASURES[0]] is not None:
+        import numpy
+        numpy.savez_compressed(args.grid, step_starts=observation_slice.step_starts, grid_lats=axes[0], grid_lons=axes[1],
+                               **grids)
+        print(str('WROTE THE GRIDS TO {0}').format(args.grid))
+    print('_'*80)
+
+def build_parser():
+    """Argument parser with one sub parser per subcommand"""
+    parser = argparse.ArgumentParser(description='Collect, store and report weather from nearby PWS')
+    # Shared by every subcommand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--imports-only', action='store_true',
+                        help='load the subcommand\'s modules and stop, for measuring startup time')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('fetch', parents=[common], help='query the nearby PWS and print their conditions').set_defaults(run=fetch)
+
+    store_parser = subparsers.add_parser('store', parents=[common], help='fetch, then store the PWS and observations')
+    store_parser.add_argument('--report', action='store_true', help='print the stored observations afterwards')
+    store_parser.set_defaults(run=store)
+
+    subparsers.add_parser('report', parents=[common], help='print the stored observations by station').set_defaults(run=report)
+
+    export_parser = subparsers.add_parser('export', parents=[common], help='write the tables out for analytics')
+    export_parser.add_argument('--format', help='parquet, arrow, csv.zst or csv.gz (default export_format)')
+    export_parser.add_argument('--dir', help='folder to write to (default export_dir)')
+    export_parser.add_argument('--full', action='store_true', help='export every observation, not just the new ones')
+    export_parser.set_defaults(run=export)
+
+    area_parser = subparsers.add_parser('area', parents=[common], help='area statistics and interpolated grids (needs numpy)')
+    area_parser.add_argument('--hours', type=float, default=3, help='hours back from the end time to cover (default 3)')
+    area_parser.add_argument('--end', help='end time, \'YYYY-MM-DD HH:MM:SS\' (default now)')
+    area_parser.add_argument('--grid', help='also interpolate the grids and save them to this .npz file')
+    area_parser.set_defaults(run=area)
+    return parser
+
+def main(argv=None):
+    """Parse the command line and run the subcommand
+    argv: arguments (default sys.argv[1:])"""
+    args = build_parser().parse_args(argv)
+    # Configuration dictionary - this holds all sorts of values, like the database
+    # and table names, the REST API queries, and diagnostic flags
+    conf = src.weather_conf.WeatherConfig()
+    # Logging level and the metrics exports come from the config as well
+    src.wu_metrics.configure(conf)
+    args.run(conf, args)
+    src.wu_metrics.finish(conf)
+
+if __name__ == '__main__':
+    main()
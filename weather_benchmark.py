@@ -0,0 +1,251 @@
+"""This module benchmarks the full weather_nearby.py flow stage by stage against the local
+simulator (src/wu_simulator.py) and a throwaway benchmark database.
+
+    python weather_benchmark.py --backend sqlite --output bench_results.json
+    python weather_benchmark.py --compare bench_results.json --output bench_new.json
+
+Each station count runs in a fresh process, so its peak_rss_kb is its own.  Results are
+written as JSON.  With --compare, any stage whose throughput dropped by more
+than --tolerance against the baseline is reported and the exit code is 1"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+import src.weather_conf
+import src.weather_store
+import src.wu_api_wrapper
+import src.wu_simulator
+
+STAGES = ['geolookup', 'fetch', 'parse', 'pws_upsert', 'observation_insert', 'report']
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+class StageTimer():
+    """Collects the per-item latencies, wall time and item count for one stage"""
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.latencies = []
+        self.items = 0
+        self.seconds = 0.0
+        self.peak_bytes = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self):
+        """Times the whole stage (and its peak traced memory when enabled)"""
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield self
+        self.seconds = time.perf_counter() - start
+        if self.trace_memory:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+
+    def timed(self, function, *args, items=1):
+        """Call function(*args), recording its latency as one sample covering 'items'"""
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        with self.lock:
+            self.latencies.append(elapsed)
+            self.items += items
+        return result
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        return {'items': self.items,
+                'seconds': round(self.seconds, 6),
+                'items_per_s': round(self.items / self.seconds, 2) if self.seconds else 0.0,
+                'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+                'peak_kb': round(self.peak_bytes / 1024.0, 1) if self.trace_memory else None}
+
+def benchmark_conf(host, station_count, cache_dir, backend):
+    """WeatherConfig aimed at the simulator and the benchmark database, with the quota,
+    caches and station limits out of the way"""
+    conf = src.weather_conf.WeatherConfig()
+    conf.values['endpoint_host'] = host
+    conf.build_endpoint_urls()
+    conf.values['use_live_server'] = True
+    conf.values['save_live_response'] = False
+    conf.values['response_cache_dir'] = cache_dir
+    conf.values['use_station_index'] = False
+    conf.values['api_calls_per_minute'] = 10 ** 9
+    conf.values['api_calls_per_day'] = 10 ** 12
+    conf.values['pws_max_distance_km'] = 10 ** 6
+    conf.values['pws_max_extract'] = station_count
+    conf.values['database_name'] = conf.values['database_name'] + '_bench'
+    conf.values['drop_all_tables'] = True
+    conf.values['storage_backend'] = backend
+    conf.values['sqlite_path'] = os.path.join(cache_dir, 'bench.sqlite3')
+    # A single writer, so the rollups fold in on every insert as they did before the lag
+    # existed, and the numbers stay comparable with older baselines
+    conf.values['rollup_lag_s'] = 0
+    return conf
+
+def run_pipeline(conf, trace_memory):
+    """One pass of geolookup -> fetch -> parse -> PWS upsert -> observation insert -> report"""
+    timers = {stage: StageTimer(trace_memory) for stage in STAGES}
+    wu = src.wu_api_wrapper.WeatherUnderground(conf)
+
+    with timers['geolookup'].stage() as timer:
+        stations = timer.timed(wu.get_nearby_pws_info, items=1)
+    station_ids = [pws_info.id for pws_info in stations]
+
+    # Fetch and parse are timed apart, so the raw (json decoded) responses are kept here
+    with timers['fetch'].stage() as timer:
+        urls = [wu.station_url_format.format(station_id) for station_id in station_ids]
+        with ThreadPoolExecutor(max_workers=conf.values['fetch_max_workers']) as executor:
+            responses = list(executor.map(lambda url: timer.timed(wu.get_server_response, url, 'conditions', False), urls))
+
+    with timers['parse'].stage() as timer:
+        observations = [timer.timed(wu.function_to_extract_observation_data, response) for response in responses]
+    del responses
+
+    dbw = src.weather_store.open_weather_database(conf)
+    dbw.verbose = False
+    batch_size = conf.values['insert_batch_size']
+    try:
+        with timers['pws_upsert'].stage() as timer:
+            known_pws = src.weather_store.load_known_pws(dbw, conf)
+            for start in range(0, len(stations), batch_size):
+                batch = stations[start:start + batch_size]
+                timer.timed(src.weather_store.store_pws, dbw, conf, batch, known_pws, items=len(batch))
+
+        with timers['observation_insert'].stage() as timer:
+            for start in range(0, len(observations), batch_size):
+                batch = observations[start:start + batch_size]
+                timer.timed(src.weather_store.store_observations, dbw, conf, batch, items=len(batch))
+
+        with timers['report'].stage() as timer:
+            chunk_size = conf.values['report_chunk_size']
+            rows = dbw.stream_rows(conf.values['observation_table_name'], src.weather_store.OBSERVATION_COL_NAMES,
+                                   ['station_id', 'time'], chunk_size)
+            # One latency sample per chunk of rows
+            count = 0
+            start = time.perf_counter()
+            for row in rows:
+                count += 1
+                if count % chunk_size == 0:
+                    timer.latencies.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+            if count % chunk_size:
+                timer.latencies.append(time.perf_counter() - start)
+            timer.items = count
+    finally:
+        dbw.close_connection()
+
+    return {stage: timers[stage].summary() for stage in STAGES}
+
+def peak_rss_kb():
+    """Peak resident memory of this process in KB, where the platform reports it.  It is the
+    peak since the process started, hence one process per station count"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes, Linux KB
+    return peak / 1024.0 if sys.platform == 'darwin' else float(peak)
+
+def run_station_count(station_count, port, latency_ms, cache_dir, backend, trace_memory):
+    """One pass against a simulator with station_count stations, meant to run in a process of
+    its own (see main)
+    returns: the run's entry for the results, with its stages and peak_rss_kb"""
+    if trace_memory:
+        tracemalloc.start()
+    stations = src.wu_simulator.SimulatedStations(station_count, 37.392089, -122.083347, 30.0, 0.02)
+    settings = src.wu_simulator.SimulatorSettings(latency_ms, 0.0, 0.0, 0, 10 ** 6, station_count)
+    server = src.wu_simulator.make_server(port, stations, settings)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    conf = benchmark_conf(str('http://127.0.0.1:{0}').format(port), station_count, cache_dir, backend)
+    try:
+        # The pipeline prints as it goes, keep that out of the numbers
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            stages = run_pipeline(conf, trace_memory)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return {'stations': station_count, 'stages': stages, 'peak_rss_kb': peak_rss_kb()}
+
+def compare(baseline, current, tolerance):
+    """List of regression messages, stages whose items/s fell by more than tolerance"""
+    regressions = []
+    baseline_runs = {run['stations']: run for run in baseline['runs']}
+    for run in current['runs']:
+        old_run = baseline_runs.get(run['stations'])
+        if old_run is None:
+            continue
+        for stage in STAGES:
+            old_rate = old_run['stages'].get(stage, {}).get('items_per_s', 0.0)
+            new_rate = run['stages'][stage]['items_per_s']
+            if old_rate and new_rate < old_rate * (1.0 - tolerance):
+                regressions.append(str('{0} stations, {1}: {2:.1f}/s -> {3:.1f}/s ({4:+.0%})').format(
+                    run['stations'], stage, old_rate, new_rate, new_rate / old_rate - 1.0))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-stage throughput benchmark of the weather pipeline')
+    parser.add_argument('--stations', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000],
+                        help='station counts to run (each is a separate pass)')
+    parser.add_argument('--port', type=int, default=8089, help='port for the in-process simulator')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated API latency')
+    parser.add_argument('--backend', choices=['mysql', 'sqlite'], default='mysql', help='storage backend to write to')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='record per-stage peak Python memory with tracemalloc (slows every stage)')
+    parser.add_argument('--output', default='bench_results.json', help='JSON file to write')
+    parser.add_argument('--compare', help='baseline JSON file to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed throughput drop before flagging')
+    args = parser.parse_args()
+
+    results = {'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'backend': args.backend,
+               'runs': []}
+
+    cache_dir = tempfile.mkdtemp(prefix='wu_bench_cache_')
+    # A spawned (not forked) process per station count starts from a clean slate, so the
+    # peak memory of one run does not carry over into the next
+    context = multiprocessing.get_context('spawn')
+    for station_count in args.stations:
+        with context.Pool(1) as pool:
+            run = pool.apply(run_station_count, (station_count, args.port, args.latency_ms, cache_dir, args.backend,
+                                                 args.trace_memory))
+        results['runs'].append(run)
+        stages = run['stages']
+        print(str('{0:>7} STATIONS').format(station_count))
+        for stage in STAGES:
+            print(str('    {0:<20} {1:>12.1f}/s   p50 {2:>9.3f}ms   p99 {3:>9.3f}ms').format(
+                stage, stages[stage]['items_per_s'], stages[stage]['p50_ms'], stages[stage]['p99_ms']))
+
+    with open(args.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    print('RESULTS WRITTEN TO ' + args.output)
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            regressions = compare(json.load(baseline_file), results, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
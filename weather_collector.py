@@ -0,0 +1,30 @@
+"""This module collects weather for several locations (see extra_locations and
+location_grid in src/weather_conf.py) in a single run.  Overlapping stations are only
+queried once"""
+import src.wu_api_wrapper
+import src.wu_metrics
+import src.weather_store
+import src.wu_collector
+
+if __name__ == '__main__':
+    # Configuration dictionary - see src/weather_conf.py for the location settings
+    conf = src.weather_conf.WeatherConfig()
+    # Logging level and the metrics exports come from the config as well
+    src.wu_metrics.configure(conf)
+
+    # Wrapper for the Weather Underground API calls, used here for the geolookups
+    wu = src.wu_api_wrapper.WeatherUnderground(conf)
+
+    # Connect, then open (or create) the database and tables
+    dbw = src.weather_store.open_weather_database(conf)
+
+    print('_'*80)
+    print()
+    print('COLLECTING ALL CONFIGURED LOCATIONS')
+    print('_'*80)
+    stations, fetched = src.wu_collector.collect(conf, wu, dbw)
+    print(str('STORED {0} OBSERVATIONS FROM {1} PWS').format(fetched, len(stations)))
+
+    # Close the connection
+    dbw.close_connection()
+    src.wu_metrics.finish(conf)
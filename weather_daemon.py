@@ -0,0 +1,46 @@
+"""This module runs the WeatherUnderground collector as a long running poller.  Unlike
+weather_nearby.py it stays resident, keeps its connections open and polls each station
+on its own interval"""
+import src.wu_api_wrapper
+import src.wu_metrics
+import src.weather_store
+import src.wu_pipeline
+import src.wu_poller
+
+# Configuration dictionary - see src/weather_conf.py for the poller settings
+conf = src.weather_conf.WeatherConfig()
+# Logging level and the metrics exports come from the config as well
+src.wu_metrics.configure(conf)
+
+# Wrapper for the Weather Underground API calls, shared for the life of the daemon
+wu = src.wu_api_wrapper.WeatherUnderground(conf)
+
+# Connect once and keep the connection open
+dbw = src.weather_store.open_weather_database(conf)
+
+print('_'*80)
+print()
+print('POLLING NEARBY PWS (Ctrl+C TO STOP)')
+print('_'*80)
+# New readings are stored by the pipeline's own worker while polling carries on.  Its
+# spool keeps them through a database outage
+pipeline = None
+if conf.values['use_store_pipeline']:
+    pipeline = src.wu_pipeline.StorePipeline(conf, 'daemon')
+    pipeline.start()
+# Dashboards can read from the daemon itself, so the latest readings are served from
+# memory as soon as they are stored
+if conf.values['query_port']:
+    import src.weather_query
+    queries = src.weather_query.WeatherQueries(conf, src.weather_store.open_connection_pool(conf))
+    queries.serve(conf.values['query_port'])
+    print(str('SERVING QUERIES ON http://127.0.0.1:{0}/').format(conf.values['query_port']))
+poller = src.wu_poller.StationPoller(wu, dbw, conf, pipeline)
+poller.run()
+if pipeline is not None:
+    stored, spooled = pipeline.finish()
+    print(str('STORED {0} OBSERVATIONS, {1} LEFT SPOOLED').format(stored, spooled))
+
+# Close the connection
+dbw.close_connection()
+src.wu_metrics.finish(conf)
@@ -0,0 +1,39 @@
+"""This module exports the PWS and OBSERVATION tables to Parquet, Arrow or compressed CSV
+files for analytics (see the export settings in src/weather_conf.py).  Each run exports
+the observations stored since the previous one.
+
+    python weather_export.py
+    python weather_export.py --format csv.gz --full"""
+import argparse
+import src.weather_conf
+import src.weather_export
+import src.weather_store
+import src.wu_metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the weather tables to files')
+    parser.add_argument('--format', choices=sorted(src.weather_export.EXPORT_FORMATS), help='file format (default export_format)')
+    parser.add_argument('--dir', help='folder to write to (default export_dir)')
+    parser.add_argument('--full', action='store_true', help='export every observation, not just the new ones')
+    args = parser.parse_args()
+
+    # Configuration dictionary - see src/weather_conf.py for the export settings
+    conf = src.weather_conf.WeatherConfig()
+    if args.dir:
+        conf.values['export_dir'] = args.dir
+    # Logging level and the metrics exports come from the config as well
+    src.wu_metrics.configure(conf)
+
+    # Connect, then open (or create) the database and tables
+    dbw = src.weather_store.open_weather_database(conf)
+    dbw.verbose = False
+
+    print('_'*80)
+    print()
+    print('EXPORTING TO ' + conf.values['export_dir'])
+    print('_'*80)
+    src.weather_export.export_all(dbw, conf, args.format, args.full)
+
+    # Close the connection
+    dbw.close_connection()
+    src.wu_metrics.finish(conf)
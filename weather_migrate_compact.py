@@ -0,0 +1,29 @@
+"""This module moves the OBSERVATION table to the compact schema (see src/weather_compact.py
+and src/weather_compact_migration.py).  It is safe to run while the other scripts keep
+storing observations, and to stop and run again.  Set compact_observations in
+src/weather_conf.py afterwards, so a new database starts out compact too.
+
+    python weather_migrate_compact.py"""
+import src.weather_compact_migration
+import src.weather_conf
+import src.weather_store
+import src.wu_metrics
+
+if __name__ == '__main__':
+    # Configuration dictionary - see src/weather_conf.py for the migration settings
+    conf = src.weather_conf.WeatherConfig()
+    # Logging level and the metrics exports come from the config as well
+    src.wu_metrics.configure(conf)
+
+    # Connect, then open (or create) the database and tables
+    dbw = src.weather_store.open_weather_database(conf)
+
+    print('_'*80)
+    print()
+    print('MIGRATING OBSERVATIONS TO THE COMPACT SCHEMA')
+    print('_'*80)
+    src.weather_compact_migration.migrate_to_compact(dbw, conf)
+
+    # Close the connection
+    dbw.close_connection()
+    src.wu_metrics.finish(conf)
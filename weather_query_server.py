@@ -0,0 +1,44 @@
+"""This module serves the read queries (see src/weather_query.py) as JSON on a local port,
+for dashboards.  Run on its own, the cache only sees other processes' inserts once its
+entries expire (query_cache_ttl_s).  Set query_port for weather_daemon.py instead to have
+new readings served as soon as they are stored
+
+    python weather_query_server.py --port 8081
+    curl "http://127.0.0.1:8081/latest?station=KCAMOUNT1"
+    curl "http://127.0.0.1:8081/nearest?lat=37.39&lon=-122.08&count=3\""""
+import argparse
+import time
+import src.weather_conf
+import src.weather_query
+import src.weather_store
+import src.wu_metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve latest, history and nearest station queries as JSON')
+    parser.add_argument('--port', type=int, default=8081, help='local port to listen on (default 8081)')
+    args = parser.parse_args()
+
+    # Configuration dictionary - see src/weather_conf.py for the query settings
+    conf = src.weather_conf.WeatherConfig()
+    # Logging level and the metrics exports come from the config as well
+    src.wu_metrics.configure(conf)
+
+    # Make sure the tables are there, then query over a pool of connections
+    src.weather_store.open_weather_database(conf).close_connection()
+    pool = src.weather_store.open_connection_pool(conf)
+    queries = src.weather_query.WeatherQueries(conf, pool)
+    queries.serve(args.port)
+
+    print('_'*80)
+    print()
+    print(str('SERVING QUERIES ON http://127.0.0.1:{0}/ (Ctrl+C TO STOP)').format(args.port))
+    print('_'*80)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print('QUERY SERVER STOPPED.')
+
+    # Close the connections
+    pool.close_all()
+    src.wu_metrics.finish(conf)
@@ -0,0 +1,35 @@
+"""This module expires observations older than the retention period (see retention_months
+in src/weather_conf.py and src/weather_retention.py).  It is safe to run while the other
+scripts keep storing observations.
+
+    python weather_retention.py
+    python weather_retention.py --months 6 --archive"""
+import argparse
+import src.weather_conf
+import src.weather_retention
+import src.weather_store
+import src.wu_metrics
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Expire old observations')
+    parser.add_argument('--months', type=int, help='months of observations to keep (default retention_months)')
+    parser.add_argument('--archive', action='store_true', help='keep expired partitions as archive tables')
+    args = parser.parse_args()
+
+    # Configuration dictionary - see src/weather_conf.py for the retention settings
+    conf = src.weather_conf.WeatherConfig()
+    # Logging level and the metrics exports come from the config as well
+    src.wu_metrics.configure(conf)
+
+    # Connect, then open (or create) the database and tables
+    dbw = src.weather_store.open_weather_database(conf)
+
+    print('_'*80)
+    print()
+    print('EXPIRING OLD OBSERVATIONS')
+    print('_'*80)
+    src.weather_retention.purge_observations(dbw, conf, args.months, True if args.archive else None)
+
+    # Close the connection
+    dbw.close_connection()
+    src.wu_metrics.finish(conf)
@@ -0,0 +1,29 @@
+"""This module brings the hourly and daily rollups up to date with every observation stored
+since the last run (see src/weather_rollup.py).  Run it on a schedule when
+rollup_on_insert is off, or once to backfill the rollups for existing data"""
+import src.weather_conf
+import src.weather_rollup
+import src.weather_store
+import src.wu_metrics
+
+if __name__ == '__main__':
+    # Configuration dictionary - see src/weather_conf.py for the rollup settings
+    conf = src.weather_conf.WeatherConfig()
+    # Logging level and the metrics exports come from the config as well
+    src.wu_metrics.configure(conf)
+
+    # Connect, then open (or create) the database and tables (rollup tables included)
+    conf.values['rollup_enabled'] = True
+    dbw = src.weather_store.open_weather_database(conf)
+    dbw.verbose = False
+
+    print('_'*80)
+    print()
+    print(str('ROLLING UP OBSERVATIONS PAST ID {0}').format(src.weather_rollup.get_watermark(dbw, conf)))
+    print('_'*80)
+    folded = src.weather_rollup.catch_up_rollups(dbw, conf)
+    print(str('FOLDED {0} OBSERVATIONS INTO THE ROLLUPS').format(folded))
+
+    # Close the connection
+    dbw.close_connection()
+    src.wu_metrics.finish(conf)
@@ -0,0 +1,55 @@
+"""This module measures the startup cost of each weather.py subcommand with -X importtime and
+checks it against a budget, for runs started from cron where startup is a good share of
+the run.  Each subcommand is run with --imports-only in a fresh interpreter
+
+    python weather_startup_check.py
+    python weather_startup_check.py --budget-ms 150 report fetch"""
+import argparse
+import subprocess
+import sys
+import time
+
+SUBCOMMANDS = ['fetch', 'store', 'report', 'export']
+
+def import_times(subcommand):
+    """Run the subcommand's imports under -X importtime
+    returns: (wall clock ms, import ms, list of (cumulative ms, module) for top level imports)"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', 'weather.py', subcommand, '--imports-only'],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    wall_ms = (time.perf_counter() - start) * 1000
+
+    # Lines look like 'import time:       123 |       4567 |   package.module'.  Nested imports
+    # are indented under the module that pulled them in, so only the top level ones add up
+    top_level = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not name[1:].startswith(' '):
+            top_level.append((int(cumulative_us) / 1000, name.strip()))
+    return (wall_ms, sum(ms for ms, name in top_level), top_level)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check weather.py startup time against a budget')
+    parser.add_argument('subcommands', nargs='*', default=SUBCOMMANDS, help='subcommands to check (default all)')
+    parser.add_argument('--budget-ms', type=float, default=100.0, help='most time imports may take (default 100)')
+    parser.add_argument('--top', type=int, default=5, help='slowest imports listed per subcommand')
+    args = parser.parse_args()
+
+    over_budget = []
+    print('_'*80)
+    print()
+    print(str('STARTUP TIME (BUDGET {0:.0f} MS OF IMPORTS)').format(args.budget_ms))
+    print('_'*80)
+    for subcommand in args.subcommands:
+        wall_ms, imports_ms, top_level = import_times(subcommand)
+        status = 'OK' if imports_ms <= args.budget_ms else 'OVER BUDGET'
+        print(str('{0:<8} IMPORTS {1:8.1f} MS  WALL {2:8.1f} MS  {3}').format(subcommand.upper(), imports_ms, wall_ms, status))
+        for ms, name in sorted(top_level, reverse=True)[:args.top]:
+            print(str('    {0:8.1f} MS  {1}').format(ms, name))
+        if imports_ms > args.budget_ms:
+            over_budget.append(subcommand)
+
+    # Non zero exit so a scheduled check or CI step can fail on a regression
+    sys.exit(1 if over_budget else 0)